@@ -19,6 +19,22 @@ if [ -z "$1" ]; then
     exit 1
 fi
 
+# Packages vendored into the Lambda functions that use them, python2.7 runtime wheels
+NUMPY_PACKAGE="numpy==1.16.6"
+PILLOW_PACKAGE="Pillow==6.2.2"
+
+# Installs the manylinux wheels of the packages for the python2.7 Lambda runtime and adds them to a zip
+# zip_wheels zip-file package...
+function zip_wheels {
+    local zip_file=$1
+    local wheels_dir=$deployment_dir/dist/wheels
+    shift
+    rm -rf $wheels_dir
+    pip install -q --only-binary=:all: --platform manylinux1_x86_64 --python-version 27 --implementation cp --abi cp27mu --target $wheels_dir "$@" || exit 1
+    (cd $wheels_dir && zip -q -r9 $zip_file . -x "bin/*" "*.pyc")
+    rm -rf $wheels_dir
+}
+
 # Build source
 echo "Starting to build distribution"
 echo "export deployment_dir=`pwd`"
@@ -49,14 +65,31 @@ cd ..
 cd 99-rekog_collection_controller
 zip -q -r9 $deployment_dir/dist/01-SVBP_rekognition_core.zip rekog_collection_controller.py
 cd ..
+cd 99-rekognition_rate_limiter
+zip -q -r9 $deployment_dir/dist/01-SVBP_rekognition_core.zip rekognition_rate_limiter.py
+cd ..
 echo "Building 02-SVBP_rekognition_worker"
 cd 02-SVBP_rekognition_worker
-zip -q -r9 $deployment_dir/dist/02-SVBP_rekognition_worker.zip lambda_function.py ../../NOTICE.txt ../../LICENSE.txt
+zip -q -r9 $deployment_dir/dist/02-SVBP_rekognition_worker.zip lambda_function.py face_search.py match_aggregator.py ../../NOTICE.txt ../../LICENSE.txt
+cd ..
+cd 99-rekognition_rate_limiter
+zip -q -r9 $deployment_dir/dist/02-SVBP_rekognition_worker.zip rekognition_rate_limiter.py
 cd ..
+cd 99-progress_publisher
+zip -q -r9 $deployment_dir/dist/02-SVBP_rekognition_worker.zip progress_publisher.py
+cd ..
+cd 99-iot_publisher
+zip -q -r9 $deployment_dir/dist/02-SVBP_rekognition_worker.zip iot_publisher.py
+cd ..
+echo "Adding Pillow to 02-SVBP_rekognition_worker"
+zip_wheels $deployment_dir/dist/02-SVBP_rekognition_worker.zip $PILLOW_PACKAGE
 echo "Building 03-SVBP_rekognition_ddb_stream"
 cd 03-SVBP_rekognition_ddb_stream
 zip -q -r9 $deployment_dir/dist/03-SVBP_rekognition_ddb_stream.zip lambda_function.py ../../NOTICE.txt ../../LICENSE.txt
 cd ..
+cd 99-iot_publisher
+zip -q -r9 $deployment_dir/dist/03-SVBP_rekognition_ddb_stream.zip iot_publisher.py
+cd ..
 echo "Building 04-SVBP_rekognition_iot"
 cd 04-SVBP_rekognition_iot
 zip -q -r9 $deployment_dir/dist/04-SVBP_rekognition_iot.zip lambda_function.py ../../NOTICE.txt ../../LICENSE.txt
@@ -73,13 +106,37 @@ cd ..
 cd 99-rekog_collection_controller
 zip -q -r9 $deployment_dir/dist/05-RVA_process_dynamodbstream_function.zip rekog_collection_controller.py
 cd ..
+cd 99-rekognition_rate_limiter
+zip -q -r9 $deployment_dir/dist/05-RVA_process_dynamodbstream_function.zip rekognition_rate_limiter.py
+cd ..
+cd 99-part_tracking
+zip -q -r9 $deployment_dir/dist/05-RVA_process_dynamodbstream_function.zip part_tracking.py
+cd ..
+cd 99-fleet_scheduler
+zip -q -r9 $deployment_dir/dist/05-RVA_process_dynamodbstream_function.zip fleet_scheduler.py
+cd ..
+cd 99-progress_publisher
+zip -q -r9 $deployment_dir/dist/05-RVA_process_dynamodbstream_function.zip progress_publisher.py
+cd ..
+cd 99-iot_publisher
+zip -q -r9 $deployment_dir/dist/05-RVA_process_dynamodbstream_function.zip iot_publisher.py
+cd ..
 echo "Building 06-RVA_process_photos_function"
 cd 06-RVA_process_photos_function
-zip -q -r9 $deployment_dir/dist/06-RVA_process_photos_function.zip lambda_function.py ../../NOTICE.txt ../../LICENSE.txt
+zip -q -r9 $deployment_dir/dist/06-RVA_process_photos_function.zip lambda_function.py frame_dedup.py batch_context.py task_scheduler.py adaptive_concurrency.py batch_writer.py frame_results_file.py face_summary.py update_expression.py parts_job.py ../../NOTICE.txt ../../LICENSE.txt
 cd ..
 cd 99-rekog_collection_controller
 zip -q -r9 $deployment_dir/dist/06-RVA_process_photos_function.zip rekog_collection_controller.py
 cd ..
+cd 99-rekognition_rate_limiter
+zip -q -r9 $deployment_dir/dist/06-RVA_process_photos_function.zip rekognition_rate_limiter.py
+cd ..
+cd 99-part_tracking
+zip -q -r9 $deployment_dir/dist/06-RVA_process_photos_function.zip part_tracking.py
+cd ..
+# numpy: frame_dedup.py and face_summary.py, Pillow: frame_dedup.py
+echo "Adding numpy and Pillow to 06-RVA_process_photos_function"
+zip_wheels $deployment_dir/dist/06-RVA_process_photos_function.zip $NUMPY_PACKAGE $PILLOW_PACKAGE
 echo "Building final Label creating Lambda function"
 echo "Building 11-Prepare_label_timeline"
 cd 11-Prepare_label_timeline
@@ -8,6 +8,9 @@ rm -Rf videos/* images/*
 FFMPEG_FRAMES_PER_SECOND=1
 SQS_MAX_NUMBER_OF_MESSAGES=1
 SQS_WAIT_TIME_SECONDS=20
+PARTS_MAPS_MAX_BYTES=8192 # videos whose part maps would be larger keep their parts in RVA_PROCESS_PARTS_TABLE
+PART_ENTRY_BYTES=25
+PART_SHARDS=10
 
 # Constants section
 INSTANCE_ID=`curl http://169.254.169.254/latest/meta-data/instance-id`
@@ -20,6 +23,16 @@ function log {
     echo "[$(date +%Y-%m-%dT%H:%M:%S) $INSTANCE_ID] - $1"
 }
 
+# Estimated size of the Parts, LeaseExpires and Attempts maps of the process item, each part key is in the three maps
+function parts_maps_size {
+    local SIZE=0
+    for PART in "$@"
+    do
+        SIZE=$((SIZE + 3 * ${#PART} + PART_ENTRY_BYTES))
+    done
+    echo $SIZE
+}
+
 # Find the proper batch size according to the number of frames
 function find_batch_size {
     if [ $1 -lt 1800 ] ; then
@@ -46,7 +59,14 @@ do
         log "Processing video '$OBJECT_KEY'"
 
 		# Update processing status before processing
-		IOT_TOPIC=$(aws s3api head-object --bucket $BUCKET_NAME --key $OBJECT_KEY | jq -r '.Metadata.topic')
+		OBJECT_METADATA=$(aws s3api head-object --bucket $BUCKET_NAME --key $OBJECT_KEY | jq -c '.Metadata')
+		IOT_TOPIC=$(echo $OBJECT_METADATA | jq -r '.topic')
+
+		# Optional priority tier and weight of the video, used when the frame batches share a fleet-wide limit
+		PRIORITY=$(echo $OBJECT_METADATA | jq -r '.priority // "0"')
+		WEIGHT=$(echo $OBJECT_METADATA | jq -r '.weight // "1"')
+		[[ "$PRIORITY" =~ ^[0-9]+$ ]] || PRIORITY=0
+		[[ "$WEIGHT" =~ ^[1-9][0-9]*$ ]] || WEIGHT=1
 		aws lambda invoke --invocation-type Event --function-name <iot_publish_function> --region $EC2_REGION --payload "{\"topic\": \"$IOT_TOPIC\", \"type\": \"status\", \"payload\": {\"message\": \"Extracting frames from video\", \"percentage\": 40}}" /dev/null
 
 		# Create the required folder structure and download video from S3
@@ -99,17 +119,47 @@ do
 
 		# Generating process item which will be put into DynamoDB in order to keep track of the process
 		DYNAMODB_PAYLOAD=$(mktemp --suffix "dynamodb.json")
-		echo "{\"Identifier\" : {\"S\": \"$FILE_IDENTIFIER\"}, \"Status\" : {\"S\": \"PROCESSING\"}, \"Topic\" : {\"S\": \"$IOT_TOPIC\"}, \"Parts\" : {\"M\":{" >> $DYNAMODB_PAYLOAD
 		LIST_OF_BATCHES=( $(find $IMAGE_PATH -maxdepth 1 -type f -name *.txt) )
-		for IDX in `seq 0 $((${#LIST_OF_BATCHES[@]}-1))`
-		do
-		    echo "\"${LIST_OF_BATCHES[$IDX]}\" : {\"S\": \"PENDING\"}" >> $DYNAMODB_PAYLOAD
-			if [[ "$IDX" -ne $((${#LIST_OF_BATCHES[@]}-1)) ]]
-			then
-		    	    echo "," >> $DYNAMODB_PAYLOAD
-			fi
-		done
-		echo '}}}' >> $DYNAMODB_PAYLOAD
+		if [[ $(parts_maps_size "${LIST_OF_BATCHES[@]}") -gt $PARTS_MAPS_MAX_BYTES ]] ; then
+		    # One item per part, spread over PART_SHARDS partition keys (the first 32 bits of the MD5 of the part)
+		    for IDX in `seq 0 25 $((${#LIST_OF_BATCHES[@]}-1))`
+		    do
+		        PARTS_PAYLOAD=$(mktemp --suffix "parts.json")
+		        SEPARATOR=''
+		        echo "{\"RVA_PROCESS_PARTS_TABLE\" : [" >> $PARTS_PAYLOAD
+		        for PART in "${LIST_OF_BATCHES[@]:$IDX:25}"
+		        do
+		            SHARD=$(( 0x$(echo -n "$PART" | md5sum | cut -c1-8) % $PART_SHARDS ))
+		            echo "$SEPARATOR{\"PutRequest\" : {\"Item\" : {\"Shard\" : {\"S\": \"$FILE_IDENTIFIER#$SHARD\"}, \"Key\" : {\"S\": \"$PART\"}, \"Identifier\" : {\"S\": \"$FILE_IDENTIFIER\"}, \"Status\" : {\"S\": \"PENDING\"}, \"PendingKey\" : {\"S\": \"$PART\"}}}}" >> $PARTS_PAYLOAD
+		            SEPARATOR=','
+		        done
+		        echo ']}' >> $PARTS_PAYLOAD
+
+		        # Retry the items left unprocessed
+		        UNPROCESSED=$(aws dynamodb batch-write-item --request-items file://$PARTS_PAYLOAD --query 'UnprocessedItems' --output json --region $EC2_REGION)
+		        while [[ -n "$UNPROCESSED" ]] && [[ "$UNPROCESSED" != "{}" ]]
+		        do
+		            sleep 1
+		            echo "$UNPROCESSED" > $PARTS_PAYLOAD
+		            UNPROCESSED=$(aws dynamodb batch-write-item --request-items file://$PARTS_PAYLOAD --query 'UnprocessedItems' --output json --region $EC2_REGION)
+		        done
+		        rm $PARTS_PAYLOAD
+		    done
+
+		    echo "{\"Identifier\" : {\"S\": \"$FILE_IDENTIFIER\"}, \"Status\" : {\"S\": \"PROCESSING\"}, \"Topic\" : {\"S\": \"$IOT_TOPIC\"}, \"Priority\" : {\"N\": \"$PRIORITY\"}, \"Weight\" : {\"N\": \"$WEIGHT\"}, \"PendingCount\" : {\"N\": \"${#LIST_OF_BATCHES[@]}\"}, \"ProcessingCount\" : {\"N\": \"0\"}, \"CompletedCount\" : {\"N\": \"0\"}, \"FailedCount\" : {\"N\": \"0\"}, \"PartsLayout\" : {\"S\": \"ITEMS\"}, \"PartCount\" : {\"N\": \"${#LIST_OF_BATCHES[@]}\"}, \"PartShards\" : {\"N\": \"$PART_SHARDS\"}}" >> $DYNAMODB_PAYLOAD
+		else
+		    # Part status counters, kept up to date with the Parts map so the orchestrator doesn't need to count it
+		    echo "{\"Identifier\" : {\"S\": \"$FILE_IDENTIFIER\"}, \"Status\" : {\"S\": \"PROCESSING\"}, \"Topic\" : {\"S\": \"$IOT_TOPIC\"}, \"Priority\" : {\"N\": \"$PRIORITY\"}, \"Weight\" : {\"N\": \"$WEIGHT\"}, \"PendingCount\" : {\"N\": \"${#LIST_OF_BATCHES[@]}\"}, \"ProcessingCount\" : {\"N\": \"0\"}, \"CompletedCount\" : {\"N\": \"0\"}, \"FailedCount\" : {\"N\": \"0\"}, \"LeaseExpires\" : {\"M\":{}}, \"Attempts\" : {\"M\":{}}, \"Parts\" : {\"M\":{" >> $DYNAMODB_PAYLOAD
+		    for IDX in `seq 0 $((${#LIST_OF_BATCHES[@]}-1))`
+		    do
+		        echo "\"${LIST_OF_BATCHES[$IDX]}\" : {\"S\": \"PENDING\"}" >> $DYNAMODB_PAYLOAD
+		        if [[ "$IDX" -ne $((${#LIST_OF_BATCHES[@]}-1)) ]]
+		        then
+		            echo "," >> $DYNAMODB_PAYLOAD
+		        fi
+		    done
+		    echo '}}}' >> $DYNAMODB_PAYLOAD
+		fi
 		aws dynamodb put-item --table-name RVA_PROCESS_TABLE --item file://$DYNAMODB_PAYLOAD --return-consumed-capacity TOTAL --region $EC2_REGION
 
 
@@ -7,7 +7,7 @@ import decimal
 from decimal import Decimal
 import logging
 import os
-from rekog_collection_controller import RekognitionCollectionController
+from rekog_collection_controller import RekognitionCollectionController, CollectionRegistry, DEFAULT_REGISTRY_TTL
 
 # Lambda Variables
 LOG_LEVEL = str(os.environ.get('LOG_LEVEL', 'INFO')).upper()
@@ -23,14 +23,27 @@ logger.debug('Loading function')
 
 # Constants
 RVA_COLLECTION_CONTROL = 'RVA_COLLECTION_CONTROL_TABLE'
+DISPATCH_MODE_S3 = 's3'         # one work file per chunk in S3, each starting a worker through its S3 event
+DISPATCH_MODE_DIRECT = 'direct' # the chunks are recorded in the processing item and sent to the workers
+S3_CHUNK_SIZE = 10
+MIN_CHUNK_SIZE = 5
+MAX_CHUNK_SIZE = 50
+DEFAULT_MAX_WORKERS = 10
 
 # Global Variables
+collection_registry = None # kept between the invocations of a warm container
+
+# Lambda Variables
+DISPATCH_MODE = os.getenv('dispatch_mode', DISPATCH_MODE_S3)
+SVBP_WORKER = os.getenv('svbp_worker')
+MAX_WORKERS = int(os.getenv('max_workers', DEFAULT_MAX_WORKERS))
+COLLECTION_REGISTRY_TTL = int(os.getenv('collection_registry_ttl', DEFAULT_REGISTRY_TTL))
 
 # Services
-rekognition = boto3.client('rekognition')
 s3 = boto3.resource('s3')
 dynamodb = boto3.resource('dynamodb', config=Config(max_pool_connections=30))
 dynamodb_table = dynamodb.Table('svbp_processing')
+lambda_client = boto3.client('lambda', region_name=os.environ['AWS_DEFAULT_REGION'])
 
 
 # Helper class to convert a DynamoDB item to JSON.
@@ -55,6 +68,18 @@ def create_dynamodb(eTag, bucket, objectKey):
         }
     )
 
+# ------- Create the DynamoDB item with all its chunks, pending ------- #
+def create_dynamodb_chunks(eTag, bucket, objectKey, chunks):
+    create_dynamodb = dynamodb_table.put_item(
+       Item={
+            'object_id': eTag,
+            's3_path': str(bucket+'/processing/'+eTag),
+            'object_key': str(objectKey),
+            'processingList': {key_name: 'pending' for key_name in chunks},
+            'chunks': chunks
+        }
+    )
+
 def update_dynamodb(eTag, key_name, keyId):
     update_dynamodb = dynamodb_table.update_item(
         Key = {'object_id': eTag},
@@ -69,9 +94,40 @@ def update_dynamodb(eTag, key_name, keyId):
     logger.debug(json.dumps(update_dynamodb, indent=4, cls=DecimalEncoder))
 
 
-# had to create this to be able to patch during unit testing
-def rekognition_list_collections():
-    return rekognition.list_collections()
+def chunk_size(collection_count):
+    '''
+    Returns the number of collections searched by each worker: enough for at most MAX_WORKERS
+    workers, within MIN_CHUNK_SIZE and MAX_CHUNK_SIZE.
+    '''
+    return min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, -(-collection_count // MAX_WORKERS)))
+
+
+def invoke_worker(processFile):
+    lambda_client.invoke(
+        FunctionName=SVBP_WORKER,
+        InvocationType='Event',
+        LogType='None',
+        Payload=json.dumps(processFile)
+    )
+
+
+def dispatch_direct(eTag, bucket, objectKey, collectionIds):
+    '''
+    Records every chunk of collections in the processing item with a single write, then sends each
+    chunk to a worker in its invocation payload.
+    '''
+    size = chunk_size(len(collectionIds))
+    collectionIds = [collectionIds[i:i+size] for i in range(0, len(collectionIds), size)]
+    key_names = ['key'+str(keyId)+'.json' for keyId in range(1, len(collectionIds)+1)]
+
+    create_dynamodb_chunks(eTag, bucket, objectKey, dict(zip(key_names, collectionIds)))
+
+    for key_name, collections in zip(key_names, collectionIds):
+        invoke_worker({'eTag': eTag, 'objectBucket': bucket, 'objectKey': objectKey, 'workKey': key_name, 'collections': collections})
+
+    logger.debug("{} chunks of {} collections sent to the workers".format(len(collectionIds), size))
+
+    return collectionIds
 
 
 # Allow mocking during For testing
@@ -79,6 +135,15 @@ def init_RekognitionCollectionController():
     return RekognitionCollectionController(RVA_COLLECTION_CONTROL, 'COLLECTIONS')
 
 
+def init_CollectionRegistry():
+    global collection_registry
+
+    if collection_registry is None:
+        collection_registry = CollectionRegistry(init_RekognitionCollectionController(), COLLECTION_REGISTRY_TTL)
+
+    return collection_registry
+
+
 def lambda_handler(event, context):
     logger.debug(event)
 
@@ -86,19 +151,19 @@ def lambda_handler(event, context):
     eTag = event['Records'][0]['s3']['object']['eTag']
     objectKey = event['Records'][0]['s3']['object']['key']
     bucket = event['Records'][0]['s3']['bucket']['name']
-    rcc = init_RekognitionCollectionController()
+    registry = init_CollectionRegistry()
+
+    # Get collectionIDs from the collection control record
+    collectionIds = registry.list_collections()
 
+    if DISPATCH_MODE == DISPATCH_MODE_DIRECT:
+        return dispatch_direct(eTag, bucket, objectKey, collectionIds)
 
     # Create the DynamoDB entry, so we can update it later
     create_dynamodb(eTag, bucket, objectKey)
 
     keyId = 0
-
-    # Get collectionIDs from Rekognition
-    collectionIds = rekognition_list_collections()
-    #collectionIds = collectionIds['CollectionIds']
-    collectionIds = rcc.list_collections()
-    collectionIds = [collectionIds[i:i+10] for i in range(0, len(collectionIds), 10)]
+    collectionIds = [collectionIds[i:i+S3_CHUNK_SIZE] for i in range(0, len(collectionIds), S3_CHUNK_SIZE)]
 
     # Create json with data to be processed by the workers
     processFile = {}
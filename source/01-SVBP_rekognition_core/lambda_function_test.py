@@ -3,6 +3,7 @@ import boto3
 import json
 import mock
 
+import lambda_function
 from lambda_function import lambda_handler
 from moto import mock_s3, mock_dynamodb2
 #from awscli.customizations.s3.subcommands import METADATA
@@ -12,12 +13,12 @@ class TestS3Actor(unittest.TestCase):
 
     @mock_s3
     @mock_dynamodb2
-    @mock.patch('lambda_function.rekognition_list_collections')
-    def test_lambda_handler(self, rlc):
+    @mock.patch('lambda_function.init_RekognitionCollectionController')
+    @mock.patch.object(lambda_function, 'collection_registry', None)
+    def test_lambda_handler(self, rcc):
         with open('rekognition_list_collections_response.json') as rekognition_file:
-            rlc.return_value = json.load(rekognition_file)
-            test_collection_ids = rlc.return_value
-            test_collection_ids = test_collection_ids['CollectionIds']
+            test_collection_ids = json.load(rekognition_file)['CollectionIds']
+            rcc.return_value.list_collections_version.return_value = (test_collection_ids, 1)
             test_collection_ids = [test_collection_ids[i:i + 10] for i in range(0, len(test_collection_ids), 10)]
 
         s3 = boto3.resource('s3', region_name='us-west-2')
@@ -38,3 +39,47 @@ class TestS3Actor(unittest.TestCase):
         
         # Verify lambda function returns the correct status
         assert lambda_handler(put_event,test_context) == test_collection_ids
+
+    @mock_dynamodb2
+    @mock.patch('lambda_function.init_RekognitionCollectionController')
+    @mock.patch('lambda_function.DISPATCH_MODE', 'direct')
+    @mock.patch('lambda_function.SVBP_WORKER', 'worker')
+    @mock.patch.object(lambda_function, 'lambda_client')
+    @mock.patch.object(lambda_function, 'collection_registry', None)
+    def test_lambda_handler_direct(self, lambda_client, rcc):
+        collection_ids = ['collection-' + str(i) for i in range(73)]
+        rcc.return_value.list_collections_version.return_value = (collection_ids, 1)
+        with open('event.json') as data_file:
+            put_event = json.load(data_file)
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(TableName='svbp_processing',
+                          KeySchema=[{'AttributeName': 'object_id', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'object_id', 'AttributeType': 'S'}],
+                          ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+        chunks = lambda_handler(put_event, '')
+
+        self.assertEqual(collection_ids, [collection for chunk in chunks for collection in chunk])
+        self.assertEqual([8] * 9 + [1], [len(chunk) for chunk in chunks])
+
+        eTag = put_event['Records'][0]['s3']['object']['eTag']
+        item = boto3.resource('dynamodb').Table('svbp_processing').get_item(Key={'object_id': eTag})['Item']
+        self.assertEqual(dict(('key' + str(i) + '.json', 'pending') for i in range(1, 11)), item['processingList'])
+        self.assertEqual(chunks[0], item['chunks']['key1.json'])
+
+        self.assertEqual(10, lambda_client.invoke.call_count)
+        payload = json.loads(lambda_client.invoke.call_args_list[9][1]['Payload'])
+        self.assertEqual('worker', lambda_client.invoke.call_args_list[9][1]['FunctionName'])
+        self.assertEqual({'eTag': eTag, 'objectBucket': 'deep-video-rekognition-photo', 'objectKey': put_event['Records'][0]['s3']['object']['key'],
+                          'workKey': 'key10.json', 'collections': ['collection-72']}, payload)
+
+    def test_chunk_size(self):
+        self.assertEqual(lambda_function.MIN_CHUNK_SIZE, lambda_function.chunk_size(12))
+        self.assertEqual(30, lambda_function.chunk_size(300))
+        self.assertEqual(lambda_function.MAX_CHUNK_SIZE, lambda_function.chunk_size(10000))
+
+    @mock.patch('lambda_function.init_RekognitionCollectionController')
+    @mock.patch.object(lambda_function, 'collection_registry', None)
+    def test_registry_kept_between_invocations(self, rcc):
+        self.assertIs(lambda_function.init_CollectionRegistry(), lambda_function.init_CollectionRegistry())
+        self.assertEqual(1, rcc.call_count)
@@ -0,0 +1,80 @@
+from __future__ import print_function
+
+import io
+import logging
+
+logger = logging.getLogger()
+
+# Pillow is not part of the python2.7 Lambda runtime, build-s3-dist.sh packages its wheel with the
+# function. When it is missing the faces are not cropped and the whole image is searched, which
+# only matches its largest face.
+try:
+    from PIL import Image
+    CROP_AVAILABLE = True
+except ImportError:
+    Image = None
+    CROP_AVAILABLE = False
+
+# CONSTANTS
+MAX_IMAGE_BYTES = 5 * 1024 * 1024 # Rekognition limit of the images sent as bytes
+FACE_MARGIN = 0.5                 # share of the face size kept around each crop, so the face is still detected
+JPEG_QUALITY = 90
+
+
+def crop_faces(image_bytes, bounding_boxes, margin=FACE_MARGIN):
+    '''
+    Returns the JPEG bytes of every face of the image, cut along its Rekognition bounding box (ratios
+    of the image size) widened by margin on each side.
+    '''
+    image = Image.open(io.BytesIO(image_bytes))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    width, height = image.size
+    crops = []
+
+    for box in bounding_boxes:
+        left = (box['Left'] - box['Width'] * margin) * width
+        top = (box['Top'] - box['Height'] * margin) * height
+        right = (box['Left'] + box['Width'] * (1 + margin)) * width
+        bottom = (box['Top'] + box['Height'] * (1 + margin)) * height
+
+        output = io.BytesIO()
+        image.crop((int(max(0, left)), int(max(0, top)), int(min(width, right)), int(min(height, bottom)))).save(output, format='JPEG', quality=JPEG_QUALITY)
+        crops.append(output.getvalue())
+
+    return crops
+
+
+def face_probes(image_bytes, bucket, key, detect_faces):
+    '''
+    Returns the Rekognition images to search the collections with: the bytes of each face of the
+    image, found with a single detect_faces(image) call. An image with no face has nothing to search,
+    one with a single face is searched as it is. An image too large to be sent as bytes is searched
+    from S3, as are all images when the detection fails.
+    '''
+    s3_image = {'S3Object': {'Bucket': bucket, 'Name': key}}
+
+    if image_bytes is None or len(image_bytes) > MAX_IMAGE_BYTES:
+        return [s3_image]
+
+    image = {'Bytes': image_bytes}
+
+    try:
+        bounding_boxes = [face['BoundingBox'] for face in detect_faces(image)['FaceDetails']]
+    except Exception as e:
+        logger.error("face_probes - error detecting the faces of '{}'. Searching the image from S3.".format(key))
+        logger.error(e)
+        return [s3_image]
+
+    logger.debug("face_probes - '{}' faces found in '{}'".format(len(bounding_boxes), key))
+
+    if len(bounding_boxes) <= 1 or not CROP_AVAILABLE:
+        return [image] if bounding_boxes else []
+
+    try:
+        return [{'Bytes': crop} for crop in crop_faces(image_bytes, bounding_boxes)]
+    except Exception as e:
+        logger.error("face_probes - error cropping the faces of '{}'. Searching the whole image.".format(key))
+        logger.error(e)
+        return [image]
@@ -0,0 +1,62 @@
+import unittest
+import io
+import logging
+
+from face_search import face_probes, crop_faces, CROP_AVAILABLE, MAX_IMAGE_BYTES
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+BUCKET = 'deep14-video-rekognition-photo'
+KEY = 'upload/siberian-people-holiday-fair-698849289.mp4-8.jpg'
+FACE_1 = {'Width': 0.1, 'Top': 0.2, 'Left': 0.1, 'Height': 0.2}
+FACE_2 = {'Width': 0.2, 'Top': 0.5, 'Left': 0.75, 'Height': 0.4}
+
+
+def jpeg(width=200, height=100):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (128, 64, 32)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def detect(*boxes):
+    return lambda image: {'FaceDetails': [{'BoundingBox': box} for box in boxes]}
+
+
+class TestFaceSearch(unittest.TestCase):
+
+    def test_no_face(self):
+        self.assertEqual([], face_probes('image', BUCKET, KEY, detect()))
+
+    def test_single_face(self):
+        self.assertEqual([{'Bytes': 'image'}], face_probes('image', BUCKET, KEY, detect(FACE_1)))
+
+    def test_s3_fallback(self):
+        s3_image = [{'S3Object': {'Bucket': BUCKET, 'Name': KEY}}]
+
+        def detect_error(image):
+            raise Exception('Throttled')
+
+        self.assertEqual(s3_image, face_probes(None, BUCKET, KEY, detect(FACE_1)))
+        self.assertEqual(s3_image, face_probes('x' * (MAX_IMAGE_BYTES + 1), BUCKET, KEY, detect(FACE_1)))
+        self.assertEqual(s3_image, face_probes('image', BUCKET, KEY, detect_error))
+
+    @unittest.skipUnless(CROP_AVAILABLE, 'Pillow not installed')
+    def test_crop_faces(self):
+        from PIL import Image
+
+        probes = face_probes(jpeg(), BUCKET, KEY, detect(FACE_1, FACE_2))
+        sizes = [Image.open(io.BytesIO(probe['Bytes'])).size for probe in probes]
+
+        # Each face with half its size around it, clipped to the image
+        self.assertEqual([(40, 40), (70, 70)], sizes)
+
+    @unittest.skipUnless(CROP_AVAILABLE, 'Pillow not installed')
+    def test_crop_error_searches_image(self):
+        self.assertEqual([{'Bytes': 'image'}], face_probes('image', BUCKET, KEY, detect(FACE_1, FACE_2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
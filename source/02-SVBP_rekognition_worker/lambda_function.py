@@ -4,11 +4,16 @@ import json
 import urllib
 import boto3
 from botocore.client import Config
-import threading
+from botocore.exceptions import ClientError
+from multiprocessing.dummy import Pool
 import sys, traceback
 import logging
 import os
-import re
+from rekognition_rate_limiter import rate_limited, API_SEARCH_FACES_BY_IMAGE, API_DETECT_FACES
+from face_search import face_probes, MAX_IMAGE_BYTES
+from match_aggregator import MatchAggregator, DEFAULT_TOP_K
+from iot_publisher import IotPublisher, PUBLISH_MODE_DIRECT
+from progress_publisher import ProgressPublisher, DEFAULT_PROGRESS_TABLE, DEFAULT_MIN_CHANGE, DEFAULT_MIN_INTERVAL
 
 # Lambda Variables
 LOG_LEVEL = str(os.environ.get('LOG_LEVEL', 'INFO')).upper()
@@ -23,12 +28,22 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 logger.debug('Loading function')
 
 # Constants
+DEFAULT_SEARCH_POOL_SIZE = 10
+DEFAULT_MAX_INLINE_MATCHES = 100 # matches kept in the results item of a photo, the others go to S3
 
 # Global Variables
+search_pool = None # kept between the invocations of a warm container
 
 # Lambda Variables
 SVBP_REKOGNITION_IOT = os.environ['SVBP_rekognition_iot']
 METRICS_FUNCTION = os.environ['metrics_function']
+PROGRESS_TABLE = os.getenv('progress_table', DEFAULT_PROGRESS_TABLE)
+PROGRESS_MIN_CHANGE = int(os.getenv('progress_min_change', DEFAULT_MIN_CHANGE))
+PROGRESS_MIN_INTERVAL = int(os.getenv('progress_min_interval', DEFAULT_MIN_INTERVAL))
+IOT_PUBLISH_MODE = os.getenv('iot_publish_mode', PUBLISH_MODE_DIRECT)
+SEARCH_POOL_SIZE = int(os.getenv('search_pool_size', DEFAULT_SEARCH_POOL_SIZE))
+SEARCH_TOP_K = int(os.getenv('search_top_k', DEFAULT_TOP_K))
+MAX_INLINE_MATCHES = int(os.getenv('max_inline_matches', DEFAULT_MAX_INLINE_MATCHES))
 
 # Services
 s3 = boto3.client('s3')
@@ -41,22 +56,10 @@ lambda_client = boto3.client('lambda', region_name=os.environ['AWS_DEFAULT_REGIO
 
 # ------- Publish message to IoT ------- #
 def publish_message(payload):
-    lambda_client.invoke(
-        FunctionName=SVBP_REKOGNITION_IOT,
-        InvocationType='Event',
-        LogType='None',
-        Payload=payload
-    )
+    iot_publisher.publish(payload)
 
-# ------- Create DynamoDB item ------- #
-def create_dynamodb(eTag, IotTopic):
-    create_dynamodb = dynamodb_results.put_item(
-       Item={
-            'object_id': eTag,
-            'iot_topic': IotTopic,
-            'results': []
-        }
-    )
+iot_publisher = IotPublisher(SVBP_REKOGNITION_IOT, IOT_PUBLISH_MODE, lambda_client=lambda_client)
+progress_publisher = ProgressPublisher(publish_message, PROGRESS_TABLE, PROGRESS_MIN_CHANGE, PROGRESS_MIN_INTERVAL)
 
 # ------- Update DynamoDB processing table ------- #
 def update_dynamodb_processing(eTag, objectKey, imageKey):
@@ -73,98 +76,209 @@ def update_dynamodb_processing(eTag, objectKey, imageKey):
     )
 
 
+# ------- Save the results of a work file in S3 ------- #
+def save_results_object(bucket, eTag, objectKey, matches):
+    resultsKey = 'results/'+eTag+'/'+objectKey
+    s3.put_object(Bucket=bucket, Key=resultsKey, Body=json.dumps(matches), ServerSideEncryption='AES256')
+    return {'Bucket': bucket, 'Key': resultsKey, 'Matches': len(matches)}
+
 # ------- Update DynamoDB results table ------- #
-def update_dynamodb_results(eTag, faceId, imageId, similarity, collection, videoId):
+def update_dynamodb_results(eTag, IotTopic, matches, failures, resultsObject=None, maxMatches=None):
+    '''
+    Appends the matches and the failed collections of a work file to the results item of the photo,
+    creating it if needed, in a single write. With maxMatches, the write fails with a
+    ConditionalCheckFailedException when the item would hold more matches.
+    '''
+    updateExpression = "SET iot_topic = :iotTopic, results = list_append(if_not_exists(results, :empty), :faceData)"
+    expressionAttributeValues = {
+        ":iotTopic": IotTopic,
+        ":faceData": matches,
+        ":empty": []
+    }
+
+    if failures:
+        updateExpression += ", failures = list_append(if_not_exists(failures, :empty), :failures)"
+        expressionAttributeValues[":failures"] = failures
+
+    if resultsObject:
+        updateExpression += ", results_objects = list_append(if_not_exists(results_objects, :empty), :resultsObject)"
+        expressionAttributeValues[":resultsObject"] = [resultsObject]
+
+    updateArgs = {}
+
+    if maxMatches is not None:
+        updateArgs['ConditionExpression'] = "attribute_not_exists(results) OR size(results) <= :room"
+        expressionAttributeValues[":room"] = maxMatches - len(matches)
+
     update_dynamodb = dynamodb_results.update_item(
         Key = {'object_id': eTag},
-        UpdateExpression = "SET results = list_append(results, :faceData)",
-        ExpressionAttributeValues = {
-            ":faceData": [{"FaceId": faceId,"VideoId": videoId, "ImageId": imageId, "Similarity": similarity, "Collection": collection}]
-        }
+        UpdateExpression = updateExpression,
+        ExpressionAttributeValues = expressionAttributeValues,
+        **updateArgs
     )
 
+def results_count(eTag):
+    '''
+    Returns the number of matches in the results item of the photo.
+    '''
+    item = dynamodb_results.get_item(
+        Key={'object_id': eTag},
+        ProjectionExpression='results',
+        ConsistentRead=True
+    ).get('Item', {})
+
+    return len(item.get('results', []))
+
+def save_results(eTag, IotTopic, bucket, objectKey, aggregator):
+    '''
+    Writes the results of a work file once. The results item of the photo holds at most
+    MAX_INLINE_MATCHES matches, from all its work files: the best matches of the work file fill the
+    room left in the item and the others, among the top matches kept by the aggregator, are saved in
+    an S3 object the item references in results_objects.
+    '''
+    matches = [{"FaceId": match['FaceId'], "VideoId": match['VideoId'], "ImageId": match['ImageId'],
+                "Similarity": str(match['Similarity']), "Collection": match['Collection']} for match in aggregator.top()]
+    failures = [{"Collection": collection, "Error": error} for collection, error in sorted(aggregator.failures.items())]
+
+    # The room left is only read when the item turns out to be fuller than the work file needs
+    room = MAX_INLINE_MATCHES
+
+    while True:
+        resultsObject = None
+
+        if len(matches) > room:
+            logger.debug("{} matches of '{}' saved in S3".format(len(matches) - room, objectKey))
+            resultsObject = save_results_object(bucket, eTag, objectKey, matches[room:])
+
+        try:
+            update_dynamodb_results(eTag, IotTopic, matches[:room], failures, resultsObject, maxMatches=MAX_INLINE_MATCHES)
+            return
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise err
+
+        room = max(0, MAX_INLINE_MATCHES - results_count(eTag))
+
 # ------- Obtain DynamoDB item from any table ------- #
 def get_item_from_ddb(ddb_object, hashkey, value):
     return ddb_object.get_item(Key={hashkey: value})['Item']
 
 
-def rekognition_search_faces_by_image(collection, imageBucket, imageKey):
+@rate_limited(API_SEARCH_FACES_BY_IMAGE)
+def rekognition_search_faces_by_image(collection, image):
     return rekognition.search_faces_by_image(
-        Image={"S3Object": {"Bucket": imageBucket, "Name": imageKey}},
+        Image=image,
         CollectionId=collection,
         FaceMatchThreshold=85
     )
 
 
-def search_faces(eTag, imageBucket, imageKey, collection):
-    try:
-        response = rekognition_search_faces_by_image(collection, imageBucket, imageKey)
-        logger.debug("Searching face in collection "+collection)
-        faceMatches = response['FaceMatches']
+@rate_limited(API_DETECT_FACES)
+def rekognition_detect_faces(image):
+    return rekognition.detect_faces(Image=image)
+
+
+def search_probes(collection, probes):
+    '''
+    Searches the collection with every face probe and returns the face matches of all of them.
+    '''
+    faceMatches = []
+
+    for probe in probes:
+        try:
+            faceMatches.extend(rekognition_search_faces_by_image(collection, probe)['FaceMatches'])
+        except ClientError as err:
+            # A crop where Rekognition finds no face anymore
+            if err.response['Error']['Code'] != 'InvalidParameterException':
+                raise err
+            logger.debug("No face found in a probe of collection " + collection)
 
-        if faceMatches:
-            for face in faceMatches:
-                faceId = face['Face']['FaceId']
-                imageId = face['Face']['ExternalImageId']
-                similarity = str(face['Similarity'])
-                videoId = re.match('(.*)-\d{5}.jpg', imageId).group(1)
+    return faceMatches
 
-                logger.debug("VideoId is: "+videoId)
-                logger.debug("Similarity is: "+similarity)
-                logger.debug("eTag is: "+eTag)
 
-                update_dynamodb_results(eTag, faceId, imageId, similarity, collection, videoId)
+def search_faces(probes, collection):
+    '''
+    Returns the collection with its face matches and the error of its search, if any.
+    '''
+    logger.debug("Searching face in collection "+collection)
 
+    try:
+        return collection, search_probes(collection, probes), None
     except Exception as e:
         logger.error(e)
         logger.error('-' * 60)
         traceback.print_exc(file=sys.stdout)
         logger.error('-' * 60)
+        return collection, [], e
+
+
+def get_search_pool():
+    global search_pool
+
+    if search_pool is None:
+        search_pool = Pool(SEARCH_POOL_SIZE)
+
+    return search_pool
+
+
+def search_collections(probes, collections):
+    '''
+    Searches the collections on the search pool, at most SEARCH_POOL_SIZE at a time, and aggregates
+    their matches as each search completes.
+    '''
+    aggregator = MatchAggregator(SEARCH_TOP_K)
+
+    for collection, faceMatches, error in get_search_pool().imap_unordered(lambda collection: search_faces(probes, collection), collections):
+        if error is None:
+            aggregator.add(collection, faceMatches)
+        else:
+            aggregator.fail(collection, error)
+
+    return aggregator
 
 def lambda_handler(event, context):
     initial_percentage = 20.0
     final_percentage = 95.0
 
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    objectKey = event['Records'][0]['s3']['object']['key'].split('/')[2]
-    key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
+    if 'Records' in event:
+        # Work file written by the core function in S3
+        bucket = event['Records'][0]['s3']['bucket']['name']
+        objectKey = event['Records'][0]['s3']['object']['key'].split('/')[2]
+        key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
 
-    s3Object = s3.get_object(Bucket=bucket, Key=key)
-    objectContent = s3Object['Body'].read().decode('utf-8')
-    objectContent = json.loads(objectContent)
+        s3Object = s3.get_object(Bucket=bucket, Key=key)
+        objectContent = s3Object['Body'].read().decode('utf-8')
+        objectContent = json.loads(objectContent)
+    else:
+        # Chunk sent by the core function in direct dispatch mode
+        bucket = event['objectBucket']
+        objectKey = event['workKey']
+        objectContent = event
 
     imageBucket = objectContent['objectBucket']
     imageKey = objectContent['objectKey']
 
     eTag = objectContent['eTag']
 
-    get_iot_topic = s3.head_object(
+    # The image is read once, its faces are detected once and searched in every collection from memory
+    imageObject = s3.get_object(
         Bucket=imageBucket,
         Key=imageKey,
     )
+    imageBytes = imageObject['Body'].read() if imageObject['ContentLength'] <= MAX_IMAGE_BYTES else None
 
-    if 'topic' in get_iot_topic['Metadata']:
-        IotTopic = get_iot_topic['Metadata']['topic']
+    if 'topic' in imageObject['Metadata']:
+        IotTopic = imageObject['Metadata']['topic']
     else:
         IotTopic = "none"
 
-    create_dynamodb(eTag, IotTopic)
-
     collections = objectContent['collections']
+    probes = face_probes(imageBytes, imageBucket, imageKey, rekognition_detect_faces)
 
-    thread_list = []
-    for collection in collections:
-        logger.debug('Searching collection: ' + collection)
-        t1 = threading.Thread(name='search_faces' + collection, target=search_faces, args=(eTag, imageBucket, imageKey, collection))
-        thread_list.append(t1)
-
-    for x in thread_list:
-        x.start()
+    aggregator = search_collections(probes, collections)
+    logger.debug("{} matches in {} collections".format(len(aggregator.matches), aggregator.collections_searched))
 
-    for x in thread_list:
-        x.join()
-
-    logger.debug(thread_list)
+    save_results(eTag, IotTopic, bucket, objectKey, aggregator)
 
     update_dynamodb_processing(eTag, objectKey, imageKey)
 
@@ -184,13 +298,15 @@ def lambda_handler(event, context):
 
     # publish message to IoT
     if IotTopic != "none":
-        payload = json.dumps({
+        payload = {
             'topic': IotTopic,
             'type': 'status',
             'payload': {'message': 'Searching image against database', 'percentage': calculated_value}
-        })
+        }
+
+        progress_publisher.publish(payload)
 
-        publish_message(payload)
+    iot_publisher.close()
 
     # send anonymous metrics
     metrics_payload = json.dumps({"Data": {"PhotosProcessed": 1}})
@@ -3,9 +3,10 @@ import boto3
 import json
 import urllib
 import mock
-import threading
 
 import lambda_function
+from iot_publisher import IotPublisher, PUBLISH_MODE_RELAY
+from match_aggregator import MatchAggregator
 from moto import mock_s3, mock_dynamodb2
 #from awscli.customizations.s3.subcommands import METADATA
 
@@ -17,33 +18,71 @@ class MockLambdaClient(object):
         print(Payload)
         return Payload
 
-class MockThreading(object):
-    def __init__(self):
-        pass
+class TestS3Actor(unittest.TestCase):
 
-    def Thread(self,name, target, args):
-        lambda_function.search_faces(args[0],args[1], args[2], args[3])
-        print(args)
-        return threading.Thread()
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch.object(lambda_function,'MAX_INLINE_MATCHES',2)
+    def test_save_results(self):
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='photos')
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(TableName='svbp_results',
+                          KeySchema=[{'AttributeName': 'object_id', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'object_id', 'AttributeType': 'S'}],
+                          ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+        face_matches = [{'Similarity': 90.0 + i, 'Face': {'FaceId': 'face-' + str(i), 'ExternalImageId': 'video.mp4-0000' + str(i) + '.jpg'}} for i in range(3)]
 
-class MockThreadList(object):
-    def __init__(self):
-        pass
+        aggregator = MatchAggregator()
+        aggregator.add('collection-1', face_matches[:1])
+        aggregator.fail('collection-2', 'Throttled')
+        lambda_function.save_results('etag', 'iot_topic', 'photos', 'key1.json', MatchAggregator())
+        lambda_function.save_results('etag', 'iot_topic', 'photos', 'key2.json', aggregator)
 
-    def append(self,thread):
-        return []
+        item = boto3.resource('dynamodb').Table('svbp_results').get_item(Key={'object_id': 'etag'})['Item']
+        self.assertEqual('iot_topic', item['iot_topic'])
+        self.assertEqual(['face-0'], [match['FaceId'] for match in item['results']])
+        self.assertEqual([{'Collection': 'collection-2', 'Error': 'Throttled'}], item['failures'])
+        self.assertNotIn('results_objects', item)
 
-class TestS3Actor(unittest.TestCase):
+        # The item holds 2 matches at most, from all the work files, the best ones fill its room
+        aggregator = MatchAggregator()
+        aggregator.add('collection-3', face_matches[1:])
+        lambda_function.save_results('etag', 'iot_topic', 'photos', 'key3.json', aggregator)
+
+        item = boto3.resource('dynamodb').Table('svbp_results').get_item(Key={'object_id': 'etag'})['Item']
+        self.assertEqual(['face-0', 'face-2'], [match['FaceId'] for match in item['results']])
+
+        results_object = item['results_objects'][0]
+        self.assertEqual('results/etag/key3.json', results_object['Key'])
+        saved = json.loads(s3.get_object(Bucket='photos', Key=results_object['Key'])['Body'].read())
+        self.assertEqual(['face-1'], [match['FaceId'] for match in saved])
+        self.assertEqual(1, results_object['Matches'])
+
+        # The item full, every match goes to S3
+        lambda_function.save_results('etag', 'iot_topic', 'photos', 'key4.json', aggregator)
+
+        item = boto3.resource('dynamodb').Table('svbp_results').get_item(Key={'object_id': 'etag'})['Item']
+        self.assertEqual(['face-0', 'face-2'], [match['FaceId'] for match in item['results']])
+        self.assertEqual(2, item['results_objects'][1]['Matches'])
+
+        # A work file with more matches than the item holds keeps its best ones inline
+        aggregator = MatchAggregator()
+        aggregator.add('collection-4', face_matches)
+        lambda_function.save_results('etag2', 'iot_topic', 'photos', 'key1.json', aggregator)
+
+        item = boto3.resource('dynamodb').Table('svbp_results').get_item(Key={'object_id': 'etag2'})['Item']
+        self.assertEqual(['face-2', 'face-1'], [match['FaceId'] for match in item['results']])
+        self.assertEqual(1, item['results_objects'][0]['Matches'])
 
     mock_iot_lambda = MockLambdaClient()
-    mock_thread = MockThreading()
-    mock_thread_list = MockThreadList()
     @mock_s3
     @mock_dynamodb2
+    @mock.patch('lambda_function.rekognition_detect_faces', return_value={'FaceDetails': [{'BoundingBox': {'Width': 0.067, 'Top': 0.162, 'Left': 0.105, 'Height': 0.120}}]})
     @mock.patch('lambda_function.rekognition_search_faces_by_image')
     @mock.patch.object(lambda_function,'lambda_client',mock_iot_lambda)
-    @mock.patch.object(lambda_function,'threading',mock_thread)
-    def test_lambda_handler(self, rsfbi):
+    @mock.patch.object(lambda_function,'iot_publisher',IotPublisher('iot', PUBLISH_MODE_RELAY, lambda_client=mock_iot_lambda))
+    def test_lambda_handler(self, rsfbi, rdf):
         with open('search_faces_by_image_response.json') as rekognition_file:
             rsfbi.return_value = json.load(rekognition_file)
         s3 = boto3.resource('s3', region_name='us-west-2')
@@ -76,6 +115,10 @@ class TestS3Actor(unittest.TestCase):
                           AttributeDefinitions=[{'AttributeName': 'object_id', 'AttributeType': 'S'}],
                           ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
                           StreamSpecification={'StreamEnabled': True,'StreamViewType': 'NEW_AND_OLD_IMAGES'})
+        dynamodb.create_table(TableName='RVA_PROGRESS_TABLE',
+                          KeySchema=[{'AttributeName': 'Topic', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'Topic', 'AttributeType': 'S'}],
+                          ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
         process_table = dynamodb_resource_client.Table(process_table_name)
 
         create_dynamodb = process_table.put_item(
@@ -0,0 +1,57 @@
+from __future__ import print_function
+
+import logging
+import re
+
+logger = logging.getLogger()
+
+# CONSTANTS
+DEFAULT_TOP_K = 100
+VIDEO_IMAGE_PATTERN = '(.*)-\d{5}.jpg' # ExternalImageId of the frames indexed: <video>-<frame>.jpg
+
+
+class MatchAggregator:
+    '''
+    Collects the face matches of every collection searched for a photo.
+
+    A face matched more than once, e.g. by two faces of the photo, is kept with its best similarity
+    and only the top_k matches by similarity are returned. The collections whose search failed are
+    kept with their error, so a failure is never mistaken for a search without matches.
+    '''
+
+    def __init__(self, top_k=DEFAULT_TOP_K):
+        self.top_k = top_k
+        self.matches = {}
+        self.failures = {}
+        self.collections_searched = 0
+
+    def add(self, collection, face_matches):
+        self.collections_searched += 1
+
+        for face in face_matches:
+            image_id = face['Face']['ExternalImageId']
+            video = re.match(VIDEO_IMAGE_PATTERN, image_id)
+
+            match = {
+                'FaceId': face['Face']['FaceId'],
+                'VideoId': video.group(1) if video else image_id,
+                'ImageId': image_id,
+                'Similarity': float(face['Similarity']),
+                'Collection': collection
+            }
+
+            kept = self.matches.get(match['FaceId'])
+            if kept is None or kept['Similarity'] < match['Similarity']:
+                self.matches[match['FaceId']] = match
+
+    def fail(self, collection, error):
+        logger.error("MatchAggregator - search of collection '{}' failed: {}".format(collection, error))
+        self.failures[collection] = str(error)
+
+    def top(self):
+        '''
+        Returns the best top_k matches, by decreasing similarity.
+        '''
+        matches = sorted(self.matches.values(), key=lambda match: (-match['Similarity'], match['FaceId']))
+
+        return matches[:self.top_k] if self.top_k > 0 else matches
@@ -0,0 +1,46 @@
+import unittest
+import logging
+
+from match_aggregator import MatchAggregator
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def face_match(face_id, similarity, image_id='video.mp4-00001.jpg'):
+    return {'Similarity': similarity, 'Face': {'FaceId': face_id, 'ExternalImageId': image_id}}
+
+
+class TestMatchAggregator(unittest.TestCase):
+
+    def test_top(self):
+        aggregator = MatchAggregator(top_k=2)
+
+        aggregator.add('collection-1', [face_match('a', 90.0), face_match('b', 99.5, 'other.mp4-00042.jpg')])
+        aggregator.add('collection-2', [face_match('c', 95.0)])
+
+        matches = aggregator.top()
+        self.assertEqual(['b', 'c'], [match['FaceId'] for match in matches])
+        self.assertEqual({'FaceId': 'b', 'VideoId': 'other.mp4', 'ImageId': 'other.mp4-00042.jpg', 'Similarity': 99.5, 'Collection': 'collection-1'}, matches[0])
+        self.assertEqual(2, aggregator.collections_searched)
+
+    def test_duplicates_keep_best_similarity(self):
+        aggregator = MatchAggregator()
+
+        aggregator.add('collection-1', [face_match('a', 88.0), face_match('a', 97.0), face_match('a', 90.0)])
+
+        self.assertEqual([97.0], [match['Similarity'] for match in aggregator.top()])
+
+    def test_failures(self):
+        aggregator = MatchAggregator()
+
+        aggregator.add('collection-1', [])
+        aggregator.fail('collection-2', Exception('ProvisionedThroughputExceededException'))
+
+        self.assertEqual([], aggregator.top())
+        self.assertEqual({'collection-2': 'ProvisionedThroughputExceededException'}, aggregator.failures)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,14 +25,18 @@ iot_data = boto3.client('iot-data', region_name=os.environ['AWS_DEFAULT_REGION']
 
 
 def lambda_handler(event, context):
-    topic = event["topic"]
-    payload = {"type": event['type'], 'payload': event['payload']}
-    response = iot_data.publish(
-        topic=topic,
-        qos=1,
-        payload=json.dumps(payload)
-    )
-    
-    logger.debug(response)
-    
+    # A single message, or every message of a caller's flush in relay mode
+    messages = event.get('messages', [event])
+
+    for message in messages:
+        topic = message["topic"]
+        payload = {"type": message['type'], 'payload': message['payload']}
+        response = iot_data.publish(
+            topic=topic,
+            qos=1,
+            payload=json.dumps(payload)
+        )
+
+        logger.debug(response)
+
     return 'OK'
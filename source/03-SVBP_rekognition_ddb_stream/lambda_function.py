@@ -5,6 +5,7 @@ import boto3
 import decimal
 import os
 import logging
+from iot_publisher import IotPublisher, PUBLISH_MODE_DIRECT
 
 # Lambda Variables
 LOG_LEVEL = str(os.environ.get('LOG_LEVEL', 'INFO')).upper()
@@ -22,22 +23,19 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 
 # Lambda Variables
 SVBP_rekognition_iot =  os.getenv('SVBP_rekognition_iot')
+iot_publish_mode = os.getenv('iot_publish_mode', PUBLISH_MODE_DIRECT)
 
 # Services
 dynamodb = boto3.resource('dynamodb')
 dynamodb_processing = dynamodb.Table('svbp_processing')
 dynamodb_results = dynamodb.Table('svbp_results')
 lambda_client = boto3.client('lambda', region_name=os.environ['AWS_DEFAULT_REGION'])
+iot_publisher = IotPublisher(SVBP_rekognition_iot, iot_publish_mode, lambda_client=lambda_client)
 
 
 # Helper section
 def publish_message(payload):
-    lambda_client.invoke(
-        FunctionName=SVBP_rekognition_iot,
-        InvocationType='Event',
-        LogType='None',
-        Payload=payload
-    )
+    iot_publisher.publish(payload)
 
 def get_item_from_ddb(ddb_object, hashkey, value):
     item = ddb_object.get_item(Key={hashkey: value})['Item']
@@ -70,4 +68,6 @@ def lambda_handler(event, context):
         })
         publish_message(payload)
 
+    iot_publisher.close()
+
     return 'Successfully processed {} records.'.format(len(event['Records']))
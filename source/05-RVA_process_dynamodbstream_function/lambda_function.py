@@ -7,11 +7,17 @@ import json
 import boto3
 import sys, traceback, os
 import logging
+import math
 import time
 import string
 import random
 from rekog_collection_controller import RekognitionCollectionController
+from part_tracking import PartTracker, parts_layout, PARTS_LAYOUT_ITEMS, STATUS_PENDING, STATUS_PROCESSING, STATUS_COMPLETED, STATUS_FAILED, STATUS_COUNTERS
+from fleet_scheduler import FleetScheduler, DEFAULT_WEIGHT, DEFAULT_TIER
+from iot_publisher import IotPublisher, PUBLISH_MODE_DIRECT
+from progress_publisher import ProgressPublisher, DEFAULT_PROGRESS_TABLE, DEFAULT_MIN_CHANGE, DEFAULT_MIN_INTERVAL
 from functools import wraps
+from collections import OrderedDict
 
 # Lambda Variables
 LOG_LEVEL = str(os.environ.get('LOG_LEVEL', 'INFO')).upper()
@@ -30,6 +36,10 @@ RVA_COLLECTION_CONTROL = 'RVA_COLLECTION_CONTROL_TABLE'
 MAX_DYNAMODB_TPS_ALLOWED=40
 MAX_BACKOFF = 15 # seconds
 MAX_RETRIES = 5
+BATCH_GET_MAX_KEYS = 100 # BatchGetItem limit
+PART_COUNTERS = ('PendingCount', 'ProcessingCount', 'CompletedCount', 'FailedCount')
+DISPATCH_MODE_STREAM = 'stream' # one photos function per part, started here
+DISPATCH_MODE_WORKER = 'worker' # MAX_TPS photos functions claiming the parts themselves
 RETRY_EXCEPTIONS = ('ProvisionedThroughputExceededException',
                     'ThrottlingException')
 
@@ -48,6 +58,24 @@ RVA_process_photos_function = os.environ['RVA_process_photos_function']
 MAX_TPS = os.environ['MAX_TPS']
 RVA_SNS_MILESTONES_TOPIC_ARN = os.environ['RVA_SNS_MILESTONES_TOPIC_ARN']
 RVA_COLLECTION_MAX_SIZE = int(os.getenv('RVA_COLLECTION_MAX_SIZE'), 10)
+RVA_PROCESS_PARTS_TABLE = os.getenv('RVA_PROCESS_PARTS_TABLE', 'RVA_PROCESS_PARTS_TABLE')
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', DISPATCH_MODE_STREAM)
+FLEET_MAX_TPS = int(os.getenv('FLEET_MAX_TPS', 0)) # shared by every video, 0 keeps the MAX_TPS limit of each video
+FLEET_DISPATCH_SHARDS = int(os.getenv('FLEET_DISPATCH_SHARDS', 1)) # control records sharing FLEET_MAX_TPS, more shards conflict less
+PART_MAX_ATTEMPTS = int(os.getenv('PART_MAX_ATTEMPTS', 3)) # a part whose lease expired this many times is failed
+PHOTOS_FUNCTION_TIMEOUT = int(os.getenv('PHOTOS_FUNCTION_TIMEOUT', 300)) # seconds
+PART_PROCESSING_SECONDS = int(os.getenv('PART_PROCESSING_SECONDS', 60)) # expected time to analyze one part
+RVA_PROGRESS_TABLE = os.getenv('RVA_PROGRESS_TABLE', DEFAULT_PROGRESS_TABLE)
+PROGRESS_MIN_CHANGE = int(os.getenv('PROGRESS_MIN_CHANGE', DEFAULT_MIN_CHANGE)) # percentage points between two status messages
+PROGRESS_MIN_INTERVAL = int(os.getenv('PROGRESS_MIN_INTERVAL', DEFAULT_MIN_INTERVAL)) # seconds after which any progress is published
+IOT_PUBLISH_MODE = os.getenv('IOT_PUBLISH_MODE', PUBLISH_MODE_DIRECT) # relay: through RVA_IoT_publish_message_function
+IOT_FLUSH_INTERVAL = float(os.getenv('IOT_FLUSH_INTERVAL', 0)) # seconds, 0 only flushes when the handler returns
+
+# Parts of the videos using the PARTS_LAYOUT_ITEMS layout
+part_tracker = PartTracker(dynamodb_client, process_table.table_name, RVA_PROCESS_PARTS_TABLE)
+
+# IoT messages of the handler, published in-process
+iot_publisher = IotPublisher(RVA_IoT_publish_message_function, IOT_PUBLISH_MODE, IOT_FLUSH_INTERVAL, lambda_client=lambda_client)
 
 # --------------- Retry decorator
 def retry(ExceptionToCheck=RETRY_EXCEPTIONS, tries=5, max_backoff=MAX_BACKOFF, logger=None):
@@ -103,13 +131,16 @@ def init_RekognitionCollectionController():
     return rcc
 
 
+def init_FleetScheduler():
+    return FleetScheduler(RVA_COLLECTION_CONTROL, 'DISPATCH', FLEET_MAX_TPS, dynamodb_client, FLEET_DISPATCH_SHARDS)
+
+
+def init_ProgressPublisher():
+    return ProgressPublisher(publish_message, RVA_PROGRESS_TABLE, PROGRESS_MIN_CHANGE, PROGRESS_MIN_INTERVAL, dynamodb_client=dynamodb_client)
+
+
 def publish_message(payload):
-    lambda_client.invoke(
-        FunctionName=RVA_IoT_publish_message_function,
-        InvocationType='Event',
-        LogType='None',
-        Payload=payload
-    )
+    iot_publisher.publish(payload)
 
 
 def dynamodb_get_item_from_identifier(video_identifier):
@@ -125,6 +156,56 @@ def dynamodb_get_item_from_identifier(video_identifier):
     return response
 
 
+@retry(RETRY_EXCEPTIONS, MAX_RETRIES, MAX_BACKOFF, logger)
+def dynamodb_batch_get_item(request_items):
+    return dynamodb_client.batch_get_item(RequestItems=request_items)
+
+
+def dynamodb_get_items_from_identifiers(video_identifiers):
+    '''
+    Reads the items of several videos, with one GetItem for a single video and BatchGetItem otherwise.
+    Returns a dict of items by identifier, videos without an item are left out.
+    '''
+    video_identifiers = list(video_identifiers)
+    items = {}
+
+    if len(video_identifiers) == 1:
+        response = dynamodb_get_item_from_identifier(video_identifiers[0])
+        if 'Item' in response:
+            items[video_identifiers[0]] = response['Item']
+        return items
+
+    for i in range(0, len(video_identifiers), BATCH_GET_MAX_KEYS):
+        request_items = {
+            process_table.table_name: {
+                'Keys': [{"Identifier": {"S": video_identifier}} for video_identifier in video_identifiers[i:i + BATCH_GET_MAX_KEYS]],
+                'ConsistentRead': True
+            }
+        }
+
+        mtries = 0
+        while request_items:
+            response = dynamodb_batch_get_item(request_items)
+
+            for item in response['Responses'].get(process_table.table_name, []):
+                items[item['Identifier']['S']] = item
+
+            request_items = response.get('UnprocessedKeys')
+
+            if request_items:
+                if mtries >= MAX_RETRIES:
+                    logger.error("BatchGetItem - '{}' keys not read".format(len(request_items[process_table.table_name]['Keys'])))
+                    break
+
+                temp = min(MAX_BACKOFF, 2 ** mtries)
+                time.sleep(temp / float(2) + random.uniform(0, temp / float(2)))
+                mtries += 1
+
+    logger.debug("dynamodb_get_items_from_identifiers - videos: '{}' items: '{}'".format(len(video_identifiers), len(items)))
+
+    return items
+
+
 def dynamodb_update_item_by_identifier(video_identifier, status_val):
     process_table.update_item(
         Key={'Identifier': video_identifier},
@@ -151,16 +232,387 @@ def notify_event(video_identifier, status):
         logger.error(e)
 
 
-def execute_lambda_process_photos(video_identifier, item):
-    logger.debug("Executing with file '{}'".format(item))
+def execute_lambda_process_photos(video_identifier, items, shards=None):
+    logger.debug("Executing with files '{}'".format(items))
+    payload = {"Identifier": video_identifier}
+
+    # Without files the function claims the pending parts itself
+    if items is not None:
+        payload['Keys'] = items
+
+    # The parts of the video are items of the parts table
+    if shards:
+        payload['Shards'] = shards
+
     lambda_client.invoke(
         FunctionName=RVA_process_photos_function,
         InvocationType='Event',
         LogType='None',
-        Payload=json.dumps({"Identifier": video_identifier, "Key": item})
+        Payload=json.dumps(payload)
     )
 
 
+def part_shards(row):
+    '''
+    Returns the number of shards of the parts table used by the video, None when its parts are in the Parts map.
+    '''
+    if parts_layout(row) == PARTS_LAYOUT_ITEMS:
+        return int(row['PartShards']['N'])
+
+    return None
+
+
+def number_of_parts(row):
+    if parts_layout(row) == PARTS_LAYOUT_ITEMS:
+        return int(row['PartCount']['N'])
+
+    return len(row['Parts']['M'])
+
+
+def dispatch_fleet_grants(grants, video_rows):
+    '''
+    Starts the parts granted by the fleet scheduler. The videos granted slots may not be in the stream batch.
+
+    Each part is sent to its own photos function, parts_per_invocation does not apply: a slot counts
+    one processing part, as the Processing demand of the scheduler does. Parts sent together would
+    hold several slots with the Rekognition calls of a single function and leave the fleet TPS unused.
+    '''
+    missing = [video_identifier for video_identifier in grants if video_identifier not in video_rows]
+
+    if missing:
+        video_rows = dict(video_rows)
+        video_rows.update(dynamodb_get_items_from_identifiers(missing))
+
+    for video_identifier, slots in grants.items():
+        if video_identifier not in video_rows:
+            logger.warn("Video '{}' not found. '{}' slots not used.".format(video_identifier, slots))
+            continue
+
+        row = video_rows[video_identifier]
+        logger.debug("You can run '{}' functions for '{}'".format(slots, video_identifier))
+
+        for item in pending_parts(row, slots):
+            execute_lambda_process_photos(video_identifier, [item], part_shards(row))
+
+
+def parts_per_invocation(pending_sum):
+    '''
+    Returns how many parts to send to each photos function: the pending parts spread over MAX_TPS
+    functions, up to the parts that fit in the timeout of the photos function with one part to spare.
+    '''
+    parts_in_timeout = max(1, PHOTOS_FUNCTION_TIMEOUT // PART_PROCESSING_SECONDS - 1)
+
+    return max(1, min(parts_in_timeout, int(math.ceil(pending_sum / float(MAX_TPS)))))
+
+
+def start_workers(video_identifier, row, pending_sum, processing_sum, completed_sum):
+    '''
+    Starts the photos functions of a video in the worker mode. They are started when no part is being
+    processed, once for a new video and again only if the video stalls after more parts were completed,
+    the condition keeps the stream records of the same state from starting them twice.
+    '''
+    if processing_sum > 0:
+        logger.debug("You have '{}' items being processed".format(processing_sum))
+        return 0
+
+    try:
+        process_table.update_item(
+            Key={'Identifier': video_identifier},
+            UpdateExpression='SET WorkersStartedAt = :completed',
+            ConditionExpression='attribute_not_exists(WorkersStartedAt) OR WorkersStartedAt < :completed',
+            ExpressionAttributeValues={':completed': completed_sum})
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise err
+
+        logger.debug("Workers of '{}' already started.".format(video_identifier))
+        return 0
+
+    workers = min(int(MAX_TPS), pending_sum)
+    logger.debug("Starting '{}' workers for '{}' pending parts".format(workers, pending_sum))
+
+    for _ in range(workers):
+        execute_lambda_process_photos(video_identifier, None, part_shards(row))
+
+    return workers
+
+
+def processing_videos():
+    '''
+    Reads the items of every video being processed, for the periodic sweep.
+    '''
+    items = OrderedDict()
+    scan = {
+        'TableName': process_table.table_name,
+        'FilterExpression': '#st = :processing',
+        'ExpressionAttributeNames': {'#st': 'Status'},
+        'ExpressionAttributeValues': {':processing': {'S': 'PROCESSING'}},
+        'ConsistentRead': True
+    }
+
+    while True:
+        response = dynamodb_client.scan(**scan)
+
+        for item in response.get('Items', []):
+            items[item['Identifier']['S']] = item
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return items
+
+
+def reclaim_map_part(video_identifier, key, lease_expires, status):
+    '''
+    Moves a part of the Parts map whose lease expired to status. Returns False when the part is not
+    under that lease anymore, completed or already reclaimed.
+    '''
+    try:
+        process_table.update_item(
+            Key={'Identifier': video_identifier},
+            UpdateExpression='SET Parts.#file = :new REMOVE LeaseExpires.#file ADD ProcessingCount :dec, #counter :inc',
+            ConditionExpression='Parts.#file = :proc AND LeaseExpires.#file = :expires',
+            ExpressionAttributeNames={'#file': key, '#counter': STATUS_COUNTERS[status]},
+            ExpressionAttributeValues={':new': status, ':proc': STATUS_PROCESSING, ':expires': lease_expires, ':dec': -1, ':inc': 1})
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise err
+
+        logger.debug("Lease of '{}' already released. Skipping.".format(key))
+        return False
+
+    return True
+
+
+def reclaim_expired_leases(video_identifier, row):
+    '''
+    Gives the parts whose photos function timed out or failed, found by their expired lease, back
+    to the pending parts, or marks them failed once they were started PART_MAX_ATTEMPTS times. The
+    row is updated with the parts reclaimed. Returns the number of parts reclaimed.
+    '''
+    if 'ProcessingCount' in row and int(row['ProcessingCount']['N']) <= 0:
+        return 0
+
+    now = int(time.time())
+    reclaimed = []
+
+    if parts_layout(row) == PARTS_LAYOUT_ITEMS:
+        shards = part_shards(row)
+
+        for key, lease_expires, attempts in list(part_tracker.expired_leases(video_identifier, shards, now)):
+            failed = attempts >= PART_MAX_ATTEMPTS
+            if part_tracker.reclaim_part(video_identifier, key, shards, lease_expires, failed):
+                reclaimed.append((key, STATUS_FAILED if failed else STATUS_PENDING))
+    else:
+        part_dict = row['Parts']['M']
+        attempts = row.get('Attempts', {}).get('M', {})
+
+        for key, value in row.get('LeaseExpires', {}).get('M', {}).items():
+            lease_expires = int(value['N'])
+            if lease_expires >= now or part_dict.get(key, {}).get('S') != STATUS_PROCESSING:
+                continue
+
+            status = STATUS_FAILED if int(attempts.get(key, {}).get('N', 0)) >= PART_MAX_ATTEMPTS else STATUS_PENDING
+            if reclaim_map_part(video_identifier, key, lease_expires, status):
+                part_dict[key] = {'S': status}
+                reclaimed.append((key, status))
+
+    for key, status in reclaimed:
+        logger.warn("Lease of '{}' expired. Part moved to '{}'.".format(key, status))
+
+        for counter, change in [(STATUS_COUNTERS[STATUS_PROCESSING], -1), (STATUS_COUNTERS[status], 1)]:
+            row[counter] = {'N': str(int(row.get(counter, {}).get('N', 0)) + change)}
+
+    # The workers of the video were lost, they are started again
+    if reclaimed and DISPATCH_MODE == DISPATCH_MODE_WORKER:
+        process_table.update_item(
+            Key={'Identifier': video_identifier},
+            UpdateExpression='REMOVE WorkersStartedAt')
+        row.pop('WorkersStartedAt', None)
+
+    return len(reclaimed)
+
+
+def count_parts(row):
+    '''
+    Returns the number of pending, processing, completed and failed parts of a video. The counters
+    kept with the item are used when they add up to the number of parts, otherwise the parts are counted.
+    '''
+    number_of_items = number_of_parts(row)
+
+    # Items written before the parts could fail have no FailedCount
+    if all(counter in row for counter in PART_COUNTERS[:-1]):
+        counts = tuple(int(row.get(counter, {}).get('N', 0)) for counter in PART_COUNTERS)
+        if sum(counts) == number_of_items and min(counts) >= 0:
+            return counts
+
+        logger.warn("Part counters out of sync. Counting the parts. Counters: '{}' Parts: '{}'".format(counts, number_of_items))
+
+    if parts_layout(row) == PARTS_LAYOUT_ITEMS:
+        return part_tracker.count_parts(row['Identifier']['S'], part_shards(row))
+
+    part_dict = row['Parts']['M']
+
+    pending_sum = 0
+    processing_sum = 0
+    completed_sum = 0
+    failed_sum = 0
+
+    for value in part_dict.itervalues():
+        if value['S'] == STATUS_PENDING:
+            pending_sum += 1
+        elif value['S'] == STATUS_PROCESSING:
+            processing_sum += 1
+        elif value['S'] == STATUS_COMPLETED:
+            completed_sum += 1
+        elif value['S'] == STATUS_FAILED:
+            failed_sum += 1
+
+    return pending_sum, processing_sum, completed_sum, failed_sum
+
+
+def pending_parts(row, limit):
+    '''
+    Returns up to limit parts of the video waiting to be processed.
+    '''
+    if parts_layout(row) == PARTS_LAYOUT_ITEMS:
+        # Each pass starts on a different shard so the workers are spread over all of them
+        shards = part_shards(row)
+        first_shard = int(row.get('CompletedCount', {}).get('N', 0)) % shards
+        return list(part_tracker.pending_parts(row['Identifier']['S'], shards, limit, first_shard))
+
+    pending_list = []
+
+    for key, value in row['Parts']['M'].iteritems():
+        if value['S'] == 'PENDING':
+            pending_list.append(key)
+            if len(pending_list) >= limit:
+                break
+
+    return pending_list
+
+
+def schedule_video(video_identifier, row, results_array, rcc, fleet_demands=None):
+    '''
+    Runs the scheduling decision of one video: starts its pending parts, completes it or notifies
+    its completion, and adds its progress to results_array. With fleet_demands the parts are not
+    started here, the demand of the video is added to it for the fleet scheduler.
+    '''
+    iot_topic = row['Topic']['S']
+
+    if row['Status']['S'] == 'PROCESSING':
+        # Check if we've already seen this iot topic to make sure we won't mess with other simultaneous process.
+        element = None
+
+        for v in results_array:
+            if v['iot_topic'] == iot_topic:
+                element = v
+                break
+
+        if element is None:
+            element = {'iot_topic': iot_topic, 'number_of_items': 0, 'max_completed_items': 0,
+                       'status': 'PROCESSING'}
+            results_array.append(element)
+
+        element['identifier'] = video_identifier
+        number_of_items = number_of_parts(row)
+        element['number_of_items'] = number_of_items
+        reclaim_expired_leases(video_identifier, row)
+        pending_sum, processing_sum, completed_sum, failed_sum = count_parts(row)
+
+        logger.debug('Verifying completed items {}'.format(element))
+
+        try:
+            if completed_sum > element['max_completed_items']:
+                element['max_completed_items'] = completed_sum
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            logger.error('-' * 10)
+            traceback.print_exc(file=sys.stdout)
+            logger.error('-' * 10)
+
+        logger.debug("Items completed so far: '{}'".format(element['max_completed_items']))
+
+        #  it means this is a fresh record
+        if completed_sum == 0  and processing_sum == 0:
+
+            collection_id = rcc.fetch_collection()
+
+            logger.debug("CollectionId: '{}'".format(collection_id))
+
+            videos_results_table.put_item(Item={
+                'Identifier': video_identifier,
+                'FaceDetails': {
+                    'Smile': {'Positive': 0, 'Negative': 0},
+                    'Eyeglasses': {'Positive': 0, 'Negative': 0},
+                    'Sunglasses': {'Positive': 0, 'Negative': 0},
+                    'Gender': {'Male': 0, 'Female': 0},
+                    'Beard': {'Positive': 0, 'Negative': 0},
+                    'Mustache': {'Positive': 0, 'Negative': 0},
+                    'EyesOpen': {'Positive': 0, 'Negative': 0},
+                    'MouthOpen': {'Positive': 0, 'Negative': 0},
+                    'Emotions': {'HAPPY': 0, 'SAD': 0, 'ANGRY': 0, 'DISGUSTED': 0, 'CONFUSED': 0,
+                                 'SURPRISED': 0, 'CALM': 0}
+                },
+                'NumberFaceDetails': 0,
+                'DetectedLabels': {},
+                'Individuals': [],
+                'CollectionId': collection_id
+            })
+
+        if fleet_demands is not None:
+            fleet_demands[video_identifier] = {
+                'Pending': pending_sum,
+                'Processing': processing_sum,
+                'Weight': int(row.get('Weight', {}).get('N', DEFAULT_WEIGHT)),
+                'Tier': int(row.get('Priority', {}).get('N', DEFAULT_TIER))
+            }
+
+        if pending_sum > 0:
+            logger.debug("Pending parts: '{}'".format(pending_sum))
+
+            if fleet_demands is not None:
+                logger.debug("You have '{}' items being processed".format(processing_sum))
+            elif DISPATCH_MODE == DISPATCH_MODE_WORKER:
+                start_workers(video_identifier, row, pending_sum, processing_sum, completed_sum)
+            else:
+                # The parts sent together stay processing until their function ends. The parts per
+                # function only go down as the video progresses, so the functions running are not
+                # underestimated.
+                parts_per_function = parts_per_invocation(pending_sum)
+                run_functions = int(MAX_TPS) - int(math.ceil(processing_sum / float(parts_per_function)))
+
+                if run_functions > 0:
+                    logger.debug("You have '{}' files to process".format(pending_sum))
+                    logger.debug("You can run '{}' functions with '{}' files each".format(run_functions, parts_per_function))
+                    pending_list = pending_parts(row, run_functions * parts_per_function)
+                    for i in range(0, len(pending_list), parts_per_function):
+                        execute_lambda_process_photos(video_identifier, pending_list[i:i + parts_per_function], part_shards(row))
+                else:
+                    logger.debug("You have '{}' items being processed".format(processing_sum))
+        elif number_of_items == completed_sum + failed_sum:
+            if failed_sum > 0:
+                logger.warn("Video '{}' completed with '{}' failed parts".format(video_identifier, failed_sum))
+
+            dynamodb_update_item_by_identifier(video_identifier, 'COMPLETED')
+
+    # elif row['Status']['S'] == 'EXTRACTING_THUMBNAILS':
+    #     element = {'iot_topic': iot_topic, 'status': 'EXTRACTING_THUMBNAILS'}
+    #     results_array.append(element)
+    #
+    #     lambda_client.invoke(
+    #         FunctionName=RVA_crop_orchestration_function,
+    #         InvocationType='Event',
+    #         LogType='None',
+    #         Payload=json.dumps({"Identifier": video_identifier})
+    #     )
+    elif row['Status']['S'] == 'COMPLETED':
+        element = {'iot_topic': iot_topic, 'status': 'COMPLETED', 'identifier': video_identifier, 'max_completed_items': 0}
+        results_array.append(element)
+        notify_event(video_identifier, 'COMPLETED')
+
+
 def lambda_handler(event, context):
     logger.debug("Received event: " + json.dumps(event))
 
@@ -169,133 +621,63 @@ def lambda_handler(event, context):
     results_array = []
     rcc = init_RekognitionCollectionController()
 
-    for record in event['Records']:
+    # Many records of a batch usually belong to the same video, each video is read and scheduled once
+    stream_rows = OrderedDict()
+    video_rows = {}
+
+    # The parts of every video are started by the fleet scheduler once the batch is read
+    fleet_demands = {} if FLEET_MAX_TPS > 0 and DISPATCH_MODE == DISPATCH_MODE_STREAM else None
+
+    records = event.get('Records', [])
+
+    for record in records:
         if record['eventName'] != 'REMOVE':
             try:
                 row = record['dynamodb']['NewImage']
-                video_identifier = row['Identifier']['S']
-
-                logger.debug("Processing record:\n{}".format(json.dumps(row)))
-
-                ddb_video_item = dynamodb_get_item_from_identifier(video_identifier)
+                stream_rows[row['Identifier']['S']] = row
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                logger.error('-' * 10)
+                traceback.print_exc(file=sys.stdout)
+                logger.error('-' * 10)
 
-                if 'Item' in ddb_video_item:
-                    row = ddb_video_item['Item']
+    # The periodic sweep schedules every video being processed, the parts of a video whose photos
+    # functions were all lost don't change anymore and its item has no stream record to reclaim them
+    if event.get('source') == 'aws.events':
+        ddb_video_items = processing_videos()
+        stream_rows = ddb_video_items
+    else:
+        ddb_video_items = dynamodb_get_items_from_identifiers(stream_rows.keys())
 
-                iot_topic = row['Topic']['S']
+    logger.debug("Records: '{}' Videos: '{}'".format(len(records), len(stream_rows)))
 
-                if row['Status']['S'] == 'PROCESSING':
-                    # Check if we've already seen this iot topic to make sure we won't mess with other simultaneous process.
-                    element = None
+    for video_identifier, row in stream_rows.iteritems():
+        try:
+            logger.debug("Processing video:\n{}".format(json.dumps(row)))
 
-                    for v in results_array:
-                        if v['iot_topic'] == iot_topic:
-                            element = v
-                            break
+            # The table holds the latest state, the stream image is only used when the item is gone
+            if video_identifier in ddb_video_items:
+                row = ddb_video_items[video_identifier]
 
-                    if element is None:
-                        element = {'iot_topic': iot_topic, 'number_of_items': 0, 'max_completed_items': 0,
-                                   'status': 'PROCESSING'}
-                        results_array.append(element)
+            video_rows[video_identifier] = row
+            schedule_video(video_identifier, row, results_array, rcc, fleet_demands)
 
-                    element['identifier'] = video_identifier
-                    completed_sum = 0
-                    processing_sum = 0
-                    part_dict = row['Parts']['M']
-                    element['number_of_items'] = len(part_dict)
-                    number_of_items = len(part_dict)
-                    parts = json.dumps(part_dict)
-                    pending_list = []
-                    logger.debug(parts)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            logger.error('-' * 10)
+            traceback.print_exc(file=sys.stdout)
+            logger.error('-' * 10)
 
-                    for key, value in part_dict.iteritems():
-                        if value['S'] == "COMPLETED":
-                            completed_sum += 1
-                        else:
-                            if value['S'] == "PENDING":
-                                pending_list.append(key)
-                                #logger.debug("Item '{}' with status '{}' needs to be processed".format(key, value))
-                            if value['S'] == 'PROCESSING':
-                                processing_sum +=1
-                                #logger.debug("Item '{}' with status '{}' is being processed".format(key, value))
-
-                    logger.debug('Verifying completed items {}'.format(element))
-
-                    try:
-                        if completed_sum > element['max_completed_items']:
-                            element['max_completed_items'] = completed_sum
-                    except Exception as e:
-                        logger.error(e, exc_info=True)
-                        logger.error('-' * 10)
-                        traceback.print_exc(file=sys.stdout)
-                        logger.error('-' * 10)
-
-                    logger.debug("Items completed so far: '{}'".format(element['max_completed_items']))
-
-                    #  it means this is a fresh record
-                    if completed_sum == 0  and processing_sum == 0:
-
-                        collection_id = rcc.fetch_collection()
-
-                        logger.debug("CollectionId: '{}'".format(collection_id))
-
-                        videos_results_table.put_item(Item={
-                            'Identifier': video_identifier,
-                            'FaceDetails': {
-                                'Smile': {'Positive': 0, 'Negative': 0},
-                                'Eyeglasses': {'Positive': 0, 'Negative': 0},
-                                'Sunglasses': {'Positive': 0, 'Negative': 0},
-                                'Gender': {'Male': 0, 'Female': 0},
-                                'Beard': {'Positive': 0, 'Negative': 0},
-                                'Mustache': {'Positive': 0, 'Negative': 0},
-                                'EyesOpen': {'Positive': 0, 'Negative': 0},
-                                'MouthOpen': {'Positive': 0, 'Negative': 0},
-                                'Emotions': {'HAPPY': 0, 'SAD': 0, 'ANGRY': 0, 'DISGUSTED': 0, 'CONFUSED': 0,
-                                             'SURPRISED': 0, 'CALM': 0}
-                            },
-                            'NumberFaceDetails': 0,
-                            'DetectedLabels': {},
-                            'Individuals': [],
-                            'CollectionId': collection_id
-                        })
-
-                    if pending_list:
-                        logger.debug("Pending list is: " + json.dumps(pending_list))
-
-                        if processing_sum >= int(MAX_TPS):
-                            logger.debug("You have '{}' items being processed".format(processing_sum))
-                        else:
-                            run_functions = int(MAX_TPS) - processing_sum
-                            if run_functions > 0:
-                                logger.debug("You have '{}' files to process".format(len(pending_list)))
-                                logger.debug("You can run '{}' functions".format(run_functions))
-                                for item in pending_list[:run_functions]:
-                                    execute_lambda_process_photos(video_identifier, item)
-                            else:
-                                logger.debug("You can't run more functins at this time.")
-                    elif number_of_items == completed_sum:
-                        dynamodb_update_item_by_identifier(video_identifier, 'COMPLETED')
-
-                # elif row['Status']['S'] == 'EXTRACTING_THUMBNAILS':
-                #     element = {'iot_topic': iot_topic, 'status': 'EXTRACTING_THUMBNAILS'}
-                #     results_array.append(element)
-                #
-                #     lambda_client.invoke(
-                #         FunctionName=RVA_crop_orchestration_function,
-                #         InvocationType='Event',
-                #         LogType='None',
-                #         Payload=json.dumps({"Identifier": video_identifier})
-                #     )
-                elif row['Status']['S'] == 'COMPLETED':
-                    element = {'iot_topic': iot_topic, 'status': 'COMPLETED', 'identifier': video_identifier, 'max_completed_items': 0}
-                    results_array.append(element)
-                    notify_event(video_identifier, 'COMPLETED')
+    if fleet_demands:
+        try:
+            dispatch_fleet_grants(init_FleetScheduler().schedule(fleet_demands), video_rows)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            logger.error('-' * 10)
+            traceback.print_exc(file=sys.stdout)
+            logger.error('-' * 10)
 
-            except Exception as e:
-                logger.error(e, exc_info=True)
-                logger.error('-' * 10)
-                traceback.print_exc(file=sys.stdout)
-                logger.error('-' * 10)
+    progress_publisher = init_ProgressPublisher()
 
     for element in results_array:
         if element['iot_topic'] != "none":
@@ -306,34 +688,36 @@ def lambda_handler(event, context):
                         ((final_percentage - initial_percentage) / element['number_of_items']) * element['max_completed_items'])))
                     logger.debug("iot_topic:%s - %d" % (element['iot_topic'], calculated_value))
 
-                    payload = json.dumps({
+                    payload = {
                         'topic': element['iot_topic'],
                         'type': 'status',
                         'payload': {'message': 'Analyzing frames', 'percentage': calculated_value}
-                    })
-                    publish_message(payload)
+                    }
+                    progress_publisher.publish(payload)
             elif element['status'] == 'CONSOLIDATING':
-                payload = json.dumps({
+                payload = {
                     'topic': element['iot_topic'],
                     'type': 'status',
                     'payload': {'message': 'Consolidating results', 'percentage': final_percentage}
-                })
-                publish_message(payload)
+                }
+                progress_publisher.publish(payload)
             elif element['status'] == 'EXTRACTING_THUMBNAILS':
-                payload = json.dumps({
+                payload = {
                     'topic': element['iot_topic'],
                     'type': 'status',
                     'payload': {'message': 'Extracting thumbnails from individuals', 'percentage': 95}
-                })
-                publish_message(payload)
+                }
+                progress_publisher.publish(payload)
             elif element['status'] == 'COMPLETED':
-                payload = json.dumps({
+                payload = {
                     'topic': element['iot_topic'],
                     'type': 'redirect',
                     'payload': {'identifier': element['identifier']}
-                })
-                publish_message(payload)
+                }
+                progress_publisher.publish(payload)
+
+    iot_publisher.close()
 
-    logger.info('Successfully processed {} records.'.format(len(event['Records'])))
+    logger.info('Successfully processed {} records.'.format(len(records)))
 
-    return 'Successfully processed {} records.'.format(len(event['Records']))
+    return 'Successfully processed {} records.'.format(len(records))
@@ -9,6 +9,7 @@ from moto import mock_s3, mock_dynamodb2, mock_dynamodb
 
 videos_results_table_name = 'RVA_VIDEOS_RESULTS_TABLE'
 videos_process_table = 'RVA_PROCESS_TABLE'
+videos_process_parts_table = 'RVA_PROCESS_PARTS_TABLE'
 
 logger = logging.getLogger()
 logger.level = logging.DEBUG
@@ -69,6 +70,7 @@ class TestActor(unittest.TestCase):
 
         create_VIDEOS_PROCESS_TABLE(dynamodb)
         create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
 
         with open('test_events/event_all_pending.json') as data_file:
             event = json.load(data_file)
@@ -90,6 +92,7 @@ class TestActor(unittest.TestCase):
 
         create_VIDEOS_PROCESS_TABLE(dynamodb)
         create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
 
         with open('test_events/event_three_pending.json') as data_file:
             event = json.load(data_file)
@@ -98,6 +101,33 @@ class TestActor(unittest.TestCase):
         
         assert 3 == mock_exec_lambda.call_count
 
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_progress_debounced(self, mock_pub, mock_rcc, mock_exec_lambda):
+        context = ''
+
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        with open('test_events/event_three_pending.json') as data_file:
+            event = json.load(data_file)
+
+        parts = event['Records'][0]['dynamodb']['NewImage']['Parts']['M']
+        parts[sorted(parts)[0]] = {'S': 'COMPLETED'}
+
+        lambda_function.lambda_handler(event, context)
+        lambda_function.lambda_handler(event, context)
+
+        # The same progress is only published once
+        assert 1 == mock_pub.call_count
+        assert 'status' == json.loads(mock_pub.call_args[0][0])['type']
+
     @mock_s3
     @mock_dynamodb2
     @mock.patch('lambda_function.execute_lambda_process_photos')
@@ -110,6 +140,7 @@ class TestActor(unittest.TestCase):
 
         create_VIDEOS_PROCESS_TABLE(dynamodb)
         create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
 
         with open('test_events/event_all_completed.json') as data_file:
             event = json.load(data_file)
@@ -140,6 +171,7 @@ class TestActor(unittest.TestCase):
 
         create_VIDEOS_PROCESS_TABLE(dynamodb)
         create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
 
         with open('test_events/event_all_completed.json') as data_file:
             event = json.load(data_file)
@@ -148,6 +180,268 @@ class TestActor(unittest.TestCase):
         
         mock_exec_lambda.assert_not_called()
 
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_records_coalesced_per_video(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        with open('test_events/event_three_pending.json') as data_file:
+            event = json.load(data_file)
+        event['Records'] = event['Records'] * 10
+
+        with mock.patch('lambda_function.dynamodb_get_item_from_identifier', wraps=lambda_function.dynamodb_get_item_from_identifier) as mock_get_item:
+            lambda_function.lambda_handler(event, '')
+
+        mock_get_item.assert_called_once_with('VideoFile.mp4')
+        self.assertEqual(3, mock_exec_lambda.call_count)
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_several_videos_read_with_batch_get(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        with open('test_events/event_three_pending.json') as data_file:
+            record = json.load(data_file)['Records'][0]
+
+        event = {'Records': []}
+        for video_identifier in ['VideoFile1.mp4', 'VideoFile2.mp4']:
+            video_record = json.loads(json.dumps(record))
+            video_record['dynamodb']['NewImage']['Identifier']['S'] = video_identifier
+            video_record['dynamodb']['NewImage']['Topic']['S'] = video_identifier
+            event['Records'] += [video_record] * 5
+
+            # The table is ahead of the stream image, only one part is left
+            item = json.loads(json.dumps(video_record['dynamodb']['NewImage']))
+            item['Parts']['M'] = {'images/{}/part.txt'.format(video_identifier): {'S': 'PENDING'}}
+            dynamodb.put_item(TableName=videos_process_table, Item=item)
+
+        with mock.patch('lambda_function.dynamodb_batch_get_item', wraps=lambda_function.dynamodb_batch_get_item) as mock_batch_get:
+            lambda_function.lambda_handler(event, '')
+
+        self.assertEqual(1, mock_batch_get.call_count)
+        self.assertEqual(sorted([mock.call('VideoFile1.mp4', ['images/VideoFile1.mp4/part.txt'], None),
+                                 mock.call('VideoFile2.mp4', ['images/VideoFile2.mp4/part.txt'], None)]),
+                         sorted(mock_exec_lambda.call_args_list))
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_part_items_pending(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_PROCESS_PARTS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        keys = ['images/VideoFile.mp4/{}.txt'.format(i) for i in range(1, 21)]
+        row = {
+            'Identifier': {'S': 'VideoFile.mp4'},
+            'Status': {'S': 'PROCESSING'},
+            'Topic': {'S': 'VideoFile.mp4'},
+            'PartsLayout': {'S': 'ITEMS'},
+            'PartCount': {'N': '20'},
+            'PartShards': {'N': '4'},
+            'PendingCount': {'N': '20'},
+            'ProcessingCount': {'N': '0'},
+            'CompletedCount': {'N': '0'}
+        }
+        dynamodb.put_item(TableName=videos_process_table, Item=row)
+        lambda_function.part_tracker.put_parts('VideoFile.mp4', keys, 4)
+
+        lambda_function.lambda_handler({'Records': [{'eventName': 'INSERT', 'dynamodb': {'NewImage': row}}]}, '')
+
+        # The 20 parts are spread over MAX_TPS functions
+        self.assertEqual(5, mock_exec_lambda.call_count)
+        self.assertEqual(sorted(keys), sorted(key for call in mock_exec_lambda.call_args_list for key in call[0][1]))
+        for call in mock_exec_lambda.call_args_list:
+            self.assertEqual(4, len(call[0][1]))
+            self.assertEqual(4, call[0][2])
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.DISPATCH_MODE', 'worker')
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_worker_mode_starts_workers_once(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        with open('test_events/event_all_pending.json') as data_file:
+            event = json.load(data_file)
+
+        lambda_function.lambda_handler(event, '')
+        lambda_function.lambda_handler(event, '')
+
+        self.assertEqual(5, mock_exec_lambda.call_count)
+        for call in mock_exec_lambda.call_args_list:
+            self.assertEqual(None, call[0][1])
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.FLEET_MAX_TPS', 4)
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_fleet_scheduler_shares_slots(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+        dynamodb.create_table(TableName='RVA_COLLECTION_CONTROL_TABLE',
+            KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+        event = {'Records': []}
+        for video_identifier, parts in [('Feature.mp4', 10), ('Clip.mp4', 1)]:
+            row = {
+                'Identifier': {'S': video_identifier},
+                'Status': {'S': 'PROCESSING'},
+                'Topic': {'S': video_identifier},
+                'Parts': {'M': dict(('images/{}/{}.txt'.format(video_identifier, i), {'S': 'PENDING'}) for i in range(parts))}
+            }
+            dynamodb.put_item(TableName=videos_process_table, Item=row)
+            event['Records'].append({'eventName': 'INSERT', 'dynamodb': {'NewImage': row}})
+
+        lambda_function.lambda_handler(event, '')
+
+        videos = [call[0][0] for call in mock_exec_lambda.call_args_list]
+        self.assertEqual(3, videos.count('Feature.mp4'))
+        self.assertEqual(1, videos.count('Clip.mp4'))
+
+        # Every slot of the fleet is in use
+        lambda_function.lambda_handler(event, '')
+        self.assertEqual(4, mock_exec_lambda.call_count)
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_sweep_reclaims_expired_leases(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        # moto can't evaluate the nested conditions on a part key with dots
+        dynamodb.put_item(TableName=videos_process_table, Item={
+            'Identifier': {'S': 'VideoFile'},
+            'Status': {'S': 'PROCESSING'},
+            'Topic': {'S': 'VideoFile'},
+            'Parts': {'M': {'images/VideoFile/1': {'S': 'PROCESSING'}, 'images/VideoFile/2': {'S': 'PROCESSING'},
+                            'images/VideoFile/3': {'S': 'PROCESSING'}, 'images/VideoFile/4': {'S': 'COMPLETED'}}},
+            'LeaseExpires': {'M': {'images/VideoFile/1': {'N': '1000'}, 'images/VideoFile/2': {'N': '1000'},
+                                   'images/VideoFile/3': {'N': '9999999999'}}},
+            'Attempts': {'M': {'images/VideoFile/1': {'N': '1'}, 'images/VideoFile/2': {'N': '3'}, 'images/VideoFile/3': {'N': '1'}}},
+            'PendingCount': {'N': '0'},
+            'ProcessingCount': {'N': '3'},
+            'CompletedCount': {'N': '1'},
+            'FailedCount': {'N': '0'}
+        })
+
+        lambda_function.lambda_handler({'source': 'aws.events', 'detail-type': 'Scheduled Event'}, '')
+
+        mock_exec_lambda.assert_called_once_with('VideoFile', ['images/VideoFile/1'], None)
+
+        item = dynamodb.get_item(TableName=videos_process_table, Key={'Identifier': {'S': 'VideoFile'}})['Item']
+        self.assertEqual({'images/VideoFile/1': 'PENDING', 'images/VideoFile/2': 'FAILED', 'images/VideoFile/3': 'PROCESSING', 'images/VideoFile/4': 'COMPLETED'},
+                         dict((key, value['S']) for key, value in item['Parts']['M'].items()))
+        self.assertEqual(['images/VideoFile/3'], item['LeaseExpires']['M'].keys())
+        self.assertEqual((1, 1, 1, 1), lambda_function.count_parts(item))
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.execute_lambda_process_photos')
+    @mock.patch('lambda_function.init_RekognitionCollectionController', return_value=mock_rcc)
+    @mock.patch('lambda_function.publish_message')
+    def test_part_items_failed_complete_the_video(self, mock_pub, mock_rcc, mock_exec_lambda):
+        dynamodb = boto3.client('dynamodb')
+
+        create_VIDEOS_PROCESS_TABLE(dynamodb)
+        create_VIDEOS_PROCESS_PARTS_TABLE(dynamodb)
+        create_VIDEOS_RESULTS_TABLE_NAME(dynamodb)
+        create_PROGRESS_TABLE(dynamodb)
+
+        keys = ['images/VideoFile.mp4/{}.txt'.format(i) for i in range(1, 5)]
+        row = {
+            'Identifier': {'S': 'VideoFile.mp4'},
+            'Status': {'S': 'PROCESSING'},
+            'Topic': {'S': 'VideoFile.mp4'},
+            'PartsLayout': {'S': 'ITEMS'},
+            'PartCount': {'N': '4'},
+            'PartShards': {'N': '2'},
+            'PendingCount': {'N': '4'},
+            'ProcessingCount': {'N': '0'},
+            'CompletedCount': {'N': '0'},
+            'FailedCount': {'N': '0'}
+        }
+        dynamodb.put_item(TableName=videos_process_table, Item=row)
+        lambda_function.part_tracker.put_parts('VideoFile.mp4', keys, 2)
+
+        # Every part was started PART_MAX_ATTEMPTS times, the last lease of the first one expired
+        for key in keys:
+            for _ in range(lambda_function.PART_MAX_ATTEMPTS):
+                lambda_function.part_tracker.start_part('VideoFile.mp4', key, 2, 1000)
+                lambda_function.part_tracker.reclaim_part('VideoFile.mp4', key, 2, 1000)
+            lambda_function.part_tracker.start_part('VideoFile.mp4', key, 2, 1000)
+            if key != keys[0]:
+                lambda_function.part_tracker.complete_part('VideoFile.mp4', key, 2)
+
+        lambda_function.lambda_handler({'source': 'aws.events', 'detail-type': 'Scheduled Event'}, '')
+
+        self.assertEqual(0, mock_exec_lambda.call_count)
+        item = dynamodb.get_item(TableName=videos_process_table, Key={'Identifier': {'S': 'VideoFile.mp4'}})['Item']
+        self.assertEqual('COMPLETED', item['Status']['S'])
+        self.assertEqual((0, 0, 3, 1), lambda_function.part_tracker.count_parts('VideoFile.mp4', 2))
+
+    @mock.patch('lambda_function.PHOTOS_FUNCTION_TIMEOUT', 300)
+    @mock.patch('lambda_function.PART_PROCESSING_SECONDS', 60)
+    def test_parts_per_invocation(self):
+        self.assertEqual(1, lambda_function.parts_per_invocation(3))
+        self.assertEqual(2, lambda_function.parts_per_invocation(6))
+        self.assertEqual(4, lambda_function.parts_per_invocation(1000))
+
+    def test_count_parts_uses_counters(self):
+        row = {'Parts': {'M': {'1.txt': {'S': 'COMPLETED'}, '2.txt': {'S': 'PENDING'}, '3.txt': {'S': 'PENDING'}}},
+               'PendingCount': {'N': '2'}, 'ProcessingCount': {'N': '0'}, 'CompletedCount': {'N': '1'}}
+
+        self.assertEqual((2, 0, 1, 0), lambda_function.count_parts(row))
+        self.assertEqual(['2.txt', '3.txt'], sorted(lambda_function.pending_parts(row, 5)))
+        self.assertEqual(1, len(lambda_function.pending_parts(row, 1)))
+
+    def test_count_parts_counters_out_of_sync(self):
+        row = {'Parts': {'M': {'1.txt': {'S': 'COMPLETED'}, '2.txt': {'S': 'PROCESSING'}, '3.txt': {'S': 'PENDING'}}},
+               'PendingCount': {'N': '3'}, 'ProcessingCount': {'N': '0'}, 'CompletedCount': {'N': '1'}}
+
+        self.assertEqual((1, 1, 1, 0), lambda_function.count_parts(row))
+
+        del row['PendingCount']
+        self.assertEqual((1, 1, 1, 0), lambda_function.count_parts(row))
+
 
 def create_VIDEOS_RESULTS_TABLE_NAME(dynamodb):
     dynamodb.create_table(TableName=videos_results_table_name,
@@ -156,6 +450,29 @@ def create_VIDEOS_RESULTS_TABLE_NAME(dynamodb):
         ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
 
 
+def create_PROGRESS_TABLE(dynamodb):
+    dynamodb.create_table(TableName='RVA_PROGRESS_TABLE',
+        KeySchema=[{'AttributeName': 'Topic', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'Topic', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+
+def create_VIDEOS_PROCESS_PARTS_TABLE(dynamodb):
+    dynamodb.create_table(TableName=videos_process_parts_table,
+        KeySchema=[{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'Key', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'Shard', 'AttributeType': 'S'}, {'AttributeName': 'Key', 'AttributeType': 'S'},
+                              {'AttributeName': 'PendingKey', 'AttributeType': 'S'}, {'AttributeName': 'LeaseExpires', 'AttributeType': 'N'}],
+        GlobalSecondaryIndexes=[{'IndexName': 'PendingParts',
+                                 'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'PendingKey', 'KeyType': 'RANGE'}],
+                                 'Projection': {'ProjectionType': 'KEYS_ONLY'},
+                                 'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}},
+                                {'IndexName': 'LeasedParts',
+                                 'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'LeaseExpires', 'KeyType': 'RANGE'}],
+                                 'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['Attempts']},
+                                 'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+
 def create_VIDEOS_PROCESS_TABLE(dynamodb):
     dynamodb.create_table(TableName=videos_process_table,
         KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
@@ -0,0 +1,540 @@
+'''
+Discrete-event simulator of the orchestrator.
+
+The real stream handler schedules the videos against moto backed DynamoDB with a simulated clock.
+The DynamoDB stream delivers the changes of the process table to the handler in batches, one
+invocation at a time, and the photos functions it starts are simulated: they claim and complete
+their parts the way the photos function does, each part taking a latency drawn from the workload
+and making Rekognition calls under an optional TPS limit. The workload is synthetic (N videos with
+a part count and a latency distribution) or recorded (a JSON list of videos with the latency of
+each part). Makespan, concurrency, idle gaps and Rekognition TPS over time are printed for every
+MAX_TPS and stream batch size and saved as JSON.
+
+Usage:
+    python simulator.py --videos 4 --parts 120 --latency lognormal:40,0.3 --max-tps 2,5,10 --batch-sizes 10,100
+    python simulator.py --workload recorded_workload.json --dispatch-mode worker --photos-timeout 300
+
+A recorded workload is a list of {"Identifier": ..., "Arrival": seconds, "Latencies": [seconds of each part]}.
+'''
+
+from __future__ import print_function
+
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'simulator')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'simulator')
+os.environ.setdefault('RVA_IoT_publish_message_function', 'simulator')
+os.environ.setdefault('RVA_process_photos_function', 'simulator')
+os.environ.setdefault('RVA_SNS_MILESTONES_TOPIC_ARN', 'simulator')
+os.environ.setdefault('RVA_COLLECTION_MAX_SIZE', '100000')
+os.environ.setdefault('MAX_TPS', '5')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import boto3
+import mock
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb2
+
+# The module level clients of lambda_function are only intercepted when they are created after the mock started
+dynamodb_mock = mock_dynamodb2()
+dynamodb_mock.start()
+
+import lambda_function
+from fleet_scheduler import FleetScheduler
+from part_tracking import PARTS_LAYOUT_MAP, PARTS_LAYOUT_ITEMS, PENDING_INDEX, LEASES_INDEX
+
+# CONSTANTS
+TABLES = {
+    'RVA_PROCESS_TABLE': 'Identifier',
+    'RVA_VIDEOS_RESULTS_TABLE': 'Identifier',
+    'RVA_COLLECTION_CONTROL_TABLE': 'Identifier',
+    'RVA_PROGRESS_TABLE': 'Topic'
+}
+PART_LEASE_SECONDS = 360        # lease of the parts claimed by the photos function
+DISPATCH_MIN_REMAINING_MS = 30000 # the photos function stops with less time left
+
+
+def latency_sampler(spec, rnd):
+    '''
+    Returns a function drawing part latencies in seconds from 'constant:s', 'uniform:low,high' or
+    'lognormal:median,sigma'.
+    '''
+    name, _, values = spec.partition(':')
+    values = [float(v) for v in values.split(',') if v]
+
+    if name == 'constant':
+        return lambda: values[0]
+    if name == 'uniform':
+        return lambda: rnd.uniform(values[0], values[1])
+    if name == 'lognormal':
+        return lambda: values[0] * math.exp(rnd.gauss(0, values[1]))
+
+    raise ValueError("Unknown latency distribution '{}'".format(spec))
+
+
+def synthetic_workload(videos, parts, latency, arrival_interval, seed=0):
+    rnd = random.Random(seed)
+    sample = latency_sampler(latency, rnd)
+
+    return [{
+        'Identifier': 'video-{}'.format(i),
+        'Arrival': i * arrival_interval,
+        'Latencies': [sample() for _ in range(parts)]
+    } for i in range(videos)]
+
+
+class SimulatedClock:
+    '''
+    Stands for the time module of the handler.
+    '''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Simulator:
+    '''
+    Runs a workload through the stream handler. Every write to the process table adds a record to the
+    stream, as the real table does, and the handler is invoked with up to batch_size of them every
+    poll_interval seconds once the previous invocation ended.
+    '''
+
+    def __init__(self, workload, max_tps=5, batch_size=100, dispatch_mode=lambda_function.DISPATCH_MODE_STREAM,
+                 fleet_max_tps=0, photos_timeout=300, part_seconds=60, parts_layout=PARTS_LAYOUT_MAP, shards=4,
+                 handler_seconds=0.3, poll_interval=0.25, invoke_latency=0.5, calls_per_part=20,
+                 rekognition_tps=0, sweep_interval=300, tps_bucket=10):
+        self.workload = dict((video['Identifier'], video) for video in workload)
+        self.max_tps = max_tps
+        self.batch_size = batch_size
+        self.dispatch_mode = dispatch_mode
+        self.fleet_max_tps = fleet_max_tps
+        self.photos_timeout = photos_timeout
+        self.part_seconds = part_seconds
+        self.parts_layout = parts_layout
+        self.shards = shards if parts_layout == PARTS_LAYOUT_ITEMS else None
+        self.handler_seconds = handler_seconds
+        self.poll_interval = poll_interval
+        self.invoke_latency = invoke_latency
+        self.calls_per_part = calls_per_part
+        self.rekognition_tps = rekognition_tps
+        self.sweep_interval = sweep_interval
+        self.tps_bucket = tps_bucket
+
+        self.clock = SimulatedClock()
+        self.events = []
+        self.sequence = 0
+        self.stream = []
+        self.handler_busy_until = 0.0
+        self.dynamodb = boto3.client('dynamodb')
+
+        self.completed = {}
+        self.latencies = {}
+        self.running = {}
+        self.idle_since = {}
+        self.idle_gaps = []
+        self.concurrency = [(0.0, 0)]
+        self.rekognition_calls = {}
+        self.handler_invocations = 0
+        self.photos_invocations = 0
+        self.parts_processed = 0
+
+    # --------------- Event loop
+
+    def schedule(self, at, action, *args):
+        heapq.heappush(self.events, (at, self.sequence, action, args))
+        self.sequence += 1
+
+    def run(self):
+        create_tables(self.dynamodb)
+
+        for video in self.workload.values():
+            self.schedule(video['Arrival'], self.arrive, video)
+
+        self.schedule(0.0, self.poll)
+        if self.sweep_interval:
+            self.schedule(self.sweep_interval, self.sweep)
+
+        patches = [
+            mock.patch.object(lambda_function, 'time', self.clock),
+            mock.patch.object(lambda_function, 'MAX_TPS', str(self.max_tps)),
+            mock.patch.object(lambda_function, 'DISPATCH_MODE', self.dispatch_mode),
+            mock.patch.object(lambda_function, 'FLEET_MAX_TPS', self.fleet_max_tps),
+            mock.patch.object(lambda_function, 'PHOTOS_FUNCTION_TIMEOUT', self.photos_timeout),
+            mock.patch.object(lambda_function, 'PART_PROCESSING_SECONDS', self.part_seconds),
+            mock.patch.object(lambda_function, 'execute_lambda_process_photos', self.invoke_photos),
+            mock.patch.object(lambda_function, 'init_RekognitionCollectionController', return_value=mock.Mock(**{'fetch_collection.return_value': 'RVA-SIMULATOR'})),
+            mock.patch.object(lambda_function, 'init_FleetScheduler', self.fleet_scheduler),
+            mock.patch.object(lambda_function, 'notify_event'),
+            mock.patch.object(lambda_function, 'publish_message')
+        ]
+
+        for patch in patches:
+            patch.start()
+
+        try:
+            while self.events and len(self.completed) < len(self.workload):
+                at, _, action, args = heapq.heappop(self.events)
+                self.clock.now = at
+                action(*args)
+        finally:
+            for patch in patches:
+                patch.stop()
+
+        return self.metrics()
+
+    def fleet_scheduler(self):
+        scheduler = FleetScheduler(lambda_function.RVA_COLLECTION_CONTROL, 'DISPATCH', self.fleet_max_tps, self.dynamodb)
+        scheduler.time = self.clock.time
+        return scheduler
+
+    # --------------- DynamoDB stream and handler
+
+    def record(self, video_identifier, event_name='MODIFY'):
+        item = self.dynamodb.get_item(TableName='RVA_PROCESS_TABLE', Key={'Identifier': {'S': video_identifier}}, ConsistentRead=True)['Item']
+        self.stream.append({'eventName': event_name, 'dynamodb': {'NewImage': item}})
+
+    def poll(self):
+        if self.stream and self.clock.now >= self.handler_busy_until:
+            records, self.stream = self.stream[:self.batch_size], self.stream[self.batch_size:]
+            self.invoke_handler({'Records': records})
+
+        self.schedule(max(self.clock.now + self.poll_interval, self.handler_busy_until), self.poll)
+
+    def sweep(self):
+        self.invoke_handler({'source': 'aws.events'})
+        self.schedule(self.clock.now + self.sweep_interval, self.sweep)
+
+    def invoke_handler(self, event):
+        self.handler_invocations += 1
+        self.handler_busy_until = self.clock.now + self.handler_seconds
+        lambda_function.lambda_handler(event, None)
+
+        for video_identifier in self.workload:
+            if video_identifier not in self.completed and self.status(video_identifier) == 'COMPLETED':
+                self.completed[video_identifier] = self.clock.now
+                self.close_idle_gap(video_identifier)
+
+    def status(self, video_identifier):
+        item = self.dynamodb.get_item(TableName='RVA_PROCESS_TABLE', Key={'Identifier': {'S': video_identifier}}, ConsistentRead=True).get('Item')
+        return item['Status']['S'] if item else None
+
+    # --------------- Videos
+
+    def arrive(self, video):
+        video_identifier = video['Identifier']
+        keys = ['images/{}/part-{:05d}'.format(video_identifier, i) for i in range(len(video['Latencies']))]
+        self.latencies.update(zip(keys, video['Latencies']))
+        counters = {'PendingCount': {'N': str(len(keys))}, 'ProcessingCount': {'N': '0'}, 'CompletedCount': {'N': '0'}, 'FailedCount': {'N': '0'}}
+
+        if self.shards:
+            item = dict(counters, PartsLayout={'S': PARTS_LAYOUT_ITEMS}, PartShards={'N': str(self.shards)}, PartCount={'N': str(len(keys))})
+            lambda_function.part_tracker.put_parts(video_identifier, keys, self.shards)
+        else:
+            item = dict(counters, Parts={'M': dict((key, {'S': 'PENDING'}) for key in keys)}, LeaseExpires={'M': {}}, Attempts={'M': {}})
+
+        item.update({'Identifier': {'S': video_identifier}, 'Status': {'S': 'PROCESSING'}, 'Topic': {'S': 'none'}})
+        self.dynamodb.put_item(TableName='RVA_PROCESS_TABLE', Item=item)
+
+        self.running[video_identifier] = 0
+        self.idle_since[video_identifier] = self.clock.now
+        self.record(video_identifier, 'INSERT')
+
+    def close_idle_gap(self, video_identifier):
+        since = self.idle_since.pop(video_identifier, None)
+        if since is not None and self.clock.now > since:
+            self.idle_gaps.append(self.clock.now - since)
+
+    def change_running(self, video_identifier, change):
+        if self.running[video_identifier] == 0:
+            self.close_idle_gap(video_identifier)
+
+        self.running[video_identifier] += change
+
+        if self.running[video_identifier] == 0 and video_identifier not in self.completed:
+            self.idle_since[video_identifier] = self.clock.now
+
+        self.concurrency.append((self.clock.now, sum(self.running.values())))
+
+    # --------------- Photos functions
+
+    def invoke_photos(self, video_identifier, items, shards=None):
+        self.photos_invocations += 1
+        self.schedule(self.clock.now + self.invoke_latency, self.start_photos, video_identifier, list(items or []))
+
+    def start_photos(self, video_identifier, keys):
+        invocation = {'Identifier': video_identifier, 'Started': self.clock.now, 'Claimed': [], 'Done': [], 'Longest': 0.0,
+                      'LeaseExpires': int(self.clock.now) + PART_LEASE_SECONDS}
+
+        for key in keys:
+            if self.claim(video_identifier, key, invocation['LeaseExpires']):
+                invocation['Claimed'].append(key)
+
+        if keys and not invocation['Claimed']:
+            return
+
+        self.change_running(video_identifier, 1)
+        self.next_part(invocation)
+
+    def next_part(self, invocation):
+        video_identifier = invocation['Identifier']
+        key = invocation['Claimed'].pop(0) if invocation['Claimed'] else None
+
+        if key is None and self.dispatch_mode == lambda_function.DISPATCH_MODE_WORKER:
+            for candidate in self.pending_keys(video_identifier):
+                if self.claim(video_identifier, candidate, int(self.clock.now) + PART_LEASE_SECONDS):
+                    key = candidate
+                    break
+
+        if key is None:
+            self.finish_photos(invocation)
+            return
+
+        self.schedule(self.clock.now + self.analyze(self.clock.now, self.latencies[key]), self.part_done, invocation, key, self.clock.now)
+
+    def part_done(self, invocation, key, started):
+        invocation['Done'].append(key)
+        invocation['Longest'] = max(invocation['Longest'], self.clock.now - started)
+        remaining_ms = (self.photos_timeout - (self.clock.now - invocation['Started'])) * 1000
+
+        if remaining_ms < max(DISPATCH_MIN_REMAINING_MS, 2000 * invocation['Longest']):
+            if self.dispatch_mode == lambda_function.DISPATCH_MODE_WORKER and self.pending_keys(invocation['Identifier']):
+                self.invoke_photos(invocation['Identifier'], None)
+            self.finish_photos(invocation)
+            return
+
+        self.next_part(invocation)
+
+    def finish_photos(self, invocation):
+        video_identifier = invocation['Identifier']
+
+        for key in invocation['Claimed']:
+            self.release(video_identifier, key, invocation['LeaseExpires'])
+
+        # The parts are completed once the results of the invocation are written
+        for key in invocation['Done']:
+            self.complete(video_identifier, key)
+            self.parts_processed += 1
+
+        self.change_running(video_identifier, -1)
+
+    def analyze(self, start, latency):
+        '''
+        Spreads the Rekognition calls of a part over its latency, each call waiting for a second with
+        calls left under the TPS limit. Returns the seconds the part takes.
+        '''
+        end = start + latency
+
+        for i in range(self.calls_per_part):
+            call_at = start + (i + 0.5) * latency / self.calls_per_part
+            second = int(call_at)
+
+            while self.rekognition_tps and self.rekognition_calls.get(second, 0) >= self.rekognition_tps:
+                second += 1
+
+            self.rekognition_calls[second] = self.rekognition_calls.get(second, 0) + 1
+            end = max(end, second + (call_at - int(call_at)))
+
+        return end - start
+
+    # --------------- Part status, as written by the photos function
+
+    def pending_keys(self, video_identifier):
+        if self.shards:
+            return list(lambda_function.part_tracker.pending_parts(video_identifier, self.shards, 10))
+
+        item = self.dynamodb.get_item(TableName='RVA_PROCESS_TABLE', Key={'Identifier': {'S': video_identifier}}, ConsistentRead=True)['Item']
+        return sorted(key for key, value in item['Parts']['M'].items() if value['S'] == 'PENDING')[:10]
+
+    def claim(self, video_identifier, key, lease_expires):
+        if self.shards:
+            claimed = lambda_function.part_tracker.start_part(video_identifier, key, self.shards, lease_expires)
+        else:
+            claimed = self.update_part(video_identifier, key,
+                                       'SET Parts.#file = :new, LeaseExpires.#file = :expires ADD PendingCount :dec, ProcessingCount :inc',
+                                       'Parts.#file = :old', 'PENDING', 'PROCESSING', {':expires': {'N': str(lease_expires)}})
+
+        if claimed:
+            self.record(video_identifier)
+
+        return claimed
+
+    def release(self, video_identifier, key, lease_expires):
+        if self.shards:
+            released = lambda_function.part_tracker.reclaim_part(video_identifier, key, self.shards, lease_expires)
+        else:
+            released = self.update_part(video_identifier, key,
+                                        'SET Parts.#file = :new REMOVE LeaseExpires.#file ADD ProcessingCount :dec, PendingCount :inc',
+                                        'Parts.#file = :old', 'PROCESSING', 'PENDING')
+
+        if released:
+            self.record(video_identifier)
+
+    def complete(self, video_identifier, key):
+        if self.shards:
+            completed = lambda_function.part_tracker.complete_part(video_identifier, key, self.shards)
+        else:
+            completed = self.update_part(video_identifier, key,
+                                         'SET Parts.#file = :new REMOVE LeaseExpires.#file ADD ProcessingCount :dec, CompletedCount :inc',
+                                         'Parts.#file = :old', 'PROCESSING', 'COMPLETED')
+
+        if completed:
+            self.record(video_identifier)
+
+    def update_part(self, video_identifier, key, update_expression, condition_expression, old_status, new_status, values=None):
+        expression_values = {':old': {'S': old_status}, ':new': {'S': new_status}, ':dec': {'N': '-1'}, ':inc': {'N': '1'}}
+        expression_values.update(values or {})
+
+        try:
+            self.dynamodb.update_item(
+                TableName='RVA_PROCESS_TABLE',
+                Key={'Identifier': {'S': video_identifier}},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames={'#file': key},
+                ExpressionAttributeValues=expression_values)
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise err
+            return False
+
+        return True
+
+    # --------------- Metrics
+
+    def metrics(self):
+        first_arrival = min(video['Arrival'] for video in self.workload.values())
+        end = max(self.completed.values()) if self.completed else self.clock.now
+        makespan = end - first_arrival
+
+        # Time weighted concurrency of the photos functions
+        busy = 0.0
+        for (at, running), (next_at, _) in zip(self.concurrency, self.concurrency[1:] + [(end, 0)]):
+            busy += running * max(0.0, min(next_at, end) - max(at, first_arrival))
+
+        seconds = range(int(first_arrival), int(math.ceil(end)) + 1)
+        buckets = [sum(self.rekognition_calls.get(s, 0) for s in seconds[i:i + self.tps_bucket]) / float(self.tps_bucket)
+                   for i in range(0, len(seconds), self.tps_bucket)]
+
+        return {
+            'MaxTps': self.max_tps,
+            'BatchSize': self.batch_size,
+            'DispatchMode': self.dispatch_mode,
+            'VideosCompleted': len(self.completed),
+            'Videos': len(self.workload),
+            'Makespan': round(makespan, 2),
+            'VideoSeconds': dict((video, round(at - self.workload[video]['Arrival'], 2)) for video, at in self.completed.items()),
+            'AverageConcurrency': round(busy / makespan, 2) if makespan else 0.0,
+            'PeakConcurrency': max(running for _, running in self.concurrency),
+            'IdleGaps': len(self.idle_gaps),
+            'IdleSeconds': round(sum(self.idle_gaps), 2),
+            'LongestIdleGap': round(max(self.idle_gaps or [0.0]), 2),
+            'RekognitionTpsPeak': max(self.rekognition_calls.values() or [0]),
+            'RekognitionTpsAverage': round(sum(self.rekognition_calls.values()) / makespan, 2) if makespan else 0.0,
+            'RekognitionTps': buckets,
+            'HandlerInvocations': self.handler_invocations,
+            'PhotosInvocations': self.photos_invocations,
+            'PartsProcessed': self.parts_processed
+        }
+
+
+def create_tables(dynamodb):
+    for table_name, key_name in TABLES.items():
+        dynamodb.create_table(TableName=table_name,
+                              KeySchema=[{'AttributeName': key_name, 'KeyType': 'HASH'}],
+                              AttributeDefinitions=[{'AttributeName': key_name, 'AttributeType': 'S'}],
+                              ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+    throughput = {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    dynamodb.create_table(TableName=lambda_function.RVA_PROCESS_PARTS_TABLE,
+                          KeySchema=[{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'Key', 'KeyType': 'RANGE'}],
+                          AttributeDefinitions=[{'AttributeName': 'Shard', 'AttributeType': 'S'}, {'AttributeName': 'Key', 'AttributeType': 'S'},
+                                                {'AttributeName': 'PendingKey', 'AttributeType': 'S'}, {'AttributeName': 'LeaseExpires', 'AttributeType': 'N'}],
+                          GlobalSecondaryIndexes=[{'IndexName': PENDING_INDEX,
+                                                   'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'PendingKey', 'KeyType': 'RANGE'}],
+                                                   'Projection': {'ProjectionType': 'KEYS_ONLY'},
+                                                   'ProvisionedThroughput': throughput},
+                                                  {'IndexName': LEASES_INDEX,
+                                                   'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'LeaseExpires', 'KeyType': 'RANGE'}],
+                                                   'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['Attempts']},
+                                                   'ProvisionedThroughput': throughput}],
+                          ProvisionedThroughput=throughput)
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Discrete-event simulator of the orchestrator')
+    parser.add_argument('--workload', help='JSON file of a recorded workload, replaces the synthetic one')
+    parser.add_argument('--videos', default=3, type=int, help='videos of the synthetic workload')
+    parser.add_argument('--parts', default=60, type=int, help='parts of each video')
+    parser.add_argument('--latency', default='lognormal:40,0.3', help='seconds per part: constant:s, uniform:low,high or lognormal:median,sigma')
+    parser.add_argument('--arrival-interval', default=0.0, type=float, help='seconds between the videos')
+    parser.add_argument('--max-tps', default='5', type=parse_list, help='MAX_TPS values to simulate')
+    parser.add_argument('--batch-sizes', default='100', type=parse_list, help='stream batch sizes to simulate')
+    parser.add_argument('--dispatch-mode', default=lambda_function.DISPATCH_MODE_STREAM, choices=[lambda_function.DISPATCH_MODE_STREAM, lambda_function.DISPATCH_MODE_WORKER])
+    parser.add_argument('--fleet-max-tps', default=0, type=int)
+    parser.add_argument('--parts-layout', default=PARTS_LAYOUT_MAP, choices=[PARTS_LAYOUT_MAP, PARTS_LAYOUT_ITEMS])
+    parser.add_argument('--photos-timeout', default=300, type=int, help='timeout of the photos function in seconds')
+    parser.add_argument('--part-seconds', default=60, type=int, help='PART_PROCESSING_SECONDS of the handler')
+    parser.add_argument('--handler-seconds', default=0.3, type=float, help='duration of a stream handler invocation')
+    parser.add_argument('--invoke-latency', default=0.5, type=float, help='seconds before a photos function starts')
+    parser.add_argument('--calls-per-part', default=20, type=int, help='Rekognition calls of each part')
+    parser.add_argument('--rekognition-tps', default=0, type=int, help='Rekognition TPS limit, 0 disables it')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default='simulator_results.json')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+
+    if args.workload:
+        with open(args.workload) as workload_file:
+            workload = json.load(workload_file)
+    else:
+        workload = synthetic_workload(args.videos, args.parts, args.latency, args.arrival_interval, args.seed)
+
+    results = []
+
+    for max_tps in args.max_tps:
+        for batch_size in args.batch_sizes:
+            # Every run starts from empty tables
+            dynamodb_mock.stop()
+            dynamodb_mock.start()
+
+            result = Simulator(workload, max_tps, batch_size, args.dispatch_mode, args.fleet_max_tps, args.photos_timeout,
+                               args.part_seconds, args.parts_layout, handler_seconds=args.handler_seconds,
+                               invoke_latency=args.invoke_latency, calls_per_part=args.calls_per_part,
+                               rekognition_tps=args.rekognition_tps).run()
+            results.append(result)
+
+            print("max tps: {MaxTps:>3} batch: {BatchSize:>4} | makespan: {Makespan:>9} s concurrency: {AverageConcurrency:>6} "
+                  "(peak {PeakConcurrency:>3}) idle: {IdleSeconds:>8} s in {IdleGaps:>4} gaps rekognition tps: {RekognitionTpsAverage:>7} "
+                  "(peak {RekognitionTpsPeak:>4}) videos: {VideosCompleted}/{Videos}".format(**result))
+
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'Config': dict(vars(args), Timestamp=int(time.time())),
+            'Results': results
+        }, output_file, indent=2, sort_keys=True)
+
+    print("Results saved to '{}'".format(args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+import logging
+import threading
+import time
+from functools import wraps
+
+logger = logging.getLogger()
+
+# CONSTANTS
+LATENCY_SPIKE_FACTOR = 3.0 # a call this many times slower than the average counts as congestion
+LATENCY_EWMA_WEIGHT = 0.1
+DECREASE_COOLDOWN = 1.0 # seconds, calls in flight when the limit is cut report the same congestion
+
+
+class AIMDController:
+    '''
+    Additive increase / multiplicative decrease of the number of concurrent calls to one API.
+
+    The limit grows by one after a full limit of successful calls and is halved when a call is
+    throttled or takes much longer than the average. It always stays between minimum and maximum.
+    '''
+
+    def __init__(self, name, initial, minimum, maximum, latency_spike_factor=LATENCY_SPIKE_FACTOR):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.window = float(min(self.maximum, max(self.minimum, initial)))
+        self.latency_spike_factor = latency_spike_factor
+        self.latency_average = None
+        self.clock = time.time
+        self.last_decrease = None
+        self.lock = threading.Lock()
+        self.reset_trace()
+
+    def limit(self):
+        return int(self.window)
+
+    def reset_trace(self):
+        self.trace_start = self.clock()
+        self.trace = [(0.0, self.limit(), 'start')]
+
+    def _record(self, reason):
+        if self.limit() != self.trace[-1][1]:
+            self.trace.append((round(self.clock() - self.trace_start, 3), self.limit(), reason))
+
+    def _decrease(self, reason):
+        now = self.clock()
+        if self.last_decrease is not None and now - self.last_decrease < DECREASE_COOLDOWN:
+            return
+
+        self.last_decrease = now
+        self.window = max(self.minimum, self.window / 2)
+        self._record(reason)
+
+    def on_success(self, latency):
+        with self.lock:
+            if self.latency_average and latency > self.latency_spike_factor * self.latency_average:
+                self._decrease('latency')
+            else:
+                self.window = min(self.maximum, self.window + 1.0 / self.window)
+                self._record('increase')
+
+            if self.latency_average is None:
+                self.latency_average = latency
+            else:
+                self.latency_average += LATENCY_EWMA_WEIGHT * (latency - self.latency_average)
+
+    def on_throttle(self):
+        with self.lock:
+            self._decrease('throttling')
+
+
+def reports_latency(controller):
+    '''
+    Decorator reporting the latency of every successful call to the controller. Apply it below
+    @rate_limited and @retry so the token waits and the backoff sleeps are not part of the latency.
+    '''
+    def decorator_reports_latency(f):
+
+        @wraps(f)
+        def f_reports_latency(*args, **kwargs):
+            start = controller.clock()
+            result = f(*args, **kwargs)
+            controller.on_success(controller.clock() - start)
+            return result
+
+        return f_reports_latency
+
+    return decorator_reports_latency
@@ -0,0 +1,105 @@
+import unittest
+import logging
+
+from adaptive_concurrency import AIMDController, reports_latency
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def new_controller(initial=4, minimum=1, maximum=16):
+    clock = FakeClock()
+    controller = AIMDController('IndexFaces', initial, minimum, maximum)
+    controller.clock = clock.time
+    controller.reset_trace()
+    return controller, clock
+
+
+class TestAIMDController(unittest.TestCase):
+
+    def test_increase_after_about_a_full_window(self):
+        controller, clock = new_controller(initial=4)
+
+        for _ in range(4):
+            controller.on_success(0.1)
+        self.assertEqual(4, controller.limit())
+
+        controller.on_success(0.1)
+        self.assertEqual(5, controller.limit())
+
+    def test_throttle_halves_the_limit(self):
+        controller, clock = new_controller(initial=8)
+
+        controller.on_throttle()
+        self.assertEqual(4, controller.limit())
+
+        # Calls throttled during the cooldown report the same congestion
+        controller.on_throttle()
+        self.assertEqual(4, controller.limit())
+
+        clock.now += 2
+        controller.on_throttle()
+        self.assertEqual(2, controller.limit())
+
+    def test_latency_spike_decreases_the_limit(self):
+        controller, clock = new_controller(initial=8)
+
+        controller.on_success(0.1)
+        controller.on_success(1.0)
+
+        self.assertEqual(4, controller.limit())
+
+    def test_limit_stays_within_bounds(self):
+        controller, clock = new_controller(initial=2, minimum=2, maximum=3)
+
+        for _ in range(100):
+            controller.on_success(0.1)
+        self.assertEqual(3, controller.limit())
+
+        for _ in range(5):
+            clock.now += 2
+            controller.on_throttle()
+        self.assertEqual(2, controller.limit())
+
+    def test_trace_records_changes(self):
+        controller, clock = new_controller(initial=2)
+
+        for _ in range(3):
+            controller.on_success(0.1)
+        clock.now += 2
+        controller.on_throttle()
+
+        self.assertEqual([(0.0, 2, 'start'), (0.0, 3, 'increase'), (2.0, 1, 'throttling')], controller.trace)
+
+    def test_reports_latency_of_the_call_only(self):
+        controller, clock = new_controller(initial=2)
+
+        @reports_latency(controller)
+        def call(latency):
+            clock.now += latency
+            if latency > 1:
+                raise ValueError(latency)
+            return latency
+
+        # A wait before the call, as a rate limiter token or a retry backoff, is not reported
+        clock.now += 5
+        self.assertEqual(0.2, call(0.2))
+        self.assertAlmostEqual(0.2, controller.latency_average)
+
+        # Failed calls are not reported
+        self.assertRaises(ValueError, call, 2)
+        self.assertAlmostEqual(0.2, controller.latency_average)
+
+
+if __name__ == '__main__':
+    unittest.main()
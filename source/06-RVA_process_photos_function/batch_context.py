@@ -0,0 +1,86 @@
+from __future__ import print_function
+
+import threading
+
+
+class BatchContext:
+    '''
+    State of one batch manifest being analyzed.
+
+    Results are stored in slots preallocated per frame, so each worker thread only writes to the slot
+    of the frame it is processing. Shared counters are updated under a lock. The per-frame records
+    are written through the results writer of the batch.
+    '''
+
+    video_identifier = ''
+    collection_id = ''
+    frames = None
+    faces_indexed = 0
+    results_writer = None
+
+    def __init__(self, video_identifier, collection_id, frames, results_writer=None):
+        self.video_identifier = video_identifier
+        self.collection_id = collection_id
+        self.results_writer = results_writer
+        # List of (key, timestamp) tuples in manifest order
+        self.frames = list(frames)
+        self.frame_index = dict((frame[0], i) for i, frame in enumerate(self.frames))
+        self.detect_faces_results = [None] * len(self.frames)
+        self.detect_labels_results = [None] * len(self.frames)
+        self.pending_calls = [0] * len(self.frames)
+        self.images = [None] * len(self.frames)
+        self.faces_indexed = 0
+        self.lock = threading.Lock()
+
+    def add_faces_indexed(self, faces_found):
+        with self.lock:
+            self.faces_indexed += faces_found
+            return self.faces_indexed
+
+    def add_pending_calls(self, key, calls):
+        with self.lock:
+            self.pending_calls[self.frame_index[key]] += calls
+
+    def complete_call(self, key):
+        '''
+        Marks one of the Rekognition calls of the frame as finished and returns how many are left.
+        '''
+        with self.lock:
+            self.pending_calls[self.frame_index[key]] -= 1
+            return self.pending_calls[self.frame_index[key]]
+
+    def set_image(self, key, image_bytes):
+        self.images[self.frame_index[key]] = image_bytes
+
+    def image(self, bucket, key):
+        '''
+        Returns the Image parameter of the Rekognition calls of the frame, its bytes when they were
+        already read from S3.
+        '''
+        image_bytes = self.images[self.frame_index[key]]
+
+        if image_bytes is not None:
+            return {'Bytes': image_bytes}
+
+        return {'S3Object': {'Bucket': bucket, 'Name': key}}
+
+    def release_image(self, key):
+        self.images[self.frame_index[key]] = None
+
+    def set_faces_result(self, key, face_records):
+        self.detect_faces_results[self.frame_index[key]] = face_records
+
+    def get_faces_result(self, key):
+        return self.detect_faces_results[self.frame_index[key]]
+
+    def set_labels_result(self, key, labels):
+        self.detect_labels_results[self.frame_index[key]] = labels
+
+    def get_labels_result(self, key):
+        return self.detect_labels_results[self.frame_index[key]]
+
+    def faces_results(self):
+        return [result for result in self.detect_faces_results if result is not None]
+
+    def labels_results(self):
+        return [result for result in self.detect_labels_results if result is not None]
@@ -0,0 +1,80 @@
+import unittest
+import logging
+from multiprocessing.dummy import Pool
+
+from batch_context import BatchContext
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+class TestBatchContext(unittest.TestCase):
+
+    test_video_identifier = 'fun-at-fair-343902224.mp4'
+
+    def new_batch_context(self, number_of_frames):
+        frames = [('images/{0}/{0}-{1}.jpg'.format(self.test_video_identifier, i), str(i * 1000)) for i in range(number_of_frames)]
+        return BatchContext(self.test_video_identifier, 'DVA-00000', frames)
+
+    def test_faces_indexed_is_deterministic(self):
+        batch_context = self.new_batch_context(1)
+
+        def increment(i):
+            for _ in range(1000):
+                batch_context.add_faces_indexed(1)
+
+        pool = Pool(16)
+        pool.map(increment, range(16))
+        pool.close()
+        pool.join()
+
+        self.assertEqual(16000, batch_context.faces_indexed)
+
+    def test_results_are_stored_per_frame(self):
+        batch_context = self.new_batch_context(500)
+
+        def store(frame):
+            key = frame[0]
+            batch_context.set_faces_result(key, [{'FaceDetail': {'Key': key}}])
+            batch_context.set_labels_result(key, [{'Name': key}])
+            batch_context.add_faces_indexed(1)
+
+        pool = Pool(16)
+        pool.map(store, batch_context.frames)
+        pool.close()
+        pool.join()
+
+        self.assertEqual(500, batch_context.faces_indexed)
+        self.assertEqual(500, len(batch_context.faces_results()))
+        self.assertEqual(500, len(batch_context.labels_results()))
+        for key, timestamp in batch_context.frames:
+            self.assertEqual(key, batch_context.get_labels_result(key)[0]['Name'])
+
+    def test_image_bytes_or_s3_object(self):
+        batch_context = self.new_batch_context(2)
+        read, unread = [frame[0] for frame in batch_context.frames]
+
+        batch_context.set_image(read, 'jpeg bytes')
+
+        self.assertEqual({'Bytes': 'jpeg bytes'}, batch_context.image('bucket', read))
+        self.assertEqual({'S3Object': {'Bucket': 'bucket', 'Name': unread}}, batch_context.image('bucket', unread))
+
+        batch_context.release_image(read)
+        self.assertEqual({'S3Object': {'Bucket': 'bucket', 'Name': read}}, batch_context.image('bucket', read))
+
+    def test_batches_do_not_share_results(self):
+        first = self.new_batch_context(2)
+        second = self.new_batch_context(2)
+        key = first.frames[0][0]
+
+        first.set_labels_result(key, [{'Name': 'Person'}])
+        first.add_faces_indexed(3)
+
+        self.assertIsNone(second.get_labels_result(key))
+        self.assertEqual(0, second.faces_indexed)
+        self.assertEqual([], second.labels_results())
+
+
+if __name__ == '__main__':
+    unittest.main()
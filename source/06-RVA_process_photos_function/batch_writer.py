@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# CONSTANTS
+BATCH_WRITE_MAX_ITEMS = 25 # BatchWriteItem limit
+DEFAULT_FLUSH_SIZE = 100
+MAX_BACKOFF = 15 # seconds
+MAX_RETRIES = 5
+
+
+class BatchWriter:
+    '''
+    Buffers the items written by the worker threads and puts them with BatchWriteItem, 25 at a time.
+
+    The buffer is flushed by the thread that fills it up to flush_size and once more when the batch
+    ends. Items left unprocessed by DynamoDB are retried with backoff. Writing an item twice before a
+    flush keeps only the last one, BatchWriteItem refuses repeated keys in the same request.
+    '''
+
+    def __init__(self, batch_write_item_call, flush_size=DEFAULT_FLUSH_SIZE, key_attributes=('Identifier', 'Key'),
+                 tries=MAX_RETRIES, max_backoff=MAX_BACKOFF):
+        self.batch_write_item_call = batch_write_item_call
+        self.flush_size = max(1, flush_size)
+        self.key_attributes = key_attributes
+        self.tries = tries
+        self.max_backoff = max_backoff
+        self.sleep = time.sleep
+        self.buffer = OrderedDict()
+        self.items_written = 0
+        self.items_failed = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def put(self, table_name, item):
+        key = (table_name,) + tuple(item.get(attribute) for attribute in self.key_attributes)
+
+        with self.lock:
+            self.buffer.pop(key, None)
+            self.buffer[key] = (table_name, item)
+
+            if len(self.buffer) < self.flush_size:
+                return
+
+            items = self._take_buffer()
+
+        self._write(items)
+
+    def flush(self):
+        with self.lock:
+            items = self._take_buffer()
+
+        self._write(items)
+
+        logger.debug("BatchWriter - items written: '{}' failed: '{}' calls: '{}'".format(self.items_written, self.items_failed, self.calls))
+
+    def _take_buffer(self):
+        # Must be called holding self.lock
+        items = list(self.buffer.values())
+        self.buffer = OrderedDict()
+        return items
+
+    def _write(self, items):
+        for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+            request_items = {}
+            for table_name, item in items[i:i + BATCH_WRITE_MAX_ITEMS]:
+                request_items.setdefault(table_name, []).append({'PutRequest': {'Item': item}})
+
+            self._write_batch(request_items)
+
+    def _write_batch(self, request_items):
+        count = sum(len(requests) for requests in request_items.values())
+        mtries = 0
+
+        while request_items:
+            try:
+                response = self.batch_write_item_call(request_items)
+            except Exception as e:
+                logger.error("BatchWriter - error writing '{}' items".format(count))
+                logger.error(e)
+                break
+            finally:
+                with self.lock:
+                    self.calls += 1
+
+            request_items = response.get('UnprocessedItems', {})
+            unprocessed = sum(len(requests) for requests in request_items.values())
+
+            with self.lock:
+                self.items_written += count - unprocessed
+            count = unprocessed
+
+            if not request_items:
+                return
+
+            if mtries >= self.tries:
+                logger.error("BatchWriter - BACKOFF - Limit breached, '{}' items not written".format(count))
+                break
+
+            temp = min(self.max_backoff, 2 ** mtries)
+            sleep = temp / float(2) + random.uniform(0, temp / float(2))
+            logger.warn("BatchWriter - BACKOFF - Waiting '{}' s Retries: '{}' Unprocessed items: '{}'".format(sleep, mtries, count))
+
+            self.sleep(sleep)
+            mtries += 1
+
+        with self.lock:
+            self.items_failed += count
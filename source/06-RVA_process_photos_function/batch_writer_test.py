@@ -0,0 +1,114 @@
+import unittest
+import mock
+import boto3
+import logging
+from multiprocessing.dummy import Pool
+
+from moto import mock_dynamodb2
+
+from batch_writer import BatchWriter
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+FRAMES_RESULTS_TABLE = 'RVA_FRAMES_RESULTS_TABLE'
+VIDEO_LABELS_TABLE = 'RVA_VIDEOS_LABELS_TABLE'
+
+
+def new_item(i):
+    return {'Identifier': 'video.mp4', 'Key': 'video.mp4-{}.jpg'.format(i), 'Time': str(i)}
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def test_items_are_written_25_at_a_time(self):
+        call = mock.Mock(return_value={'UnprocessedItems': {}})
+        writer = BatchWriter(call, flush_size=1000)
+
+        for i in range(60):
+            writer.put(FRAMES_RESULTS_TABLE, new_item(i))
+            writer.put(VIDEO_LABELS_TABLE, new_item(i))
+        self.assertEqual(0, call.call_count)
+
+        writer.flush()
+
+        self.assertEqual(5, call.call_count)
+        self.assertEqual([25, 25, 25, 25, 20], [sum(len(requests) for requests in c[0][0].values()) for c in call.call_args_list])
+        self.assertEqual(120, writer.items_written)
+
+    def test_flush_when_buffer_is_full(self):
+        call = mock.Mock(return_value={'UnprocessedItems': {}})
+        writer = BatchWriter(call, flush_size=10)
+
+        for i in range(25):
+            writer.put(FRAMES_RESULTS_TABLE, new_item(i))
+
+        self.assertEqual(2, call.call_count)
+        self.assertEqual(20, writer.items_written)
+
+    def test_repeated_key_keeps_last_item(self):
+        call = mock.Mock(return_value={'UnprocessedItems': {}})
+        writer = BatchWriter(call)
+
+        writer.put(FRAMES_RESULTS_TABLE, dict(new_item(1), Time='1'))
+        writer.put(FRAMES_RESULTS_TABLE, dict(new_item(1), Time='2'))
+        writer.flush()
+
+        requests = call.call_args[0][0][FRAMES_RESULTS_TABLE]
+        self.assertEqual([{'PutRequest': {'Item': dict(new_item(1), Time='2')}}], requests)
+
+    def test_unprocessed_items_are_retried(self):
+        unprocessed = {FRAMES_RESULTS_TABLE: [{'PutRequest': {'Item': new_item(1)}}]}
+        call = mock.Mock(side_effect=[{'UnprocessedItems': unprocessed}, {'UnprocessedItems': {}}])
+        writer = BatchWriter(call)
+        writer.sleep = mock.Mock()
+
+        writer.put(FRAMES_RESULTS_TABLE, new_item(0))
+        writer.put(FRAMES_RESULTS_TABLE, new_item(1))
+        writer.flush()
+
+        self.assertEqual(unprocessed, call.call_args[0][0])
+        self.assertEqual(1, writer.sleep.call_count)
+        self.assertEqual(2, writer.items_written)
+        self.assertEqual(0, writer.items_failed)
+
+    def test_items_failed_after_retries(self):
+        unprocessed = {FRAMES_RESULTS_TABLE: [{'PutRequest': {'Item': new_item(0)}}]}
+        call = mock.Mock(return_value={'UnprocessedItems': unprocessed})
+        writer = BatchWriter(call, tries=2)
+        writer.sleep = mock.Mock()
+
+        writer.put(FRAMES_RESULTS_TABLE, new_item(0))
+        writer.flush()
+
+        self.assertEqual(3, call.call_count)
+        self.assertEqual(1, writer.items_failed)
+
+    @mock_dynamodb2
+    def test_threads_write_to_dynamodb(self):
+        dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+        dynamodb_resource = boto3.resource('dynamodb', region_name='us-east-1')
+        dynamodb.create_table(TableName=FRAMES_RESULTS_TABLE,
+                            KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'Key', 'KeyType': 'RANGE'}],
+                            AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'Key', 'AttributeType': 'S'}],
+                            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+        writer = BatchWriter(lambda request_items: dynamodb_resource.batch_write_item(RequestItems=request_items), flush_size=30)
+
+        pool = Pool(8)
+        pool.map(lambda i: writer.put(FRAMES_RESULTS_TABLE, new_item(i)), range(200))
+        pool.close()
+        pool.join()
+        writer.flush()
+
+        self.assertEqual(200, dynamodb.scan(TableName=FRAMES_RESULTS_TABLE)['Count'])
+        self.assertEqual(200, writer.items_written)
+
+
+if __name__ == '__main__':
+    unittest.main()
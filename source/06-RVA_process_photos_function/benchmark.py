@@ -0,0 +1,338 @@
+'''
+Throughput benchmark of the frame analysis Lambda.
+
+The handler runs against moto backed S3/DynamoDB and a fake Rekognition client answering with the
+sample responses of this folder after a random latency, throttling a share of the calls. The sweep
+runs every combination of batch size (frames per manifest), pool size (maximum concurrency per API)
+and video length (manifests per video) and the results are saved as JSON.
+
+Usage:
+    python benchmark.py --batch-sizes 10,50 --pool-sizes 4,16 --video-lengths 1,4 --output benchmark_results.json
+'''
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('VIDEO_BUCKET', 'rva-benchmark-video-bucket')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import boto3
+import mock
+from botocore.exceptions import ClientError
+from moto import mock_s3, mock_dynamodb2
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+    Image = None
+
+# The module level clients of lambda_function are only intercepted when they are created after the mocks started
+s3_mock = mock_s3()
+dynamodb_mock = mock_dynamodb2()
+s3_mock.start()
+dynamodb_mock.start()
+
+import lambda_function
+import rekognition_rate_limiter
+
+# CONSTANTS
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+TABLES = {
+    'RVA_PROCESS_TABLE': ['Identifier'],
+    'RVA_VIDEOS_RESULTS_TABLE': ['Identifier'],
+    'RVA_VIDEOS_RESULTS_MARKERS_TABLE': ['Identifier', 'Marker'],
+    'RVA_FRAMES_RESULTS_TABLE': ['Identifier', 'Key'],
+    'RVA_VIDEOS_LABELS_TABLE': ['Identifier', 'Key']
+}
+WRITE_UNIT_SIZE = 1024 # bytes
+
+
+class FakeRekognition:
+    '''
+    Answers IndexFaces/DetectLabels with the sample responses after a lognormal latency and throttles
+    a share of the calls.
+    '''
+
+    def __init__(self, latency_median, latency_sigma, throttle_rate, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttled = {}
+
+        with open(os.path.join(BENCHMARK_DIR, 'faces.json')) as faces_file:
+            self.faces_response = json.load(faces_file)
+        with open(os.path.join(BENCHMARK_DIR, 'labels.json')) as labels_file:
+            self.labels_response = json.load(labels_file)
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.throttled = {}
+
+    def _call(self, api, response):
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+            latency = self.latency_median * math.exp(self.random.gauss(0, self.latency_sigma))
+            throttle = self.random.random() < self.throttle_rate
+            if throttle:
+                self.throttled[api] = self.throttled.get(api, 0) + 1
+
+        time.sleep(latency)
+
+        if throttle:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, api)
+
+        return response
+
+    def index_faces(self, **kwargs):
+        return self._call('IndexFaces', self.faces_response)
+
+    def detect_labels(self, **kwargs):
+        return self._call('DetectLabels', self.labels_response)
+
+
+class WriteCounter:
+    '''
+    Counts the DynamoDB write calls of the handler and estimates the write units they consume.
+    '''
+
+    def __init__(self, client):
+        self.lock = threading.Lock()
+        self.reset()
+        client.meta.events.register_last('before-parameter-build.dynamodb', self.before_parameter_build)
+
+    def reset(self):
+        self.calls = {}
+        self.write_units = 0
+
+    def before_parameter_build(self, params, model, **kwargs):
+        operation = model.name
+        if operation not in ('PutItem', 'UpdateItem', 'BatchWriteItem', 'DeleteItem'):
+            return
+
+        if operation == 'BatchWriteItem':
+            items = [request.get('PutRequest', {}).get('Item', request.get('DeleteRequest', {}).get('Key'))
+                     for requests in params['RequestItems'].values() for request in requests]
+        else:
+            items = [params.get('Item', params.get('Key'))]
+
+        write_units = sum(int(math.ceil(len(json.dumps(item)) / float(WRITE_UNIT_SIZE))) for item in items)
+
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.write_units += write_units
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def frame_body(rnd):
+    if np is None:
+        return 'frame-{}'.format(rnd.random())
+
+    # Noise frames, so no frame is skipped as a duplicate of the previous one
+    pixels = np.random.RandomState(rnd.randint(0, 2 ** 31)).randint(0, 256, (90, 160, 3)).astype(np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def create_tables():
+    dynamodb = boto3.client('dynamodb')
+
+    for table_name, key_names in TABLES.items():
+        dynamodb.create_table(TableName=table_name,
+                              KeySchema=[{'AttributeName': name, 'KeyType': key_type} for name, key_type in zip(key_names, ['HASH', 'RANGE'])],
+                              AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name in key_names],
+                              ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+    boto3.resource('s3').create_bucket(Bucket=os.environ['VIDEO_BUCKET'])
+
+
+def create_video(video_identifier, batch_size, video_length, rnd):
+    bucket = boto3.resource('s3').Bucket(os.environ['VIDEO_BUCKET'])
+    dynamodb = boto3.resource('dynamodb')
+    manifests = []
+
+    for part in range(video_length):
+        frame_keys = []
+        for i in range(batch_size):
+            frame_number = part * batch_size + i
+            frame_keys.append('images/{0}/{0}-{1}.jpg'.format(video_identifier, frame_number))
+            bucket.put_object(Key=frame_keys[-1], Body=frame_body(rnd))
+
+        # moto 1.3.16 doesn't resolve the conditions on the part keys with dots, so the video and the
+        # manifests are named without them and the handler claims and completes its parts for real
+        manifest_key = 'images/{}/part-{}'.format(video_identifier, part)
+        bucket.put_object(Key=manifest_key, Body=' '.join('{}:{}'.format(key, (part * batch_size + i) * 1000) for i, key in enumerate(frame_keys)))
+        manifests.append(manifest_key)
+
+    dynamodb.Table('RVA_PROCESS_TABLE').put_item(Item={
+        'Identifier': video_identifier,
+        'Status': 'PROCESSING',
+        'Parts': dict((manifest_key, 'PENDING') for manifest_key in manifests),
+        'LeaseExpires': {},
+        'Attempts': {},
+        'PendingCount': len(manifests),
+        'ProcessingCount': 0,
+        'CompletedCount': 0
+    })
+
+    dynamodb.Table('RVA_VIDEOS_RESULTS_TABLE').put_item(Item={
+        'Identifier': video_identifier,
+        'FaceDetails': {
+            'Smile': {'Positive': 0, 'Negative': 0},
+            'Eyeglasses': {'Positive': 0, 'Negative': 0},
+            'Sunglasses': {'Positive': 0, 'Negative': 0},
+            'Gender': {'Male': 0, 'Female': 0},
+            'Beard': {'Positive': 0, 'Negative': 0},
+            'Mustache': {'Positive': 0, 'Negative': 0},
+            'EyesOpen': {'Positive': 0, 'Negative': 0},
+            'MouthOpen': {'Positive': 0, 'Negative': 0},
+            'Emotions': {'HAPPY': 0, 'SAD': 0, 'ANGRY': 0, 'DISGUSTED': 0, 'CONFUSED': 0,
+                         'SURPRISED': 0, 'CALM': 0}
+        },
+        'NumberFaceDetails': 0,
+        'DetectedLabels': {},
+        'Individuals': [],
+        'CollectionId': 'RVA-BENCHMARK'
+    })
+
+    return manifests
+
+
+def configure_concurrency(pool_size):
+    # The controllers are bound to the retry decorators at import, so they are updated in place
+    lambda_function.MAX_API_CONCURRENCY = pool_size
+
+    for controller in lambda_function.concurrency_controllers.values():
+        controller.maximum = max(controller.minimum, pool_size)
+        controller.window = float(min(controller.maximum, lambda_function.THREAD_POOL_SIZE))
+        controller.latency_average = None
+        controller.last_decrease = None
+
+
+def run_scenario(rekognition, write_counter, batch_size, pool_size, video_length, rnd):
+    video_identifier = 'benchmark-{}-{}-{}'.format(batch_size, pool_size, video_length)
+    manifests = create_video(video_identifier, batch_size, video_length, rnd)
+
+    configure_concurrency(pool_size)
+    rekognition.reset()
+    write_counter.reset()
+
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.return_value = 300000
+
+    batch_latencies = []
+    start = time.time()
+
+    for manifest_key in manifests:
+        batch_start = time.time()
+        lambda_function.lambda_handler({'Identifier': video_identifier, 'Key': manifest_key}, context)
+        batch_latencies.append(time.time() - batch_start)
+
+    elapsed = time.time() - start
+    frames = batch_size * video_length
+    api_calls = sum(rekognition.calls.values())
+
+    return {
+        'BatchSize': batch_size,
+        'PoolSize': pool_size,
+        'VideoLength': video_length,
+        'Frames': frames,
+        'Seconds': round(elapsed, 3),
+        'FramesPerSecond': round(frames / elapsed, 2),
+        'BatchLatencyP50': round(percentile(batch_latencies, 50), 3),
+        'BatchLatencyP99': round(percentile(batch_latencies, 99), 3),
+        'ApiCalls': dict(rekognition.calls),
+        'ApiCallsThrottled': dict(rekognition.throttled),
+        'ApiCallsPerFrame': round(api_calls / float(frames), 3),
+        'DynamoDBWriteCalls': dict(write_counter.calls),
+        'DynamoDBWriteUnits': write_counter.write_units
+    }
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Throughput benchmark of the frame analysis Lambda')
+    parser.add_argument('--batch-sizes', default='10,50', type=parse_list, help='frames per manifest')
+    parser.add_argument('--pool-sizes', default='4,16', type=parse_list, help='maximum concurrency per API')
+    parser.add_argument('--video-lengths', default='1,4', type=parse_list, help='manifests per video')
+    parser.add_argument('--latency', default=0.05, type=float, help='median Rekognition latency in seconds')
+    parser.add_argument('--latency-sigma', default=0.5, type=float, help='sigma of the lognormal latency')
+    parser.add_argument('--throttle-rate', default=0.0, type=float, help='share of the Rekognition calls throttled')
+    parser.add_argument('--tps', default=0, type=int, help='Rekognition TPS of the client side rate limiter, 0 disables it')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+
+    for api in [rekognition_rate_limiter.API_INDEX_FACES, rekognition_rate_limiter.API_DETECT_LABELS]:
+        os.environ['REKOGNITION_TPS_{}'.format(api.upper())] = str(args.tps)
+    rekognition_rate_limiter.rate_limiters.clear()
+
+    rnd = random.Random(args.seed)
+    rekognition = FakeRekognition(args.latency, args.latency_sigma, args.throttle_rate, args.seed)
+    write_counter = WriteCounter(lambda_function.dynamodb_client.meta.client)
+    create_tables()
+
+    results = []
+
+    # The collection control table is out of the measured path, the status writes of the parts are measured
+    with mock.patch.object(lambda_function, 'rekognition', rekognition), \
+            mock.patch.object(lambda_function, 'update_collection_control'):
+        for batch_size in args.batch_sizes:
+            for pool_size in args.pool_sizes:
+                for video_length in args.video_lengths:
+                    result = run_scenario(rekognition, write_counter, batch_size, pool_size, video_length, rnd)
+                    results.append(result)
+
+                    print("batch: {BatchSize:>5} pool: {PoolSize:>3} length: {VideoLength:>3} | frames/s: {FramesPerSecond:>8} "
+                          "p50: {BatchLatencyP50:>7} s p99: {BatchLatencyP99:>7} s calls/frame: {ApiCallsPerFrame:>6} "
+                          "write units: {DynamoDBWriteUnits:>6}".format(**result))
+
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'Config': {
+                'Latency': args.latency,
+                'LatencySigma': args.latency_sigma,
+                'ThrottleRate': args.throttle_rate,
+                'Tps': args.tps,
+                'Seed': args.seed,
+                'Timestamp': int(time.time())
+            },
+            'Results': results
+        }, output_file, indent=2, sort_keys=True)
+
+    print("Results saved to '{}'".format(args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,149 @@
+from __future__ import print_function
+
+import logging
+
+logger = logging.getLogger()
+
+# numpy is not part of the python2.7 Lambda runtime, build-s3-dist.sh packages its wheel with the
+# function. When it is missing the same columns are reduced in plain Python.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# CONSTANTS
+TYPE_BOOLEAN = 'Boolean'   # {'Value': true/false, 'Confidence': c} counted as Positive/Negative
+TYPE_GENDER = 'Gender'     # {'Value': state, 'Confidence': c} counted by value
+TYPE_EMOTIONS = 'Emotions' # [{'Type': state, 'Confidence': c}, ...] counted by the most confident type
+TYPE_RANGE = 'Range'       # {'Low': l, 'High': h} middle value counted in the bucket it falls in
+
+BOOLEAN_STATES = ['Positive', 'Negative']
+
+# Attributes summarized for every face. Adding an attribute only needs an entry here, 'Edges' are
+# the lower bounds of the buckets after the first one for the Range type, e.g.
+# {'Name': 'AgeRange', 'Type': TYPE_RANGE, 'States': ['0-17', '18-34', '35-54', '55+'], 'Edges': [18, 35, 55]}
+FACE_ATTRIBUTES = [
+    {'Name': 'Eyeglasses', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'Sunglasses', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'EyesOpen', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'Smile', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'MouthOpen', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'Mustache', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'Beard', 'Type': TYPE_BOOLEAN, 'States': BOOLEAN_STATES},
+    {'Name': 'Gender', 'Type': TYPE_GENDER, 'States': ['Male', 'Female']},
+    {'Name': 'Emotions', 'Type': TYPE_EMOTIONS, 'States': ['HAPPY', 'SURPRISED', 'DISGUSTED', 'ANGRY', 'SAD', 'CONFUSED', 'CALM']}
+]
+
+
+class FaceSummary:
+    '''
+    Columnar aggregation of the FaceDetails of a batch.
+
+    The FaceDetails are read into one column per attribute (the confidence and the state code of
+    every face, or a confidence matrix for the Emotions), each array of a column built at once with
+    numpy.fromiter, and every histogram is then computed with masked reductions over the whole column.
+    '''
+
+    def __init__(self, face_confidence, attribute_confidence, attributes=FACE_ATTRIBUTES):
+        self.face_confidence = face_confidence
+        self.attribute_confidence = attribute_confidence
+        self.attributes = attributes
+
+    def _column(self, attribute, face_details):
+        # The values of every face are extracted in bulk, one numpy.fromiter per array of the column
+        states = attribute['States']
+        values = [face_detail.get(attribute['Name']) for face_detail in face_details]
+
+        if np is None:
+            array = lambda items, dtype: list(items)
+        else:
+            array = lambda items, dtype: np.fromiter(items, np.dtype(dtype), count=len(values))
+
+        if attribute['Type'] == TYPE_EMOTIONS:
+            # One confidence per state plus a last one for the types we don't count, from the flattened
+            # (face, state, confidence) of every element
+            codes = dict((state, i) for i, state in enumerate(states))
+            elements = [(face, codes.get(element['Type'], len(states)), element['Confidence'])
+                        for face, value in enumerate(values) for element in value or []]
+
+            if np is None:
+                rows = [[0.0] * (len(states) + 1) for _ in values]
+                for face, i, confidence in elements:
+                    rows[face][i] = max(rows[face][i], confidence)
+                return {'Confidence': rows, 'Codes': []}
+
+            rows = np.zeros((len(values), len(states) + 1), dtype=np.float64)
+            if elements:
+                flat = np.fromiter((field for element in elements for field in element), np.float64, count=3 * len(elements)).reshape(-1, 3)
+                np.maximum.at(rows, (flat[:, 0].astype(np.int64), flat[:, 1].astype(np.int64)), flat[:, 2])
+            return {'Confidence': rows, 'Codes': []}
+
+        if attribute['Type'] == TYPE_RANGE:
+            return {'Confidence': array((100.0 if value else 0.0 for value in values), 'float64'),
+                    'Codes': array(((value['Low'] + value['High']) / 2.0 if value else 0.0 for value in values), 'float64')}
+
+        codes = {True: 0, False: 1} if attribute['Type'] == TYPE_BOOLEAN else dict((state, i) for i, state in enumerate(states))
+
+        return {'Confidence': array((value['Confidence'] if value else 0.0 for value in values), 'float64'),
+                'Codes': array((codes.get(value['Value'], -1) if value else -1 for value in values), 'int64')}
+
+    def _histogram(self, attribute, column):
+        states = attribute['States']
+
+        if np is None:
+            return self._histogram_python(attribute, column)
+
+        confidence = np.asarray(column['Confidence'], dtype=np.float64)
+
+        if attribute['Type'] == TYPE_EMOTIONS:
+            confidence = confidence.reshape(-1, len(states) + 1)
+            codes = confidence.argmax(axis=1)
+            mask = (confidence.max(axis=1) > self.attribute_confidence) & (codes < len(states))
+        elif attribute['Type'] == TYPE_RANGE:
+            codes = np.digitize(np.asarray(column['Codes'], dtype=np.float64), attribute['Edges'])
+            mask = confidence > 0
+        else:
+            codes = np.asarray(column['Codes'], dtype=np.int64)
+            mask = (confidence > self.attribute_confidence) & (codes >= 0)
+
+        counts = np.bincount(codes[mask], minlength=len(states))
+
+        return dict((state, int(count)) for state, count in zip(states, counts))
+
+    def _histogram_python(self, attribute, column):
+        states = attribute['States']
+        counts = [0] * len(states)
+
+        if attribute['Type'] == TYPE_EMOTIONS:
+            for row in column['Confidence']:
+                i = row.index(max(row))
+                if row[i] > self.attribute_confidence and i < len(states):
+                    counts[i] += 1
+        elif attribute['Type'] == TYPE_RANGE:
+            for confidence, value in zip(column['Confidence'], column['Codes']):
+                if confidence > 0:
+                    counts[sum(1 for edge in attribute['Edges'] if value >= edge)] += 1
+        else:
+            for confidence, code in zip(column['Confidence'], column['Codes']):
+                if confidence > self.attribute_confidence and code >= 0:
+                    counts[code] += 1
+
+        return dict(zip(states, counts))
+
+    def summarize(self, face_records):
+        '''
+        Returns the list of attribute summaries ({'Name', 'Type', <state>: count}) and the number of
+        faces counted.
+        '''
+        face_details = [face_record['FaceDetail'] for face_record in face_records
+                        if face_record['FaceDetail']['Confidence'] > self.face_confidence]
+
+        list_fd_attr = []
+
+        for attribute in self.attributes:
+            column = self._column(attribute, face_details)
+            summary = {'Name': attribute['Name'], 'Type': attribute['Type']}
+            summary.update(self._histogram(attribute, column) if face_details else dict((state, 0) for state in attribute['States']))
+            list_fd_attr.append(summary)
+
+        return list_fd_attr, len(face_details)
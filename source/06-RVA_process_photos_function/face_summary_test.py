@@ -0,0 +1,111 @@
+import unittest
+import json
+import mock
+import random
+import logging
+
+import face_summary
+from face_summary import FaceSummary, FACE_ATTRIBUTES, TYPE_RANGE
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+EMOTIONS = ['HAPPY', 'SURPRISED', 'DISGUSTED', 'ANGRY', 'SAD', 'CONFUSED', 'CALM', 'UNKNOWN']
+
+
+def random_face_record(rnd):
+    face_detail = {'Confidence': rnd.uniform(80, 100)}
+
+    for name in ['Eyeglasses', 'Sunglasses', 'EyesOpen', 'Smile', 'MouthOpen', 'Mustache', 'Beard']:
+        face_detail[name] = {'Confidence': rnd.uniform(80, 100), 'Value': rnd.random() > 0.5}
+    face_detail['Gender'] = {'Confidence': rnd.uniform(80, 100), 'Value': rnd.choice(['Male', 'Female'])}
+
+    confidences = [rnd.random() ** 4 for _ in range(3)]
+    face_detail['Emotions'] = [{'Type': emotion, 'Confidence': 100 * c / sum(confidences)}
+                               for emotion, c in zip(rnd.sample(EMOTIONS, 3), confidences)]
+
+    low = rnd.randint(0, 70)
+    face_detail['AgeRange'] = {'Low': low, 'High': low + rnd.randint(0, 15)}
+
+    return {'FaceDetail': face_detail}
+
+
+def expected_summary(face_records):
+    # Counts one face at a time, the way the summary was computed before the columnar engine
+    summaries = [dict([('Name', a['Name']), ('Type', a['Type'])] + [(state, 0) for state in a['States']]) for a in FACE_ATTRIBUTES]
+    faces = 0
+
+    for face_record in face_records:
+        face_detail = face_record['FaceDetail']
+        if face_detail['Confidence'] <= 95:
+            continue
+        faces += 1
+
+        for summary in summaries[:7]:
+            if face_detail[summary['Name']]['Confidence'] > 90:
+                summary['Positive' if face_detail[summary['Name']]['Value'] else 'Negative'] += 1
+        if face_detail['Gender']['Confidence'] > 90:
+            summaries[7][face_detail['Gender']['Value']] += 1
+
+        best = max(face_detail['Emotions'], key=lambda element: element['Confidence'])
+        if best['Confidence'] > 90 and best['Type'] in summaries[8]:
+            summaries[8][best['Type']] += 1
+
+    return summaries, faces
+
+
+class TestFaceSummary(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(42)
+        self.face_records = [random_face_record(rnd) for _ in range(2000)]
+
+    def test_matches_per_face_counts(self):
+        summary, faces = FaceSummary(95, 90).summarize(self.face_records)
+
+        self.assertEqual(expected_summary(self.face_records), (summary, faces))
+
+    @mock.patch('face_summary.np', None)
+    def test_python_fallback_matches(self):
+        summary, faces = FaceSummary(95, 90).summarize(self.face_records)
+
+        self.assertEqual(expected_summary(self.face_records), (summary, faces))
+
+    def test_sample_face(self):
+        with open('./faces.json') as faces_file:
+            face_records = json.load(faces_file)['FaceRecords']
+
+        summary, faces = FaceSummary(95, 90).summarize(face_records)
+        summary = dict((item['Name'], item) for item in summary)
+
+        self.assertEqual(1, faces)
+        self.assertEqual(1, summary['Gender']['Male'])
+        self.assertEqual(1, summary['Smile']['Positive'])
+        self.assertEqual(0, summary['Sunglasses']['Positive'] + summary['Sunglasses']['Negative'])
+        self.assertEqual(1, summary['Emotions']['HAPPY'])
+
+    def test_no_faces(self):
+        summary, faces = FaceSummary(95, 90).summarize([])
+
+        self.assertEqual(0, faces)
+        self.assertEqual(len(FACE_ATTRIBUTES), len(summary))
+        self.assertEqual(0, summary[0]['Positive'])
+
+    def test_new_attribute_only_needs_table_entry(self):
+        age_range = {'Name': 'AgeRange', 'Type': TYPE_RANGE, 'States': ['0-17', '18-34', '35-54', '55+'], 'Edges': [18, 35, 55]}
+        expected = {'0-17': 0, '18-34': 0, '35-54': 0, '55+': 0}
+        for face_record in self.face_records:
+            if face_record['FaceDetail']['Confidence'] > 95:
+                middle = (face_record['FaceDetail']['AgeRange']['Low'] + face_record['FaceDetail']['AgeRange']['High']) / 2.0
+                expected[age_range['States'][sum(1 for edge in age_range['Edges'] if middle >= edge)]] += 1
+
+        for np in [face_summary.np, None]:
+            with mock.patch('face_summary.np', np):
+                summary, faces = FaceSummary(95, 90, FACE_ATTRIBUTES + [age_range]).summarize(self.face_records)
+
+            self.assertEqual(dict(expected, Name='AgeRange', Type=TYPE_RANGE), summary[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+from __future__ import print_function
+
+import io
+import logging
+import sys, traceback
+
+logger = logging.getLogger()
+
+# numpy and Pillow are not part of the python2.7 Lambda runtime, build-s3-dist.sh packages their
+# wheels with the function. When they are missing the dedup stage is disabled and every frame is
+# sent to Rekognition.
+try:
+    import numpy as np
+    from PIL import Image
+    DEDUP_AVAILABLE = True
+except ImportError:
+    np = None
+    Image = None
+    DEDUP_AVAILABLE = False
+
+# CONSTANTS
+DEFAULT_HASH_SIZE = 8
+DEFAULT_HAMMING_THRESHOLD = 5
+DEDUP_WINDOW = 32 # frames compared against the kept frame per vectorized step
+IMAGE_BYTES_MAX = 5 * 1024 * 1024 # largest image Rekognition accepts in the request itself
+
+
+class FrameDeduplicator:
+    '''
+    Perceptual hash (dHash) based frame deduplication.
+
+    Every frame is read once from S3, reduced to a (hash_size x hash_size) bit matrix and compared
+    against the last frame that was kept. Frames whose Hamming distance to it is below the threshold
+    are reported as duplicates so their Rekognition results can be reused. The bytes read are kept in
+    images, up to the size Rekognition accepts, so the frames analyzed are not read from S3 again.
+    '''
+
+    s3_client = None
+    threshold = DEFAULT_HAMMING_THRESHOLD
+    hash_size = DEFAULT_HASH_SIZE
+    frames_skipped = 0
+
+    def __init__(self, s3_client, threshold=DEFAULT_HAMMING_THRESHOLD, hash_size=DEFAULT_HASH_SIZE):
+        self.s3_client = s3_client
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.frames_skipped = 0
+        self.images = {}
+
+    def enabled(self):
+        return DEDUP_AVAILABLE and self.threshold > 0
+
+    def dhash(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes)).convert('L')
+        image = image.resize((self.hash_size + 1, self.hash_size), Image.ANTIALIAS)
+        pixels = np.asarray(image, dtype=np.int16)
+
+        return (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    def hash_frame(self, params):
+        #Unpacking params to support ThreadPools
+        bucket = params[0]
+        key = params[1]
+
+        try:
+            contents = self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            if len(contents) <= IMAGE_BYTES_MAX:
+                self.images[key] = contents
+
+            return self.dhash(contents)
+        except Exception as e:
+            logger.error("hash_frame - error hashing file. Bucket: '{}' Key: '{}'".format(bucket, key))
+            logger.error(e)
+            logger.error('-' * 60)
+            traceback.print_exc(file=sys.stdout)
+            logger.error('-' * 60)
+
+        return None
+
+    def hash_frames(self, bucket, keys, pool):
+        return pool.map(self.hash_frame, [(bucket, key) for key in keys])
+
+    def find_duplicates(self, keys, hashes):
+        '''
+        Returns a dict mapping every duplicated key to the key of the kept frame it matches.
+        Frames that could not be hashed are always kept.
+        '''
+        duplicates = {}
+
+        if not self.enabled() or not keys:
+            return duplicates
+
+        valid = np.array([h is not None for h in hashes], dtype=bool)
+        bits = np.zeros((len(keys), self.hash_size * self.hash_size), dtype=bool)
+        for i, h in enumerate(hashes):
+            if h is not None:
+                bits[i] = h
+
+        # Compare the kept frame against a window of the frames after it at once. The run of duplicates
+        # ends at the first frame that is too far away (or could not be hashed), which becomes the next kept frame.
+        kept_index = 0
+        start = 1
+        while start < len(keys):
+            end = min(len(keys), start + DEDUP_WINDOW)
+            if valid[kept_index]:
+                distances = np.count_nonzero(bits[start:end] != bits[kept_index], axis=1)
+                is_duplicate = valid[start:end] & (distances < self.threshold)
+            else:
+                is_duplicate = np.zeros(end - start, dtype=bool)
+
+            run_length = len(is_duplicate) if is_duplicate.all() else int(np.argmin(is_duplicate))
+            for i in range(start, start + run_length):
+                duplicates[keys[i]] = keys[kept_index]
+
+            if run_length == len(is_duplicate):
+                start = end
+            else:
+                kept_index = start + run_length
+                start = kept_index + 1
+
+        self.frames_skipped += len(duplicates)
+        logger.debug("find_duplicates - duplicates: '{}'".format(duplicates))
+
+        return duplicates
+
+    def dedup(self, bucket, keys, pool):
+        if not self.enabled():
+            return {}
+
+        return self.find_duplicates(keys, self.hash_frames(bucket, keys, pool))
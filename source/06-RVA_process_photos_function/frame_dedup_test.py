@@ -0,0 +1,101 @@
+import unittest
+import io
+import boto3
+import logging
+import mock
+from multiprocessing.dummy import Pool
+
+import numpy as np
+from PIL import Image
+from moto import mock_s3
+
+from frame_dedup import FrameDeduplicator
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+# CONSTANTS
+TEST_BUCKET = 'deep-west-video-rekognition-video'
+
+
+class TestFrameDeduplicator(unittest.TestCase):
+
+    def test_find_duplicates_against_kept_frame(self):
+        fd = FrameDeduplicator(None, threshold=5, hash_size=8)
+        base = np.zeros(64, dtype=bool)
+        near = base.copy()
+        near[:3] = True
+        far = ~base
+
+        keys = ['f1', 'f2', 'f3', 'f4', 'f5']
+        duplicates = fd.find_duplicates(keys, [base, near, far, far, base])
+
+        self.assertEqual({'f2': 'f1', 'f4': 'f3'}, duplicates)
+        self.assertEqual(2, fd.frames_skipped)
+
+    def test_unhashed_frames_are_kept(self):
+        fd = FrameDeduplicator(None, threshold=5, hash_size=8)
+        base = np.zeros(64, dtype=bool)
+
+        duplicates = fd.find_duplicates(['f1', 'f2', 'f3'], [base, None, base])
+
+        self.assertEqual({}, duplicates)
+
+    def test_long_static_shot(self):
+        fd = FrameDeduplicator(None, threshold=5, hash_size=8)
+        base = np.zeros(64, dtype=bool)
+        keys = ['f{}'.format(i) for i in range(100)]
+
+        duplicates = fd.find_duplicates(keys, [base] * 100)
+
+        self.assertEqual(99, len(duplicates))
+        self.assertEqual(set(['f0']), set(duplicates.values()))
+
+    def test_threshold_zero_disables_dedup(self):
+        fd = FrameDeduplicator(None, threshold=0)
+        base = np.zeros(64, dtype=bool)
+
+        self.assertEqual({}, fd.find_duplicates(['f1', 'f2'], [base, base]))
+
+    @mock_s3
+    def test_dedup_reads_frames_from_s3(self):
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=TEST_BUCKET)
+
+        gradient = np.tile(np.arange(0, 256, 4, dtype=np.uint8), (64, 1))
+        frames = {
+            'images/video.mp4/video.mp4-1.jpg': gradient,
+            'images/video.mp4/video.mp4-2.jpg': gradient,
+            'images/video.mp4/video.mp4-3.jpg': gradient[:, ::-1].copy(),
+        }
+        for key, pixels in frames.items():
+            s3.Object(TEST_BUCKET, key).put(Body=to_jpeg(pixels))
+
+        fd = FrameDeduplicator(boto3.client('s3', region_name='us-east-1'))
+        pool = Pool(2)
+        duplicates = fd.dedup(TEST_BUCKET, sorted(frames.keys()), pool)
+        pool.close()
+        pool.join()
+
+        self.assertEqual({'images/video.mp4/video.mp4-2.jpg': 'images/video.mp4/video.mp4-1.jpg'}, duplicates)
+
+        # The frames read are kept for the Rekognition calls, unless they are too large to be sent
+        self.assertEqual(dict((key, to_jpeg(pixels)) for key, pixels in frames.items()), fd.images)
+
+        with mock.patch('frame_dedup.IMAGE_BYTES_MAX', 10):
+            fd = FrameDeduplicator(boto3.client('s3', region_name='us-east-1'))
+            self.assertIsNotNone(fd.hash_frame((TEST_BUCKET, 'images/video.mp4/video.mp4-1.jpg')))
+            self.assertEqual({}, fd.images)
+
+
+def to_jpeg(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG')
+    return output.getvalue()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+from __future__ import print_function
+
+import json
+import logging
+
+logger = logging.getLogger()
+
+# CONSTANTS
+OUTPUT_MODE_FRAME = 'frame' # one JSON object per frame with faces
+OUTPUT_MODE_BATCH = 'batch' # one JSON Lines object per manifest batch
+
+
+class FrameResultsFile:
+    '''
+    JSON Lines object with the face records of every frame of a batch.
+
+    Each line holds one frame and its offset and length in bytes are kept as the index, so a single
+    frame can be read back with a ranged GET and the whole batch with a plain GET.
+    '''
+
+    def __init__(self):
+        self.lines = []
+        self.size = 0
+        self.index = {}
+
+    def add(self, key, timestamp, face_records):
+        line = json.dumps({'Key': key, 'Time': timestamp, 'FaceRecords': face_records}, separators=(',', ':')) + '\n'
+
+        self.index[key] = (self.size, len(line))
+        self.lines.append(line)
+        self.size += len(line)
+
+        return self.index[key]
+
+    def body(self):
+        return ''.join(self.lines)
+
+
+def read_frame_results(s3_client, bucket, object_path, offset, length):
+    '''
+    Returns the face records of one frame stored in a FrameResultsFile.
+    '''
+    response = s3_client.get_object(Bucket=bucket, Key=object_path, Range='bytes={}-{}'.format(offset, offset + length - 1))
+
+    return json.loads(response['Body'].read())['FaceRecords']
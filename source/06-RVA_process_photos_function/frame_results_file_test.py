@@ -0,0 +1,51 @@
+import unittest
+import json
+import boto3
+import logging
+
+from moto import mock_s3
+
+from frame_results_file import FrameResultsFile, read_frame_results
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+BUCKET = 'deep-west-video-rekognition-video'
+
+
+class TestFrameResultsFile(unittest.TestCase):
+
+    def test_index_points_to_each_line(self):
+        results_file = FrameResultsFile()
+        first = results_file.add('video.mp4-1.jpg', '0', [{'Face': {'FaceId': '1'}}])
+        second = results_file.add('video.mp4-2.jpg', '1000', [{'Face': {'FaceId': '2'}}, {'Face': {'FaceId': '3'}}])
+
+        body = results_file.body()
+
+        self.assertEqual(0, first[0])
+        self.assertEqual(first[1], second[0])
+        self.assertEqual(len(body), second[0] + second[1])
+        self.assertEqual(2, len(json.loads(body[second[0]:second[0] + second[1]])['FaceRecords']))
+        self.assertEqual(2, len(body.splitlines()))
+
+    @mock_s3
+    def test_ranged_read(self):
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BUCKET)
+
+        results_file = FrameResultsFile()
+        for i in range(10):
+            results_file.add('video.mp4-{}.jpg'.format(i), str(i * 1000), [{'Face': {'FaceId': str(i)}}])
+        s3_client.put_object(Bucket=BUCKET, Key='results/batches/video.mp4/batch.txt.jsonl', Body=results_file.body())
+
+        offset, length = results_file.index['video.mp4-7.jpg']
+        face_records = read_frame_results(s3_client, BUCKET, 'results/batches/video.mp4/batch.txt.jsonl', offset, length)
+
+        self.assertEqual([{'Face': {'FaceId': '7'}}], face_records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,8 +15,19 @@ import logging
 import time
 import base64
 from multiprocessing.dummy import Pool
-from functools import wraps
+from functools import wraps, partial
 from rekog_collection_controller import RekognitionCollectionController
+from rekognition_rate_limiter import rate_limited, API_INDEX_FACES, API_DETECT_LABELS
+from frame_dedup import FrameDeduplicator, DEFAULT_HAMMING_THRESHOLD
+from batch_context import BatchContext
+from task_scheduler import TaskScheduler
+from adaptive_concurrency import AIMDController, reports_latency
+from batch_writer import BatchWriter, DEFAULT_FLUSH_SIZE
+from frame_results_file import FrameResultsFile, OUTPUT_MODE_FRAME, OUTPUT_MODE_BATCH
+from face_summary import FaceSummary
+from update_expression import CounterUpdateBuilder
+from parts_job import PartsJob
+from part_tracking import PartTracker, write_transaction
 
 # Lambda Variables
 LOG_LEVEL = str(os.environ.get('LOG_LEVEL', 'INFO')).upper()
@@ -39,37 +50,59 @@ DETECT_LABELS_MAX_NUMBER = 10
 MAX_BACKOFF = 15 # seconds
 MAX_RETRIES = 5
 THREAD_POOL_SIZE = 4
+API_REUSE_RESULTS = 'ReuseResults'
+DISPATCH_MODE_STREAM = 'stream' # one invocation per part, started by the stream function
+DISPATCH_MODE_WORKER = 'worker' # every invocation keeps claiming pending parts
+CLAIM_CANDIDATES = 10
+MARKER_TTL_SECONDS = 7 * 24 * 3600 # markers of the batches added to the video results, kept while a batch can be delivered again
 RETRY_EXCEPTIONS = ('ProvisionedThroughputExceededException',
                     'ThrottlingException',
                     'ResourceNotFoundException') # Collection not found
+THROTTLING_EXCEPTIONS = ('ProvisionedThroughputExceededException',
+                         'ThrottlingException')
 
 
-# GLOBAL VARIABLES
-video_identifier = ''
-faces_indexed = 0
-detect_labels_results = {}
-detect_faces_results = {}
-
 # LAMBDA VARIABLES
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 VIDEO_BUCKET = os.environ['VIDEO_BUCKET']
+FRAME_DEDUP_THRESHOLD = int(os.getenv('FRAME_DEDUP_THRESHOLD', DEFAULT_HAMMING_THRESHOLD)) # 0 disables frame dedup
+INDEX_FACES_CONCURRENCY = int(os.getenv('INDEX_FACES_CONCURRENCY', THREAD_POOL_SIZE))
+DETECT_LABELS_CONCURRENCY = int(os.getenv('DETECT_LABELS_CONCURRENCY', THREAD_POOL_SIZE))
+MIN_API_CONCURRENCY = int(os.getenv('MIN_API_CONCURRENCY', 1))
+MAX_API_CONCURRENCY = int(os.getenv('MAX_API_CONCURRENCY', 16))
+BATCH_WRITE_FLUSH_SIZE = int(os.getenv('BATCH_WRITE_FLUSH_SIZE', DEFAULT_FLUSH_SIZE))
+FRAME_RESULTS_OUTPUT = os.getenv('FRAME_RESULTS_OUTPUT', OUTPUT_MODE_FRAME) # 'frame' or 'batch'
+RVA_PROCESS_PARTS_TABLE = os.getenv('RVA_PROCESS_PARTS_TABLE', 'RVA_PROCESS_PARTS_TABLE')
+RVA_VIDEOS_RESULTS_MARKERS_TABLE = os.getenv('RVA_VIDEOS_RESULTS_MARKERS_TABLE', 'RVA_VIDEOS_RESULTS_MARKERS_TABLE')
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', DISPATCH_MODE_STREAM)
+DISPATCH_MIN_REMAINING_MS = int(os.getenv('DISPATCH_MIN_REMAINING_MS', 60000)) # time left needed to claim another part
+PART_LEASE_SECONDS = int(os.getenv('PART_LEASE_SECONDS', 360)) # a part not completed by then is given to another invocation
 
 # SERVICES
 rekognition = boto3.client('rekognition', region_name=os.environ['AWS_DEFAULT_REGION'], config=Config(max_pool_connections=30))
 s3_client = boto3.client('s3')
+lambda_client = boto3.client('lambda')
 s3_resource = boto3.resource('s3')
 dynamodb_client = boto3.resource('dynamodb', config=Config(max_pool_connections=30))
 process_table = dynamodb_client.Table('RVA_PROCESS_TABLE')
 frames_results_table = dynamodb_client.Table('RVA_FRAMES_RESULTS_TABLE')
 videos_results_table = dynamodb_client.Table('RVA_VIDEOS_RESULTS_TABLE')
 videos_labels_table  = dynamodb_client.Table('RVA_VIDEOS_LABELS_TABLE')
+part_tracker = PartTracker(boto3.client('dynamodb'), process_table.table_name, RVA_PROCESS_PARTS_TABLE)
+
+
+# Concurrency of each API, kept between batches handled by the same container
+concurrency_controllers = {
+    API_INDEX_FACES: AIMDController(API_INDEX_FACES, INDEX_FACES_CONCURRENCY, MIN_API_CONCURRENCY, MAX_API_CONCURRENCY),
+    API_DETECT_LABELS: AIMDController(API_DETECT_LABELS, DETECT_LABELS_CONCURRENCY, MIN_API_CONCURRENCY, MAX_API_CONCURRENCY)
+}
 
 
 if LOG_LEVEL == 'DEBUG':
     logger.setLevel(logging.DEBUG)
 
 # --------------- Retry decorator
-def retry(ExceptionToCheck=RETRY_EXCEPTIONS, tries=5, max_backoff=MAX_BACKOFF, logger=None):
+def retry(ExceptionToCheck=RETRY_EXCEPTIONS, tries=5, max_backoff=MAX_BACKOFF, logger=None, on_throttle=None):
     def decorator_retry(f):
 
         @wraps(f)
@@ -92,6 +125,9 @@ def retry(ExceptionToCheck=RETRY_EXCEPTIONS, tries=5, max_backoff=MAX_BACKOFF, l
                             print(err)
                         raise err
 
+                    if on_throttle and err.response['Error']['Code'] in THROTTLING_EXCEPTIONS:
+                        on_throttle()
+
                     temp = min(max_backoff, 2 ** mtries)
                     sleep = temp / float(2) + random.uniform(0, temp / float(2))
 
@@ -113,12 +149,24 @@ def retry(ExceptionToCheck=RETRY_EXCEPTIONS, tries=5, max_backoff=MAX_BACKOFF, l
 
     return decorator_retry
 
-# --------------- Helper Functions to call Rekognition APIs ------------------
+# --------------- Helper Functions to call DynamoDB APIs ------------------
 
 @retry(RETRY_EXCEPTIONS, 5, MAX_BACKOFF, logger)
-def index_faces_call(bucket, key, video_identifier, coll_id):
+def batch_write_item_call(request_items):
+    return dynamodb_client.batch_write_item(RequestItems=request_items)
+
+
+def new_results_writer():
+    return BatchWriter(batch_write_item_call, BATCH_WRITE_FLUSH_SIZE)
+
+# --------------- Helper Functions to call Rekognition APIs ------------------
+
+@retry(RETRY_EXCEPTIONS, 5, MAX_BACKOFF, logger, concurrency_controllers[API_INDEX_FACES].on_throttle)
+@rate_limited(API_INDEX_FACES)
+@reports_latency(concurrency_controllers[API_INDEX_FACES])
+def index_faces_call(image, key, video_identifier, coll_id):
     response = rekognition.index_faces(
-        Image={"S3Object": {"Bucket": bucket, "Name": key}},
+        Image=image,
         CollectionId=coll_id,
         DetectionAttributes=["ALL", "DEFAULT"],
         ExternalImageId=extract_object_key(key)
@@ -127,20 +175,19 @@ def index_faces_call(bucket, key, video_identifier, coll_id):
     return response
 
 
-@retry(RETRY_EXCEPTIONS, 5, MAX_BACKOFF, logger)
-def detect_labels_call(bucket, key, threshold_detectlabels_attributes_confidence, detect_labels_max_number):
+@retry(RETRY_EXCEPTIONS, 5, MAX_BACKOFF, logger, concurrency_controllers[API_DETECT_LABELS].on_throttle)
+@rate_limited(API_DETECT_LABELS)
+@reports_latency(concurrency_controllers[API_DETECT_LABELS])
+def detect_labels_call(image, threshold_detectlabels_attributes_confidence, detect_labels_max_number):
 
-    response = rekognition.detect_labels(Image={"S3Object": {"Bucket": bucket, "Name": key}},
+    response = rekognition.detect_labels(Image=image,
         MinConfidence=threshold_detectlabels_attributes_confidence,
         MaxLabels=detect_labels_max_number)
 
     return response
 
 
-def detect_faces(params):
-    global faces_indexed
-    global detect_faces_results
-
+def detect_faces(batch_context, params):
     #Unpacking params to support ThreadPools
     bucket = params[0]
     key = params[1]
@@ -150,36 +197,29 @@ def detect_faces(params):
     try:
         logger.debug("detect_faces: threadname: '{}' bucket: '{}' key: '{}' CollId:'{}'".format(threading.currentThread().getName(), bucket, key, coll_id))
 
-        response = index_faces_call(bucket, key, video_identifier, coll_id)
+        response = index_faces_call(batch_context.image(bucket, key), key, batch_context.video_identifier, coll_id)
 
         if 'FaceRecords' in response:
-            req_id = response['ResponseMetadata']['RequestId']
-            detect_faces_results[req_id] = response['FaceRecords']
+            batch_context.set_faces_result(key, response['FaceRecords'])
 
             faces_found = len(response['FaceRecords'])
-            faces_indexed += faces_found
+            batch_context.add_faces_indexed(faces_found)
 
             logger.debug("Faces found on the frame: '{}'".format(faces_found))
 
             # Let's check whether or not we have found faces in this picture, otherwise it wouldn't
-            # make any sense to waste our resources to persist it.
-            if faces_found > 0:
+            # make any sense to waste our resources to persist it. In batch output mode the results
+            # of all the frames are persisted together once the batch ends.
+            if faces_found > 0 and FRAME_RESULTS_OUTPUT == OUTPUT_MODE_FRAME:
                 # response_dynamodb_ready = json.loads(json.dumps(response), parse_float=Decimal)
                 object_name = extract_object_key(key)
 
-                object_path = "results/frames/{}/{}.json".format(str(video_identifier), str(object_name))
+                object_path = "results/frames/{}/{}.json".format(str(batch_context.video_identifier), str(object_name))
                 object_body = json.dumps(response['FaceRecords']) #, parse_float=Decimal)
 
                 saveObject = s3_resource.Object(bucket, object_path).put(Body=object_body,ServerSideEncryption='AES256')
 
-                frames_results_table.put_item(
-                    Item = {
-                        'Identifier': video_identifier,
-                        'Key': extract_object_key(key),
-                        'S3Path': "s3://{}/{}".format(bucket, object_path),
-                        'Time': timestamp
-                    }
-                )
+                store_frame_results(batch_context, key, timestamp, "s3://{}/{}".format(bucket, object_path))
     except Exception as e:
         logger.error("detect_faces - error processing file. Bucket: '{}' Key: '{}'".format(bucket, key))
         logger.error(e)
@@ -187,28 +227,71 @@ def detect_faces(params):
         traceback.print_exc(file=sys.stdout)
         logger.error('-' * 60)
 
+    return batch_context.get_faces_result(key)
 
-def store_labels_detected(key, timestamp, labels):
 
-    if labels:
-        logger.debug("Inserting labels... Key: '{}' Time: '{}' Labels: '{}' video_identifier: '{}'".format(key, timestamp, labels, video_identifier))
+def store_frame_results(batch_context, key, timestamp, s3_path):
+    batch_context.results_writer.put(frames_results_table.name, {
+        'Identifier': batch_context.video_identifier,
+        'Key': extract_object_key(key),
+        'S3Path': s3_path,
+        'Time': timestamp
+    })
+
+
+def store_batch_frame_results(batch_context, bucket, key, duplicates):
+    '''
+    Writes the face records of all the frames of the batch to one JSON Lines object. The frame results
+    rows point to the line of each frame, duplicated frames to the line of the frame they reuse.
+    '''
+    results_file = FrameResultsFile()
+    object_path = "results/batches/{}/{}.jsonl".format(str(batch_context.video_identifier), str(extract_object_key(key)))
+
+    for image_file, timestamp in batch_context.frames:
+        face_records = batch_context.get_faces_result(image_file)
+        if face_records and image_file not in duplicates:
+            results_file.add(extract_object_key(image_file), timestamp, face_records)
+
+    if not results_file.index:
+        return
+
+    s3_resource.Object(bucket, object_path).put(Body=results_file.body(), ServerSideEncryption='AES256')
+
+    for image_file, timestamp in batch_context.frames:
+        original_key = extract_object_key(duplicates.get(image_file, image_file))
+        if original_key in results_file.index and batch_context.get_faces_result(image_file):
+            offset, length = results_file.index[original_key]
+            batch_context.results_writer.put(frames_results_table.name, {
+                'Identifier': batch_context.video_identifier,
+                'Key': extract_object_key(image_file),
+                'S3Path': "s3://{}/{}".format(bucket, object_path),
+                'Offset': offset,
+                'Length': length,
+                'Time': timestamp
+            })
 
-        response_dynamodb_ready = json.loads(json.dumps(labels))
+    logger.debug("Batch frame results written: '{}' Frames: '{}' Size: '{}'".format(object_path, len(results_file.index), results_file.size))
 
-        videos_labels_table.update_item(
-            Key={'Identifier': video_identifier, 'Key': extract_object_key(key)},
-            UpdateExpression='SET #labels = :val1, #timestamp = :val2',
-            ExpressionAttributeNames={'#labels': 'Labels', '#timestamp': 'Time'},
-            ExpressionAttributeValues={':val1': labels, ':val2': timestamp})
 
+def store_labels_detected(batch_context, key, timestamp, labels):
 
-def detect_labels(params):
+    if labels:
+        logger.debug("Inserting labels... Key: '{}' Time: '{}' Labels: '{}' video_identifier: '{}'".format(key, timestamp, labels, batch_context.video_identifier))
+
+        batch_context.results_writer.put(videos_labels_table.name, {
+            'Identifier': batch_context.video_identifier,
+            'Key': extract_object_key(key),
+            'Labels': labels,
+            'Time': timestamp
+        })
+
+
+def detect_labels(batch_context, params):
     #Unpacking params to support ThreadPool
     bucket = params[0]
     key = params[1]
     timestamp = params[2]
 
-    global detect_labels_results
     update_expression_str_list = []
     expression_attr_values_dict = {}
     expression_attr_names_dict = {}
@@ -218,18 +301,17 @@ def detect_labels(params):
         logger.debug(
             'detect_labels: threadname: "{}" bucket: "{}" key: "{}"'.format(threading.currentThread().getName(), bucket, key))
 
-        response = detect_labels_call(bucket, key, THRESHOLD_DETECTLABELS_ATTRIBUTES_CONFIDENCE, DETECT_LABELS_MAX_NUMBER)
+        response = detect_labels_call(batch_context.image(bucket, key), THRESHOLD_DETECTLABELS_ATTRIBUTES_CONFIDENCE, DETECT_LABELS_MAX_NUMBER)
 
         logger.debug("detect_labels resp: '{}'".format(response))
 
         if 'Labels' in response:
-            req_id = response['ResponseMetadata']['RequestId']
-            detect_labels_results[req_id] = response['Labels']
+            batch_context.set_labels_result(key, response['Labels'])
 
             for label_prediction in response['Labels']:
                 labels.append(label_prediction['Name'])
 
-            store_labels_detected(key, timestamp, labels)
+            store_labels_detected(batch_context, key, timestamp, labels)
 
     except Exception as e:
         logger.debug("update_expression_str_list: {} ".format(update_expression_str_list))
@@ -241,12 +323,47 @@ def detect_labels(params):
 
     return labels
 
-def index_faces(bucket, key):
+def reuse_frame_results(batch_context, params):
+    '''
+    Copies the results of a previously analyzed frame to a near-identical one, so the duplicated
+    frame shows up in the frame results and labels timeline with its own timestamp.
+    '''
+    #Unpacking params to support ThreadPool
+    bucket = params[0]
+    key = params[1]
+    timestamp = params[2]
+    original_key = params[3]
+
+    try:
+        logger.debug("reuse_frame_results: key: '{}' original_key: '{}'".format(key, original_key))
+
+        face_records = batch_context.get_faces_result(original_key)
+        if face_records is not None:
+            batch_context.set_faces_result(key, face_records)
+
+            if len(face_records) > 0 and FRAME_RESULTS_OUTPUT == OUTPUT_MODE_FRAME:
+                object_path = "results/frames/{}/{}.json".format(str(batch_context.video_identifier), str(extract_object_key(original_key)))
+
+                store_frame_results(batch_context, key, timestamp, "s3://{}/{}".format(bucket, object_path))
+
+        label_records = batch_context.get_labels_result(original_key)
+        if label_records is not None:
+            batch_context.set_labels_result(key, label_records)
+            store_labels_detected(batch_context, key, timestamp, [label_prediction['Name'] for label_prediction in label_records])
+    except Exception as e:
+        logger.error("reuse_frame_results - error processing file. Bucket: '{}' Key: '{}'".format(bucket, key))
+        logger.error(e)
+        logger.error('-' * 60)
+        traceback.print_exc(file=sys.stdout)
+        logger.error('-' * 60)
+
+
+def index_faces(bucket, key, coll_id):
     logger.debug('index_faces: threadname: {} bucket: {} key: {}'.format(threading.currentThread().getName(), bucket, key))
     try:
         # Calculate
         response = rekognition.index_faces(Image={"S3Object": {"Bucket": bucket, "Name": key}},
-                                           CollectionId=video_identifier, DetectionAttributes=["ALL"])
+                                           CollectionId=coll_id, DetectionAttributes=["ALL"])
         logger.debug(json.dumps(response))
     except Exception as e:
         logger.error(e)
@@ -255,6 +372,18 @@ def index_faces(bucket, key):
         logger.error('-' * 60)
 
 
+def frame_call_completed(batch_context, scheduler, reuse_results_params, key, result):
+    '''
+    Callback of every IndexFaces/DetectLabels call. Once both calls of a frame are done, the
+    results are copied to its duplicated frames right away instead of waiting for the whole batch.
+    '''
+    if batch_context.complete_call(key) == 0:
+        batch_context.release_image(key)
+
+        for params in reuse_results_params.get(key, []):
+            scheduler.submit(API_REUSE_RESULTS, partial(reuse_frame_results, batch_context), params)
+
+
 # --------------- Misc helper functions ------------------
 
 def extract_video_identifier(key):
@@ -271,46 +400,75 @@ def extract_key_paths(key, group_number):
     return m.group(group_number)
 
 
-def update_process_table_completed_item(identifier, key):
+def update_process_table_completed_item(identifier, key, shards=None, lease_expires=None):
     logger.debug("update_process_table_completed_item {} {}".format(identifier, key))
 
-    process_table.update_item(
+    if shards:
+        part_tracker.complete_part(identifier, key, shards, lease_expires)
+        return
+
+    # The part status, its lease and the status counters change in the same atomic update. With the
+    # lease of the claim, a part reclaimed or failed since is not completed by this invocation.
+    conditionExpression = "Parts.#bf = :proc"
+    expressionAttributeValues = {':newvalue': 'COMPLETED', ':proc': 'PROCESSING', ':dec': -1, ':inc': 1}
+
+    if lease_expires is not None:
+        conditionExpression += " AND LeaseExpires.#bf = :expires"
+        expressionAttributeValues[':expires'] = lease_expires
+
+    for lease_maps_added in [False, True]:
+        try:
+            process_table.update_item(
+                Key={'Identifier': identifier},
+                UpdateExpression="SET Parts.#bf = :newvalue REMOVE LeaseExpires.#bf ADD ProcessingCount :dec, CompletedCount :inc",
+                ExpressionAttributeNames={
+                    '#bf': key
+                },
+                ExpressionAttributeValues=expressionAttributeValues,
+                ConditionExpression=conditionExpression)
+            return
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ValidationException' and not lease_maps_added:
+                add_lease_maps(identifier)
+                continue
+
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise err
+
+            logger.warn("File '{}' already completed or reclaimed. Skipping.".format(key))
+            return
+
+
+def leased_parts(identifier, keys, shards, lease_expires):
+    '''
+    Returns the keys of the parts still processing under the lease of this invocation.
+    '''
+    if shards:
+        return part_tracker.leased_parts(identifier, keys, shards, lease_expires)
+
+    names = dict(('#p{}'.format(i), key) for i, key in enumerate(keys))
+    item = process_table.get_item(
         Key={'Identifier': identifier},
-        UpdateExpression="SET Parts.#bf = :newvalue",
-        ExpressionAttributeNames={
-            '#bf': key
-        },
-        ExpressionAttributeValues={':newvalue': 'COMPLETED'})
-
-def evaluate_facedetail_attribute_boolean_type(service_response, attribute, output):
-    if service_response['FaceDetail'][attribute]['Confidence'] > THRESHOLD_FACEDETAILS_ATTRIBUTES_CONFIDENCE:
-        output['Positive' if service_response['FaceDetail'][attribute]['Value'] else 'Negative'] += 1
-
-
-def evaluate_facedetail_attribute_gender_type(service_response, attribute, output):
-    if service_response['FaceDetail'][attribute]['Confidence'] > THRESHOLD_FACEDETAILS_ATTRIBUTES_CONFIDENCE:
-        output[service_response['FaceDetail'][attribute]['Value']] += 1
-
-
-def evaluate_facedetail_attribute_emotions_type(service_response, attribute, output):
-    selected_type = ''
-    highest_value = 0.0
-    for element in service_response['FaceDetail'][attribute]:
-        if element['Confidence'] > THRESHOLD_FACEDETAILS_ATTRIBUTES_CONFIDENCE:
-            if element['Confidence'] > highest_value:
-                highest_value = element['Confidence']
-                selected_type = element['Type']
-    try:
-        if selected_type != '':
-            output[selected_type] += 1
-    except Exception as e:
-        logger.debug("Unsupported Face Details Type.")
+        ProjectionExpression=', '.join('Parts.{0}, LeaseExpires.{0}'.format(name) for name in sorted(names)),
+        ExpressionAttributeNames=names,
+        ConsistentRead=True
+    ).get('Item', {})
 
+    parts = item.get('Parts', {})
+    leases = item.get('LeaseExpires', {})
 
-def randomword(length):
-    return ''.join(random.choice(string.lowercase) for i in range(length))
+    return set(key for key in keys if parts.get(key) == 'PROCESSING' and leases.get(key) == lease_expires)
 
 
+def add_lease_maps(identifier):
+    '''
+    Adds the lease maps to a process item written before the parts had leases.
+    '''
+    process_table.update_item(
+        Key={'Identifier': identifier},
+        UpdateExpression="SET LeaseExpires = if_not_exists(LeaseExpires, :empty), Attempts = if_not_exists(Attempts, :empty)",
+        ExpressionAttributeValues={':empty': {}})
+
 def get_collection_id(video_identifier):
     coll_id = ""
 
@@ -347,116 +505,124 @@ def check_file_processing_status(identifier, key):
     return file_processing_status
 
 
-def change_status_to_processing(identifier, key):
+def change_status_to_processing(identifier, key, shards=None, lease_expires=None):
     logger.debug(">change_status_to_processing Id: '{}' Key: '{}'".format(identifier, key))
     updated = False
 
-    try:
-        response = process_table.update_item(
-            Key={ "Identifier": identifier },
-            UpdateExpression="SET Parts.#file = :proc",
-            ExpressionAttributeValues={
-                ":proc" : "PROCESSING",
-                ":pend" : "PENDING"
-            },
-            ExpressionAttributeNames={ "#file": key },
-            ConditionExpression="Parts.#file = :pend",
-            ReturnValues="UPDATED_NEW"
-        )
-
-        updated = True
-    except Exception as e:
-        logger.debug("Function in execution. Skipping...")
+    # The part is leased to this invocation, the stream function gives it to another one once the lease expires
+    lease_expires = lease_expires or int(time.time()) + PART_LEASE_SECONDS
+
+    # The part is an item of the parts table
+    if shards:
+        return part_tracker.start_part(identifier, key, shards, lease_expires)
+
+    for lease_maps_added in [False, True]:
+        try:
+            process_table.update_item(
+                Key={ "Identifier": identifier },
+                UpdateExpression="SET Parts.#file = :proc, LeaseExpires.#file = :expires, Attempts.#file = if_not_exists(Attempts.#file, :zero) + :inc ADD PendingCount :dec, ProcessingCount :inc",
+                ExpressionAttributeValues={
+                    ":proc" : "PROCESSING",
+                    ":pend" : "PENDING",
+                    ":expires" : lease_expires,
+                    ":zero" : 0,
+                    ":dec" : -1,
+                    ":inc" : 1
+                },
+                ExpressionAttributeNames={ "#file": key },
+                ConditionExpression="Parts.#file = :pend"
+            )
+
+            updated = True
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ValidationException' and not lease_maps_added:
+                add_lease_maps(identifier)
+                continue
+
+            logger.debug("Function in execution. Skipping...")
+        except Exception as e:
+            logger.debug("Function in execution. Skipping...")
+
+        break
 
     return updated
 
 
-def update_videos_results_table(summary_labels, summary_faces, faces_detected):
-    update_labels(summary_labels)
-    update_faces(summary_faces, faces_detected)
+def results_counters(summary_labels, summary_faces, faces_detected):
+    builder = CounterUpdateBuilder()
 
+    for label, count in summary_labels.iteritems():
+        builder.add(('DetectedLabels', label), count)
 
-def update_faces(list_fd_attr, number_of_recognized_faces):
-    update_expression_str_list = []
-    expression_attr_values_dict = {}
+    for item in summary_faces:
+        for item_state, count in item.iteritems():
+            if item_state not in ('Name', 'Type'):
+                builder.add(('FaceDetails', item['Name'], item_state), count)
 
-    for item in list_fd_attr:
-        if item['Type'] == 'Boolean':
-            for item_state in ['Positive', 'Negative']:
-                random_value_name = randomword(5)
-                if item[item_state] > 0:
-                    update_expression_str_list.append(
-                        'FaceDetails.{0}.{1} = FaceDetails.{0}.{1} + :{2}'.format(item['Name'], item_state,
-                                                                                    random_value_name))
-                    expression_attr_values_dict[':{}'.format(random_value_name)] = item[item_state]
-        elif item['Type'] == 'Gender':
-            for item_state in ['Male', 'Female']:
-                random_value_name = randomword(5)
-                if item[item_state] > 0:
-                    update_expression_str_list.append(
-                        'FaceDetails.{0}.{1} = FaceDetails.{0}.{1} + :{2}'.format(item['Name'], item_state,
-                                                                                    random_value_name))
-                    expression_attr_values_dict[':{}'.format(random_value_name)] = item[item_state]
-        elif item['Type'] == 'Emotions':
-            for item_state in ['HAPPY', 'SURPRISED', 'DISGUSTED', 'ANGRY', 'SAD', 'CONFUSED', 'CALM']:
-                random_value_name = randomword(5)
-                if item[item_state] > 0:
-                    update_expression_str_list.append(
-                        'FaceDetails.{0}.{1} = FaceDetails.{0}.{1} + :{2}'.format(item['Name'], item_state,
-                                                                                    random_value_name))
-                    expression_attr_values_dict[':{}'.format(random_value_name)] = item[item_state]
-
-    if len(update_expression_str_list) > 0:
-        logger.debug("Updating faces. SET {}".format(', '.join(update_expression_str_list)))
-        # Add number of faces recognized
-        random_value_name = randomword(5)
-        update_expression_str_list.append('NumberFaceDetails = NumberFaceDetails + :{0}'.format(random_value_name))
-        expression_attr_values_dict[':{}'.format(random_value_name)] = number_of_recognized_faces
-
-        videos_results_table.update_item(
-            Key={'Identifier': video_identifier},
-            UpdateExpression=('SET ' + ', '.join(update_expression_str_list)),
-            ExpressionAttributeValues=expression_attr_values_dict)
-
-
-def update_labels(summary):
-    logger.debug(">update_labels {}".format(summary))
+    builder.add(('NumberFaceDetails',), faces_detected)
 
-    update_expression_str_list = []
-    expression_attr_values_dict = {}
-    expression_attr_names_dict = {}
+    return builder
 
-    for k, v in summary.iteritems():
-        random_value_name = randomword(5)
-        random_expr_attr_name = randomword(5)
 
-        #DDB reserved names issue
-        update_expression_str_list.append(
-            'DetectedLabels.#{0} :{1}'.format(random_expr_attr_name, random_value_name))
-        expression_attr_names_dict['#{}'.format(random_expr_attr_name)] = k
-        expression_attr_values_dict[':{}'.format(random_value_name)] = v
+def update_videos_results_table(video_identifier, summary_labels, summary_faces, faces_detected, batch_key=None):
+    '''
+    Adds the label and face counters of the batch to the video results with as few atomic updates as
+    possible. With a batch key, a batch already added is skipped.
+    '''
+    return add_videos_results_counters(video_identifier, results_counters(summary_labels, summary_faces, faces_detected), batch_key)
 
-    logger.debug('ADD ' + ', '.join(expression_attr_names_dict))
-    logger.debug('ADD ' + ', '.join(update_expression_str_list))
 
-    if len(update_expression_str_list) > 0:
-        logger.debug('ADD ' + ', '.join(update_expression_str_list))
-        logger.debug(expression_attr_values_dict)
+def add_videos_results_counters(video_identifier, builder, batch_key=None):
+    '''
+    Adds the counters of a builder to the video results. Returns the number of updates applied: an
+    update whose batch, or one of the batches of a list of batch keys, was already added is skipped
+    and the next ones are still applied, so a batch stopped halfway is completed when added again.
+    '''
+    if batch_key is None:
+        updates = builder.updates()
+        for update in updates:
+            videos_results_table.update_item(Key={'Identifier': video_identifier}, **update)
+        return len(updates)
 
-        videos_results_table.update_item(
-            Key={'Identifier': video_identifier},
-            UpdateExpression=('ADD ' + ', '.join(update_expression_str_list)),
-            ExpressionAttributeValues=expression_attr_values_dict,
-            ExpressionAttributeNames=expression_attr_names_dict
-        )
+    # The markers are items of the markers table written with the counters, the video results item doesn't grow
+    applied = 0
+    transactions = builder.transactions(videos_results_table.table_name, {'Identifier': video_identifier}, batch_key,
+                                        RVA_VIDEOS_RESULTS_MARKERS_TABLE, int(time.time()) + MARKER_TTL_SECONDS)
+
+    for transact_items in transactions:
+        logger.debug("Updating video results. {}".format(transact_items[-1]['Update']['UpdateExpression']))
+
+        if write_transaction(part_tracker.dynamodb_client, transact_items) is not None:
+            logger.warn("Video results already updated by this batch. Skipping. Video: '{}' Batch: '{}'".format(video_identifier, batch_key))
+            continue
+
+        applied += 1
 
+    return applied
 
-def summarize_labels(summary):
-    logger.debug(">summarize_labels\n{}".format(json.dumps(detect_labels_results)))
+
+def update_videos_results_job(job):
+    '''
+    Adds the results of every part of the job. The single update of a group of parts claims them: it
+    adds the counters and writes the first marker of every part, on condition that none of them is
+    there yet. When a part of the group was already added, by an invocation whose lease expired before it
+    completed the part, the parts of the group are added one by one, each with its own markers.
+    '''
+    for keys, counters in job.groups():
+        if len(keys) == 1:
+            add_videos_results_counters(job.video_identifier, counters, keys[0])
+        elif add_videos_results_counters(job.video_identifier, counters, keys) == 0:
+            for key in keys:
+                add_videos_results_counters(job.video_identifier, job.parts[key], key)
+
+
+def summarize_labels(batch_context):
+    summary = batch_context.labels_results()
+    logger.debug(">summarize_labels\n{}".format(json.dumps(summary)))
 
     labels_consolidated = {}
 
-    for a, v in summary.iteritems():
+    for v in summary:
         if v:
             for element in v:
                 label = element['Name']
@@ -467,104 +633,287 @@ def summarize_labels(summary):
 
     return labels_consolidated
 
-def summarize_faces(summary):
+def summarize_faces(batch_context):
+    summary = batch_context.faces_results()
     logger.debug(">summarize_faces\n{}".format(json.dumps(summary)))
 
-    number_of_recognized_faces = 0
-    list_fd_attr = [
-        {'Name': 'Eyeglasses', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'Sunglasses', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'EyesOpen', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'Smile', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'MouthOpen', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'Mustache', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'Beard', 'Type': 'Boolean', 'Positive': 0, 'Negative': 0},
-        {'Name': 'Gender', 'Type': 'Gender', 'Male': 0, 'Female': 0},
-        {'Name': 'Emotions', 'Type': 'Emotions', 'HAPPY': 0, 'SURPRISED': 0, 'DISGUSTED': 0, 'ANGRY': 0, 'SAD': 0,
-            'CONFUSED': 0, 'CALM': 0}
-    ]
-
-    for a, v in summary.iteritems():
-        if v:
-            for faceDetail in v:
-                if faceDetail['FaceDetail']['Confidence'] > THRESHOLD_FACEDETAILS_RESPONSE_CONFIDENCE:
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[0]['Name'], list_fd_attr[0])
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[1]['Name'], list_fd_attr[1])
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[2]['Name'], list_fd_attr[2])
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[3]['Name'], list_fd_attr[3])
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[4]['Name'], list_fd_attr[4])
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[5]['Name'], list_fd_attr[5])
-                    evaluate_facedetail_attribute_boolean_type(faceDetail, list_fd_attr[6]['Name'], list_fd_attr[6])
-                    evaluate_facedetail_attribute_gender_type(faceDetail, list_fd_attr[7]['Name'], list_fd_attr[7])
-                    evaluate_facedetail_attribute_emotions_type(faceDetail, list_fd_attr[8]['Name'], list_fd_attr[8])
-                    number_of_recognized_faces += 1
+    face_records = [faceDetail for v in summary if v for faceDetail in v]
+    list_fd_attr, number_of_recognized_faces = FaceSummary(THRESHOLD_FACEDETAILS_RESPONSE_CONFIDENCE,
+                                                           THRESHOLD_FACEDETAILS_ATTRIBUTES_CONFIDENCE).summarize(face_records)
 
     logger.debug("list_fd_attr: '{}'".format(list_fd_attr))
 
     return list_fd_attr, number_of_recognized_faces
 
-# --------------- Main handler ------------------
-
-def lambda_handler(event, context):
-    logger.debug("Received event: {}".format(json.dumps(event)))
-
-    # Get the object from the event
-    bucket = VIDEO_BUCKET
-    identifier = event['Identifier']
-    key = event['Key']
-
-    updated = change_status_to_processing(identifier, key)
-    
-    if not updated:
-        logger.error("File '{}' is already being processed. Nothing to do.".format(key))
-        return "Done"
-
+def process_part(bucket, key, job):
+    '''
+    Analyzes the frames of one part of a video, already moved to processing, and adds its results to the job.
+    Returns the number of faces indexed and of frames skipped.
+    '''
     contents = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
 
-    logger.debug("Video filename: {}".format(identifier))
-    logger.debug("File to process: {}".format(key))
+    video_identifier = extract_video_identifier(key)
 
-    global video_identifier
-    global faces_indexed
-    global detect_labels_results
-    global detect_faces_results
+    logger.debug("Video filename: {}".format(video_identifier))
+    logger.debug("File to process: {}".format(key))
 
-    detect_labels_results = {}
-    detect_faces_results = {}
-    faces_indexed = 0
+    # The first part starts the pool and the results writer shared by the parts of the job
+    if job.pool is None:
+        job.collection_id = get_collection_id(video_identifier)
+        job.pool = Pool(MAX_API_CONCURRENCY * len(concurrency_controllers))
+        job.results_writer = new_results_writer()
 
-    video_identifier = extract_video_identifier(key)
-    coll_id = get_collection_id(video_identifier)
+    coll_id = job.collection_id
+    pool = job.pool
 
     contents_array = contents.split(' ')
 
-    pool = Pool(THREAD_POOL_SIZE)
-
-    detect_labels_params = []
-    detect_faces_params = []
+    frames = []
+    frames_analyzed = 0
+    reuse_results_params = {}
 
     for image_file_meta in contents_array:
         metadata = image_file_meta.split(':')
         image_file = metadata[0].strip()
         timestamp = metadata[1].strip()
+        frames.append((image_file, timestamp))
+
+    # Frame results and labels are buffered and written with BatchWriteItem
+    batch_context = BatchContext(video_identifier, coll_id, frames, job.results_writer)
+
+    # Skip frames nearly identical to the previous analyzed one, their results are reused below
+    frame_deduplicator = FrameDeduplicator(s3_client, FRAME_DEDUP_THRESHOLD)
+    duplicates = frame_deduplicator.dedup(bucket, [frame[0] for frame in frames], pool)
+
+    for image_file, timestamp in frames:
+        if image_file in duplicates:
+            logger.debug("Skipping image file: '{}' Same as: '{}'".format(image_file, duplicates[image_file]))
+            reuse_results_params.setdefault(duplicates[image_file], []).append((bucket, image_file, timestamp, duplicates[image_file]))
+        else:
+            # The frames read for the dedup are sent with the requests instead of being read from S3 again
+            batch_context.set_image(image_file, frame_deduplicator.images.pop(image_file, None))
+            batch_context.add_pending_calls(image_file, 2)
+
+    frame_deduplicator.images.clear()
+
+    # Both APIs are called for every frame on the same pool, each one with its own adaptive concurrency
+    for controller in concurrency_controllers.values():
+        controller.reset_trace()
+
+    scheduler = TaskScheduler(pool, {}, THREAD_POOL_SIZE, concurrency_controllers)
+
+    for image_file, timestamp in frames:
+        if image_file in duplicates:
+            continue
+
         logger.debug("Analyzing image file: '{}'".format(image_file))
+        frames_analyzed += 1
+
+        callback = partial(frame_call_completed, batch_context, scheduler, reuse_results_params, image_file)
+        scheduler.submit(API_INDEX_FACES, partial(detect_faces, batch_context), (bucket, image_file, timestamp, coll_id), callback)
+        scheduler.submit(API_DETECT_LABELS, partial(detect_labels, batch_context), (bucket, image_file, timestamp), callback)
+
+    scheduler.join()
+
+    if FRAME_RESULTS_OUTPUT == OUTPUT_MODE_BATCH:
+        store_batch_frame_results(batch_context, bucket, key, duplicates)
 
-        detect_faces_params.append((bucket, image_file, timestamp, coll_id))
-        detect_labels_params.append((bucket, image_file, timestamp))
+    logger.info("Frames analyzed: '{}' Frames skipped: '{}'".format(frames_analyzed, frame_deduplicator.frames_skipped))
 
-    pool.map(detect_faces, detect_faces_params)
-    pool.map(detect_labels, detect_labels_params)
+    for api, controller in concurrency_controllers.items():
+        logger.info("Concurrency trace - {}: {}".format(api, controller.trace))
 
-    pool.close()
-    pool.join()
+    # Consolidate results, they are written once the job ends
+    summary_labels = summarize_labels(batch_context)
+    summary_faces, faces_detected = summarize_faces(batch_context)
 
-    # Consolidate results
-    summary_labels = summarize_labels(detect_labels_results)
-    summary_faces, faces_detected = summarize_faces(detect_faces_results)
+    job.add_part(key, results_counters(summary_labels, summary_faces, faces_detected), batch_context.faces_indexed, frame_deduplicator.frames_skipped)
+
+    return batch_context.faces_indexed, frame_deduplicator.frames_skipped
+
+
+def finish_job(job):
+    '''
+    Writes the results of every part of the job and then completes the parts, so the video can't
+    complete before the results of its last parts are in.
+    '''
+    if job.pool is None:
+        return
+
+    job.pool.close()
+    job.pool.join()
+
+    if not job.parts:
+        return
 
     logger.debug("We are updating the tables")
-    update_process_table_completed_item(video_identifier, key)
-    update_videos_results_table(summary_labels, summary_faces, faces_detected)
-    update_collection_control(coll_id, faces_indexed)
+    job.results_writer.flush()
+
+    # A part whose lease was reclaimed, or failed since, is counted by the invocation it is given
+    # to, if any. A lease lost between this check and the results is still counted.
+    if job.lease_expires is not None:
+        leased = leased_parts(job.video_identifier, list(job.parts), job.shards, job.lease_expires)
+        lost = [key for key in job.parts if key not in leased]
+
+        if lost:
+            logger.warn("Parts not leased anymore, their results are left out: {}".format(lost))
+            job.drop_parts(lost)
+
+    update_videos_results_job(job)
+
+    for key in job.parts:
+        update_process_table_completed_item(job.video_identifier, key, job.shards, job.lease_expires)
+
+    update_collection_control(job.collection_id, job.faces_indexed)
+
+
+def release_part(identifier, key, shards, lease_expires):
+    '''
+    Gives back a part claimed by this invocation that it has no time left to process.
+    '''
+    if shards:
+        part_tracker.reclaim_part(identifier, key, shards, lease_expires)
+        return
+
+    try:
+        process_table.update_item(
+            Key={'Identifier': identifier},
+            UpdateExpression="SET Parts.#file = :pend REMOVE LeaseExpires.#file ADD ProcessingCount :dec, PendingCount :inc",
+            ExpressionAttributeNames={'#file': key},
+            ExpressionAttributeValues={':pend': 'PENDING', ':proc': 'PROCESSING', ':expires': lease_expires, ':dec': -1, ':inc': 1},
+            ConditionExpression="Parts.#file = :proc AND LeaseExpires.#file = :expires")
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise err
+
+        logger.warn("File '{}' not leased to this invocation anymore. Skipping.".format(key))
+
+
+def next_part(identifier, claimed, shards, lease_expires=None):
+    '''
+    Returns the next part claimed with the event or, in the worker mode, claims the next pending part of the video.
+    '''
+    if claimed:
+        return claimed.pop(0)
+
+    if DISPATCH_MODE == DISPATCH_MODE_WORKER:
+        return claim_next_part(identifier, shards, lease_expires)
+
+    return None
+
+
+def claim_next_part(identifier, shards, lease_expires=None):
+    '''
+    Moves one pending part of the video to processing and returns its key, None when no part is left.
+    '''
+    for _ in range(MAX_RETRIES):
+        candidates = pending_part_candidates(identifier, shards, CLAIM_CANDIDATES)
+
+        if not candidates:
+            return None
+
+        for key in candidates:
+            if change_status_to_processing(identifier, key, shards, lease_expires):
+                return key
+
+    return None
+
+
+def pending_part_candidates(identifier, shards, limit):
+    '''
+    Returns up to limit pending parts of the video in random order, so the workers of a video don't all
+    try to claim the same part.
+    '''
+    if shards:
+        candidates = list(part_tracker.pending_parts(identifier, shards, limit, random.randrange(shards)))
+    else:
+        response = process_table.get_item(
+            Key={'Identifier': identifier},
+            ProjectionExpression='Parts',
+            ConsistentRead=True
+        )
+        parts = response.get('Item', {}).get('Parts', {})
+        candidates = [key for key, status in parts.iteritems() if status == 'PENDING']
+
+    random.shuffle(candidates)
+
+    return candidates[:limit]
+
+
+def hand_over(context, identifier, shards):
+    '''
+    Starts a new invocation of this function to go on claiming the parts of the video.
+    '''
+    payload = {'Identifier': identifier}
+
+    if shards:
+        payload['Shards'] = shards
+
+    lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        LogType='None',
+        Payload=json.dumps(payload)
+    )
+
+# --------------- Main handler ------------------
+
+def lambda_handler(event, context):
+    logger.debug("Received event: {}".format(json.dumps(event)))
+
+    # Get the object from the event
+    bucket = VIDEO_BUCKET
+    identifier = event['Identifier']
+    keys = event.get('Keys') or ([event['Key']] if event.get('Key') else [])
+    shards = event.get('Shards')
+
+    parts_processed = 0
+    faces_indexed = 0
+    frames_skipped = 0
+    longest_part = 0
+
+    # The parts sent together are claimed at once, so the stream function doesn't send them again.
+    # The lease outlasts the function, a part claimed can't expire before this invocation ends.
+    lease_expires = int(time.time()) + PART_LEASE_SECONDS
+    claimed = []
+
+    for key in keys:
+        if change_status_to_processing(identifier, key, shards, lease_expires):
+            claimed.append(key)
+        else:
+            logger.error("File '{}' is already being processed. Skipping.".format(key))
+
+    if keys and not claimed:
+        logger.error("Nothing to do.")
+        return "Done"
+
+    job = PartsJob(identifier, shards, lease_expires)
+
+    try:
+        key = next_part(identifier, claimed, shards, lease_expires)
+
+        # The function keeps processing parts while another part fits in the time left
+        while key is not None:
+            start = time.time()
+            part_faces_indexed, part_frames_skipped = process_part(bucket, key, job)
+
+            parts_processed += 1
+            faces_indexed += part_faces_indexed
+            frames_skipped += part_frames_skipped
+            longest_part = max(longest_part, int((time.time() - start) * 1000))
+
+            if context.get_remaining_time_in_millis() < max(DISPATCH_MIN_REMAINING_MS, 2 * longest_part):
+                if DISPATCH_MODE == DISPATCH_MODE_WORKER and pending_part_candidates(identifier, shards, 1):
+                    logger.info("Time remaining: '{}' Longest part: '{}'. Handing over.".format(context.get_remaining_time_in_millis(), longest_part))
+                    hand_over(context, identifier, shards)
+                break
+
+            key = next_part(identifier, claimed, shards, lease_expires)
+    finally:
+        # The parts claimed and not started are processed by another invocation
+        for key in claimed:
+            release_part(identifier, key, shards, lease_expires)
+
+        finish_job(job)
 
-    return "OK. Time remaining: '{}' Faces indexed: '{}'".format(context.get_remaining_time_in_millis(), faces_indexed)
+    return "OK. Parts processed: '{}' Time remaining: '{}' Faces indexed: '{}' Frames skipped: '{}'".format(parts_processed, context.get_remaining_time_in_millis(), faces_indexed, frames_skipped)
@@ -1,13 +1,20 @@
 import unittest
+import io
 import mock
 import json
 import boto3
 import botocore
 import logging
 import sure
+import numpy as np
+from PIL import Image
 from boto.dynamodb2.exceptions import ValidationException
 
 import lambda_function
+from batch_context import BatchContext
+from frame_results_file import read_frame_results
+from parts_job import PartsJob
+from update_expression import CounterUpdateBuilder
 #from lambda_function import lambda_handler
 from moto import mock_s3, mock_dynamodb2, mock_dynamodb
 
@@ -20,20 +27,25 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 # CONSTANTS
 PROCESS_TABLE = 'RVA_PROCESS_TABLE'
 VIDEOS_RESULTS_TABLE = 'RVA_VIDEOS_RESULTS_TABLE'
+VIDEOS_RESULTS_MARKERS_TABLE = 'RVA_VIDEOS_RESULTS_MARKERS_TABLE'
 FRAMES_RESULTS_TABLE = 'RVA_FRAMES_RESULTS_TABLE'
 VIDEO_LABELS_TABLE = 'RVA_VIDEOS_LABELS_TABLE'
+PROCESS_PARTS_TABLE = 'RVA_PROCESS_PARTS_TABLE'
 
 class TestActor(unittest.TestCase):
 
     test_video_identifier = 'fun-at-fair-343902224.mp4'
-    faces_indexed = 0
+    test_frame_key = 'images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-3.jpg'
+
+    def new_batch_context(self, keys=None, results_writer=None):
+        keys = keys or [self.test_frame_key]
+        return BatchContext(self.test_video_identifier, 'DVA-00000', [(key, '1000') for key in keys],
+                            results_writer or lambda_function.new_results_writer())
 
     @mock_s3
     @mock_dynamodb2
     @mock.patch('lambda_function.index_faces_call')
     @mock.patch('lambda_function.detect_labels_call')
-    @mock.patch.object(lambda_function,'video_identifier',test_video_identifier)
-    @mock.patch.object(lambda_function,'faces_indexed', faces_indexed)
     def test_rekognition(self, rdl, rif):
         with open('./faces.json') as faces_file:
             rif.return_value = json.load(faces_file)
@@ -87,8 +99,13 @@ class TestActor(unittest.TestCase):
         context = ''
         #handler = lambda_function.lambda_handler(event,context)
 
-        detectlabels = lambda_function.detect_labels('deep-west-video-rekognition-video','images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-3.jpg', 0)
-        detectfaces = lambda_function.detect_faces('deep-west-video-rekognition-video','images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-3.jpg','1000-01-01 00:00:00', 0)
+        batch_context = self.new_batch_context()
+        detectlabels = lambda_function.detect_labels(batch_context, ('deep-west-video-rekognition-video', self.test_frame_key, '1000'))
+        detectfaces = lambda_function.detect_faces(batch_context, ('deep-west-video-rekognition-video', self.test_frame_key, '1000', 'DVA-00000'))
+
+        summary_labels = lambda_function.summarize_labels(batch_context)
+        summary_faces, faces_detected = lambda_function.summarize_faces(batch_context)
+        lambda_function.update_videos_results_table(self.test_video_identifier, summary_labels, summary_faces, faces_detected)
 
         #print(dynamodb.describe_table(TableName=videos_results_table_name))
 
@@ -100,10 +117,12 @@ class TestActor(unittest.TestCase):
         )
         print(json.dumps(check_item))
 
-        #print(check_item['Item']['FaceDetails.Gender.Male'])
-        self.assertIsNone(None,check_item['Item']['FaceDetails.Gender.Male'])
-        self.assertIsNone(None,check_item['Item']['FaceDetails.Smile.Positive'])
-        self.assertIsNone(None,check_item['Item']['FaceDetails.Emotions.HAPPY'])
+        face_details = check_item['Item']['FaceDetails']['M']
+        self.assertEqual(1, batch_context.faces_indexed)
+        self.assertEqual('1', face_details['Gender']['M']['Male']['N'])
+        self.assertEqual('1', face_details['Smile']['M']['Positive']['N'])
+        self.assertEqual('1', face_details['Emotions']['M']['HAPPY']['N'])
+        self.assertEqual('1', check_item['Item']['NumberFaceDetails']['N'])
 
         #print(dynamodb.scan(
         #    TableName=videos_results_table.table_name,
@@ -115,9 +134,8 @@ class TestActor(unittest.TestCase):
     @mock_s3
     @mock_dynamodb2
     @mock.patch('lambda_function.detect_labels_call', return_value=json.loads('{"Labels": [], "OrientationCorrection": "ROTATE_0"}'))
-    @mock.patch.object(lambda_function,'video_identifier',test_video_identifier)
     def test_rekog_labels_empty_list(self, rdl):
-        labels = lambda_function.detect_labels('deep-west-video-rekognition-video','images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-3.jpg', 0)
+        labels = lambda_function.detect_labels(self.new_batch_context(), ('deep-west-video-rekognition-video', self.test_frame_key, 0))
         self.assertEqual(0, len(labels))
 
 
@@ -125,20 +143,18 @@ class TestActor(unittest.TestCase):
     @mock_dynamodb2
     @mock.patch('lambda_function.detect_labels_call', return_value=json.loads('{"Labels": [{ "Confidence": 74.410766601,  "Name": "Text" }], "OrientationCorrection": "ROTATE_0"}'))
     @mock.patch('lambda_function.store_labels_detected', return_value=None)
-    @mock.patch.object(lambda_function,'video_identifier',test_video_identifier)
     def test_rekog_labels_ddb_reserved_words(self, f1, f2):
 
         dynamodb = boto3.client('dynamodb')
 
         create_RVA_VIDEOS_RESULTS_TABLE(dynamodb)
 
-        labels = lambda_function.detect_labels('deep-west-video-rekognition-video','images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-3.jpg', 0)
+        labels = lambda_function.detect_labels(self.new_batch_context(), ('deep-west-video-rekognition-video', self.test_frame_key, 0))
 
         self.assertEqual(1, len(labels))
 
 
     @mock_dynamodb2
-    @mock.patch.object(lambda_function,'video_identifier',test_video_identifier)
     def test_store_labels_ddb_update(self):
         key = "images/video/video.jpg"
         timestamp = 1234
@@ -148,7 +164,9 @@ class TestActor(unittest.TestCase):
 
         create_RVA_VIDEOS_LABELS_TABLE(dynamodb)
 
-        lambda_function.store_labels_detected(key, timestamp, labels)
+        batch_context = self.new_batch_context()
+        lambda_function.store_labels_detected(batch_context, key, timestamp, labels)
+        batch_context.results_writer.flush()
 
         check_item = dynamodb.get_item(
             TableName=VIDEO_LABELS_TABLE,
@@ -163,8 +181,516 @@ class TestActor(unittest.TestCase):
         self.assertEqual(2, len(labels), msg="Data written in DDB is wrong. Exp: {} Found: {}".format(2, labels))
 
 
+    @mock.patch('lambda_function.store_labels_detected', return_value=None)
+    def test_reuse_frame_results(self, sld):
+        original_key = 'images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-3.jpg'
+        key = 'images/fun-at-fair-343902224.mp4/fun-at-fair-343902224.mp4-4.jpg'
+        with open('./faces.json') as faces_file:
+            face_records = json.load(faces_file)['FaceRecords']
+        with open('./labels.json') as labels_file:
+            label_records = json.load(labels_file)['Labels']
+
+        batch_context = self.new_batch_context([original_key, key], mock.Mock())
+        batch_context.set_faces_result(original_key, face_records)
+        batch_context.set_labels_result(original_key, label_records)
+
+        lambda_function.reuse_frame_results(batch_context, ('deep-west-video-rekognition-video', key, '2000', original_key))
+
+        self.assertEqual(face_records, batch_context.get_faces_result(key))
+        self.assertEqual(label_records, batch_context.get_labels_result(key))
+        self.assertEqual(0, batch_context.faces_indexed)
+
+        table_name, item = batch_context.results_writer.put.call_args[0]
+        self.assertEqual(FRAMES_RESULTS_TABLE, table_name)
+        self.assertEqual('fun-at-fair-343902224.mp4-4.jpg', item['Key'])
+        self.assertEqual('2000', item['Time'])
+        self.assertTrue(item['S3Path'].endswith('fun-at-fair-343902224.mp4-3.jpg.json'))
+        sld.assert_called_once_with(batch_context, key, '2000', [label['Name'] for label in label_records])
+
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.update_collection_control')
+    @mock.patch('lambda_function.index_faces_call')
+    @mock.patch('lambda_function.detect_labels_call')
+    def test_lambda_handler(self, rdl, rif, ucc):
+        with open('./faces.json') as faces_file:
+            rif.return_value = json.load(faces_file)
+        with open('./labels.json') as labels_file:
+            rdl.return_value = json.load(labels_file)
+
+        # moto can't evaluate the nested conditions on a part key with dots
+        self.test_video_identifier = 'fun-at-fair-343902224'
+
+        dynamodb = boto3.client('dynamodb')
+        manifest_key, result = run_lambda_handler(self.test_video_identifier, ['is awesome'] * 7, 'd630ccbcf37810eb16187bd859a7e280')
+
+        self.assertIn("Faces indexed: '7'", result)
+        self.assertEqual(7, rif.call_count)
+        self.assertEqual(7, rdl.call_count)
+        ucc.assert_called_once_with('DVA-00000', 7)
+
+        check_item = dynamodb.get_item(TableName=VIDEOS_RESULTS_TABLE, Key={"Identifier": {"S": self.test_video_identifier}})
+        self.assertEqual('7', check_item['Item']['NumberFaceDetails']['N'])
+        self.assertEqual('7', check_item['Item']['DetectedLabels']['M']['Head']['N'])
+
+        check_item = dynamodb.get_item(TableName=PROCESS_TABLE, Key={"Identifier": {"S": self.test_video_identifier}})
+        self.assertEqual('COMPLETED', check_item['Item']['Parts']['M'][manifest_key]['S'])
+
+        self.assertEqual(7, dynamodb.scan(TableName=FRAMES_RESULTS_TABLE)['Count'])
+        self.assertEqual(7, dynamodb.scan(TableName=VIDEO_LABELS_TABLE)['Count'])
+
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.change_status_to_processing', return_value=True)
+    @mock.patch('lambda_function.leased_parts', new=lambda identifier, keys, shards, lease_expires: set(keys))
+    @mock.patch('lambda_function.update_collection_control')
+    @mock.patch('lambda_function.index_faces_call')
+    @mock.patch('lambda_function.detect_labels_call')
+    def test_lambda_handler_skips_duplicated_frames(self, rdl, rif, ucc, cstp):
+        with open('./faces.json') as faces_file:
+            rif.return_value = json.load(faces_file)
+        with open('./labels.json') as labels_file:
+            rdl.return_value = json.load(labels_file)
+
+        gradient = np.tile(np.arange(0, 256, 4, dtype=np.uint8), (64, 1))
+        static_shot = [to_jpeg(gradient)] * 4 + [to_jpeg(gradient[:, ::-1].copy())] * 3
+
+        dynamodb = boto3.client('dynamodb')
+        manifest_key, result = run_lambda_handler(self.test_video_identifier, static_shot)
+
+        self.assertIn("Faces indexed: '2' Frames skipped: '5'", result)
+        self.assertEqual(2, rif.call_count)
+        self.assertEqual(2, rdl.call_count)
+
+        # The frames analyzed are sent with the requests, as read for the dedup
+        self.assertEqual(sorted(set(static_shot)), sorted(call[0][0]['Bytes'] for call in rif.call_args_list))
+        self.assertEqual(sorted(set(static_shot)), sorted(call[0][0]['Bytes'] for call in rdl.call_args_list))
+        ucc.assert_called_once_with('DVA-00000', 2)
+
+        # Skipped frames still count in the video results and have their own frame entries
+        check_item = dynamodb.get_item(TableName=VIDEOS_RESULTS_TABLE, Key={"Identifier": {"S": self.test_video_identifier}})
+        self.assertEqual('7', check_item['Item']['NumberFaceDetails']['N'])
+        self.assertEqual(7, dynamodb.scan(TableName=FRAMES_RESULTS_TABLE)['Count'])
+        self.assertEqual(7, dynamodb.scan(TableName=VIDEO_LABELS_TABLE)['Count'])
+
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.FRAME_RESULTS_OUTPUT', 'batch')
+    @mock.patch('lambda_function.change_status_to_processing', return_value=True)
+    @mock.patch('lambda_function.leased_parts', new=lambda identifier, keys, shards, lease_expires: set(keys))
+    @mock.patch('lambda_function.update_collection_control')
+    @mock.patch('lambda_function.index_faces_call')
+    @mock.patch('lambda_function.detect_labels_call')
+    def test_lambda_handler_batch_frame_results(self, rdl, rif, ucc, cstp):
+        with open('./faces.json') as faces_file:
+            rif.return_value = json.load(faces_file)
+        with open('./labels.json') as labels_file:
+            rdl.return_value = json.load(labels_file)
+
+        gradient = np.tile(np.arange(0, 256, 4, dtype=np.uint8), (64, 1))
+        static_shot = [to_jpeg(gradient)] * 2 + [to_jpeg(gradient[:, ::-1].copy())] * 2
+
+        manifest_key, result = run_lambda_handler(self.test_video_identifier, static_shot)
+
+        s3_client = boto3.client('s3')
+        objects = s3_client.list_objects(Bucket='deep-west-video-rekognition-video', Prefix='results/')['Contents']
+        self.assertEqual(['results/batches/fun-at-fair-343902224.mp4/d630ccbcf37810eb16187bd859a7e280.txt.jsonl'], [o['Key'] for o in objects])
+
+        items = boto3.resource('dynamodb').Table(FRAMES_RESULTS_TABLE).scan()['Items']
+        self.assertEqual(4, len(items))
+
+        for item in sorted(items, key=lambda item: item['Key']):
+            bucket, object_path = item['S3Path'][len('s3://'):].split('/', 1)
+            face_records = read_frame_results(s3_client, bucket, object_path, int(item['Offset']), int(item['Length']))
+            self.assertEqual(rif.return_value['FaceRecords'], face_records)
+
+        # Duplicated frames point to the line of the frame they reuse
+        offsets = dict((item['Key'], item['Offset']) for item in items)
+        self.assertEqual(offsets['fun-at-fair-343902224.mp4-1.jpg'], offsets['fun-at-fair-343902224.mp4-2.jpg'])
+        self.assertNotEqual(offsets['fun-at-fair-343902224.mp4-1.jpg'], offsets['fun-at-fair-343902224.mp4-3.jpg'])
+
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.update_collection_control')
+    @mock.patch('lambda_function.index_faces_call')
+    @mock.patch('lambda_function.detect_labels_call')
+    def test_lambda_handler_several_parts(self, rdl, rif, ucc):
+        with open('./faces.json') as faces_file:
+            rif.return_value = json.load(faces_file)
+        with open('./labels.json') as labels_file:
+            rdl.return_value = json.load(labels_file)
+
+        # moto can't evaluate the nested conditions on a part key with dots
+        video_identifier = 'fun-at-fair-343902224'
+        manifest_keys = create_manifests(video_identifier, [3, 2, 4])
+
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 200000
+
+        with mock.patch('lambda_function.write_transaction', wraps=lambda_function.write_transaction) as mock_transaction:
+            result = lambda_function.lambda_handler({'Identifier': video_identifier, 'Keys': manifest_keys}, context)
+
+        self.assertIn("Parts processed: '3'", result)
+        self.assertEqual(1, mock_transaction.call_count)
+        ucc.assert_called_once_with('DVA-00000', 9)
+
+        dynamodb = boto3.client('dynamodb')
+        check_item = dynamodb.get_item(TableName=VIDEOS_RESULTS_TABLE, Key={"Identifier": {"S": video_identifier}})
+        self.assertEqual('9', check_item['Item']['NumberFaceDetails']['N'])
+        self.assertNotIn('ProcessedBatches', check_item['Item'])
+        markers = dynamodb.scan(TableName=VIDEOS_RESULTS_MARKERS_TABLE)['Items']
+        self.assertEqual(sorted(manifest_keys), sorted(marker['Marker']['S'] for marker in markers))
+        self.assertEqual(set([video_identifier]), set(marker['Identifier']['S'] for marker in markers))
+
+        check_item = dynamodb.get_item(TableName=PROCESS_TABLE, Key={"Identifier": {"S": video_identifier}})
+        self.assertEqual(['COMPLETED'] * 3, [check_item['Item']['Parts']['M'][key]['S'] for key in manifest_keys])
+        self.assertEqual(9, dynamodb.scan(TableName=FRAMES_RESULTS_TABLE)['Count'])
+
+    @mock_s3
+    @mock_dynamodb2
+    @mock.patch('lambda_function.update_collection_control')
+    @mock.patch('lambda_function.index_faces_call')
+    @mock.patch('lambda_function.detect_labels_call')
+    def test_lambda_handler_releases_parts_without_time(self, rdl, rif, ucc):
+        rif.return_value = {'FaceRecords': []}
+        rdl.return_value = {'Labels': []}
+
+        video_identifier = 'fun-at-fair-343902224'
+        manifest_keys = create_manifests(video_identifier, [1, 1])
+
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 10000
+
+        result = lambda_function.lambda_handler({'Identifier': video_identifier, 'Keys': manifest_keys}, context)
+
+        self.assertIn("Parts processed: '1'", result)
+
+        item = boto3.resource('dynamodb').Table(PROCESS_TABLE).get_item(Key={'Identifier': video_identifier})['Item']
+        self.assertEqual(['COMPLETED', 'PENDING'], [item['Parts'][key] for key in manifest_keys])
+        self.assertEqual({}, item['LeaseExpires'])
+
+    @mock_dynamodb2
+    def test_completed_item_updates_counters(self):
+        dynamodb = boto3.client('dynamodb')
+        create_RVA_PROCESS_TABLE(dynamodb)
+
+        process_table = boto3.resource('dynamodb').Table(PROCESS_TABLE)
+        process_table.put_item(Item={
+            'Identifier': self.test_video_identifier,
+            'Status': 'PROCESSING',
+            'Parts': {'images/video/1': 'PROCESSING', 'images/video/2': 'PENDING'},
+            'PendingCount': 1,
+            'ProcessingCount': 1,
+            'CompletedCount': 0
+        })
+
+        # Item written before the leases, without the lease maps
+        lambda_function.update_process_table_completed_item(self.test_video_identifier, 'images/video/1')
+
+        item = process_table.get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual('COMPLETED', item['Parts']['images/video/1'])
+        self.assertEqual((1, 0, 1), (item['PendingCount'], item['ProcessingCount'], item['CompletedCount']))
+
+        # A part reclaimed by the stream function is not completed by the late invocation
+        self.assertTrue(lambda_function.change_status_to_processing(self.test_video_identifier, 'images/video/2'))
+        item = process_table.get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual(1, item['Attempts']['images/video/2'])
+        self.assertIn('images/video/2', item['LeaseExpires'])
+
+        process_table.update_item(Key={'Identifier': self.test_video_identifier},
+            UpdateExpression="SET Parts.#f = :pend REMOVE LeaseExpires.#f ADD ProcessingCount :dec, PendingCount :inc",
+            ExpressionAttributeNames={'#f': 'images/video/2'},
+            ExpressionAttributeValues={':pend': 'PENDING', ':dec': -1, ':inc': 1})
+        lambda_function.update_process_table_completed_item(self.test_video_identifier, 'images/video/2')
+
+        item = process_table.get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual('PENDING', item['Parts']['images/video/2'])
+        self.assertEqual((1, 0, 1), (item['PendingCount'], item['ProcessingCount'], item['CompletedCount']))
+
+    @mock_dynamodb2
+    @mock.patch('lambda_function.update_collection_control')
+    def test_finish_job_of_parts_not_leased(self, ucc):
+        dynamodb = boto3.client('dynamodb')
+        create_RVA_PROCESS_TABLE(dynamodb)
+        create_RVA_VIDEOS_RESULTS_TABLE(dynamodb)
+
+        keys = ['images/video/1', 'images/video/2', 'images/video/3']
+        process_table = boto3.resource('dynamodb').Table(PROCESS_TABLE)
+        process_table.put_item(Item={
+            'Identifier': self.test_video_identifier,
+            'Status': 'PROCESSING',
+            'Parts': {keys[0]: 'PROCESSING', keys[1]: 'FAILED', keys[2]: 'PROCESSING'},
+            'LeaseExpires': {keys[0]: 1000, keys[2]: 2000},
+            'Attempts': {keys[0]: 1, keys[1]: 3, keys[2]: 2},
+            'PendingCount': 0,
+            'ProcessingCount': 2,
+            'CompletedCount': 0,
+            'FailedCount': 1
+        })
+        boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).put_item(Item={'Identifier': self.test_video_identifier, 'DetectedLabels': {}})
+
+        # The part failed and the part reclaimed and leased to another invocation since are left out
+        job = PartsJob(self.test_video_identifier, lease_expires=1000)
+        job.pool = mock.Mock()
+        job.results_writer = mock.Mock()
+        for key, label in zip(keys, ['A', 'B', 'C']):
+            counters = CounterUpdateBuilder()
+            counters.add(('DetectedLabels', label), 1)
+            job.add_part(key, counters, 1, 0)
+
+        self.assertEqual(set([keys[0]]), lambda_function.leased_parts(self.test_video_identifier, keys, None, 1000))
+        lambda_function.finish_job(job)
+
+        item = boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual({'A': 1}, item['DetectedLabels'])
+
+        item = process_table.get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual(['COMPLETED', 'FAILED', 'PROCESSING'], [item['Parts'][key] for key in keys])
+        self.assertEqual((0, 1, 1, 1), (item['PendingCount'], item['ProcessingCount'], item['CompletedCount'], item['FailedCount']))
+
+        # Nor is a part completed under a lease it doesn't hold
+        lambda_function.update_process_table_completed_item(self.test_video_identifier, keys[2], None, 1000)
+        item = process_table.get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual('PROCESSING', item['Parts'][keys[2]])
+
+    @mock_dynamodb2
+    def test_part_items_status(self):
+        dynamodb = boto3.client('dynamodb')
+        create_RVA_PROCESS_TABLE(dynamodb)
+        create_RVA_PROCESS_PARTS_TABLE(dynamodb)
+
+        keys = ['images/video/1.txt', 'images/video/2.txt']
+        process_table = boto3.resource('dynamodb').Table(PROCESS_TABLE)
+        process_table.put_item(Item={
+            'Identifier': self.test_video_identifier,
+            'Status': 'PROCESSING',
+            'PartsLayout': 'ITEMS',
+            'PartCount': 2,
+            'PartShards': 4,
+            'PendingCount': 2,
+            'ProcessingCount': 0,
+            'CompletedCount': 0
+        })
+        lambda_function.part_tracker.put_parts(self.test_video_identifier, keys, 4)
+
+        self.assertTrue(lambda_function.change_status_to_processing(self.test_video_identifier, keys[0], 4))
+        self.assertFalse(lambda_function.change_status_to_processing(self.test_video_identifier, keys[0], 4))
+        lambda_function.update_process_table_completed_item(self.test_video_identifier, keys[0], 4)
+        lambda_function.update_process_table_completed_item(self.test_video_identifier, keys[0], 4)
+
+        item = process_table.get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual((1, 0, 1), (item['PendingCount'], item['ProcessingCount'], item['CompletedCount']))
+        self.assertNotIn('Parts', item)
+
+    @mock_dynamodb2
+    @mock.patch('lambda_function.DISPATCH_MODE', 'worker')
+    @mock.patch('lambda_function.process_part', return_value=(1, 0))
+    @mock.patch('lambda_function.hand_over')
+    def test_worker_mode_claims_every_part(self, mock_hand_over, mock_process_part):
+        keys = create_part_items(self.test_video_identifier, 3)
+
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 200000
+
+        result = lambda_function.lambda_handler({'Identifier': self.test_video_identifier, 'Shards': 4}, context)
+
+        self.assertEqual(sorted(keys), sorted(call[0][1] for call in mock_process_part.call_args_list))
+        self.assertIn("Parts processed: '3'", result)
+        self.assertEqual(0, mock_hand_over.call_count)
+
+    @mock_dynamodb2
+    @mock.patch('lambda_function.DISPATCH_MODE', 'worker')
+    @mock.patch('lambda_function.process_part', return_value=(1, 0))
+    @mock.patch('lambda_function.hand_over')
+    def test_worker_mode_hands_over(self, mock_hand_over, mock_process_part):
+        create_part_items(self.test_video_identifier, 3)
+
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 10000
+
+        result = lambda_function.lambda_handler({'Identifier': self.test_video_identifier, 'Shards': 4}, context)
+
+        self.assertEqual(1, mock_process_part.call_count)
+        self.assertIn("Parts processed: '1'", result)
+        mock_hand_over.assert_called_once_with(context, self.test_video_identifier, 4)
+
+    @mock_dynamodb2
+    def test_job_results_part_already_added(self):
+        create_RVA_VIDEOS_RESULTS_TABLE(boto3.client('dynamodb'))
+        boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).put_item(Item={'Identifier': self.test_video_identifier, 'DetectedLabels': {}})
+
+        def counters(labels):
+            # One counter per update
+            builder = CounterUpdateBuilder(max_expression_size=20)
+            for label in labels:
+                builder.add(('DetectedLabels', label), 1)
+            return builder
+
+        # k2 was added by an invocation whose lease expired
+        lambda_function.add_videos_results_counters(self.test_video_identifier, counters(['B']), 'k2')
+
+        job = PartsJob(self.test_video_identifier)
+        job.add_part('k1', counters(['A', 'B', 'C']), 0, 0)
+        job.add_part('k2', counters(['B']), 0, 0)
+        self.assertEqual([['k1'], ['k2']], [keys for keys, _ in job.groups()])
+        lambda_function.update_videos_results_job(job)
+
+        item = boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual({'A': 1, 'B': 2, 'C': 1}, item['DetectedLabels'])
+
+        # The job added again changes nothing
+        job = PartsJob(self.test_video_identifier)
+        job.add_part('k1', counters(['A', 'B', 'C']), 0, 0)
+        job.add_part('k3', counters(['C']), 0, 0)
+        lambda_function.update_videos_results_job(job)
+
+        item = boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual({'A': 1, 'B': 2, 'C': 2}, item['DetectedLabels'])
+
+        # The parts of a group whose claim fails are added one by one
+        job = PartsJob(self.test_video_identifier)
+        job.add_part('k3', counters(['D']), 0, 0)
+        job.add_part('k4', counters(['E']), 0, 0)
+        job.parts['k3'].max_expression_size = job.parts['k4'].max_expression_size = 100
+        self.assertEqual([['k3', 'k4']], [keys for keys, _ in job.groups()])
+        lambda_function.update_videos_results_job(job)
+
+        item = boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual({'A': 1, 'B': 2, 'C': 2, 'E': 1}, item['DetectedLabels'])
+
+    @mock_dynamodb2
+    def test_results_batch_added_again_after_partial_write(self):
+        create_RVA_VIDEOS_RESULTS_TABLE(boto3.client('dynamodb'))
+        boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).put_item(Item={'Identifier': self.test_video_identifier, 'DetectedLabels': {}})
+
+        # One counter per update
+        builder = CounterUpdateBuilder(max_expression_size=20)
+        for label in ['A', 'B', 'C']:
+            builder.add(('DetectedLabels', label), 1)
+
+        # The invocation stopped after the first update
+        transactions = builder.transactions(VIDEOS_RESULTS_TABLE, {'Identifier': self.test_video_identifier}, 'k1', VIDEOS_RESULTS_MARKERS_TABLE)
+        self.assertEqual(3, len(transactions))
+        boto3.client('dynamodb').transact_write_items(TransactItems=transactions[0])
+
+        self.assertEqual(2, lambda_function.add_videos_results_counters(self.test_video_identifier, builder, 'k1'))
+        self.assertEqual(0, lambda_function.add_videos_results_counters(self.test_video_identifier, builder, 'k1'))
+
+        item = boto3.resource('dynamodb').Table(VIDEOS_RESULTS_TABLE).get_item(Key={'Identifier': self.test_video_identifier})['Item']
+        self.assertEqual({'A': 1, 'B': 1, 'C': 1}, item['DetectedLabels'])
+
+
+
 ## HELPERS
 
+def create_part_items(video_identifier, parts):
+    dynamodb = boto3.client('dynamodb')
+    create_RVA_PROCESS_TABLE(dynamodb)
+    create_RVA_PROCESS_PARTS_TABLE(dynamodb)
+
+    keys = ['images/{}/{}.txt'.format(video_identifier, i + 1) for i in range(parts)]
+    boto3.resource('dynamodb').Table(PROCESS_TABLE).put_item(Item={
+        'Identifier': video_identifier,
+        'Status': 'PROCESSING',
+        'PartsLayout': 'ITEMS',
+        'PartCount': parts,
+        'PartShards': 4,
+        'PendingCount': parts,
+        'ProcessingCount': 0,
+        'CompletedCount': 0
+    })
+    lambda_function.part_tracker.put_parts(video_identifier, keys, 4)
+
+    return keys
+
+
+def run_lambda_handler(video_identifier, frame_bodies, manifest_name='d630ccbcf37810eb16187bd859a7e280.txt'):
+    bucket = 'deep-west-video-rekognition-video'
+    manifest_key = 'images/{0}/{1}'.format(video_identifier, manifest_name)
+    frame_keys = ['images/{0}/{0}-{1}.jpg'.format(video_identifier, i + 1) for i in range(len(frame_bodies))]
+
+    dynamodb = boto3.client('dynamodb')
+    create_RVA_PROCESS_TABLE(dynamodb)
+    create_RVA_VIDEOS_RESULTS_TABLE(dynamodb)
+    create_RVA_FRAMES_RESULTS_TABLE(dynamodb)
+    create_RVA_VIDEOS_LABELS_TABLE(dynamodb)
+    create_video_items(video_identifier, {manifest_key: 'PENDING'})
+
+    s3 = boto3.resource('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket=bucket)
+    s3.Object(bucket, manifest_key).put(Body=' '.join('{}:{}'.format(key, i * 1000) for i, key in enumerate(frame_keys)))
+    for key, body in zip(frame_keys, frame_bodies):
+        s3.Object(bucket, key).put(Body=body)
+
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.return_value = 60000
+
+    return manifest_key, lambda_function.lambda_handler({'Identifier': video_identifier, 'Key': manifest_key}, context)
+
+
+def create_manifests(video_identifier, frames_per_part):
+    bucket = 'deep-west-video-rekognition-video'
+    manifest_keys = ['images/{0}/part{1}'.format(video_identifier, i) for i in range(len(frames_per_part))]
+
+    dynamodb = boto3.client('dynamodb')
+    create_RVA_PROCESS_TABLE(dynamodb)
+    create_RVA_VIDEOS_RESULTS_TABLE(dynamodb)
+    create_RVA_FRAMES_RESULTS_TABLE(dynamodb)
+    create_RVA_VIDEOS_LABELS_TABLE(dynamodb)
+    create_video_items(video_identifier, dict((key, 'PENDING') for key in manifest_keys))
+
+    s3 = boto3.resource('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket=bucket)
+
+    for i, (manifest_key, frames) in enumerate(zip(manifest_keys, frames_per_part)):
+        frame_keys = ['images/{0}/{0}-{1}-{2}.jpg'.format(video_identifier, i, j + 1) for j in range(frames)]
+        s3.Object(bucket, manifest_key).put(Body=' '.join('{}:{}'.format(key, j * 1000) for j, key in enumerate(frame_keys)))
+        for j, key in enumerate(frame_keys):
+            s3.Object(bucket, key).put(Body='part {} frame {}'.format(i, j))
+
+    return manifest_keys
+
+
+def to_jpeg(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def create_video_items(video_identifier, parts):
+    dynamodb_resource_client = boto3.resource('dynamodb')
+
+    dynamodb_resource_client.Table(PROCESS_TABLE).put_item(Item={
+        'Identifier': video_identifier,
+        'Status': 'PROCESSING',
+        'Parts': parts
+    })
+
+    dynamodb_resource_client.Table(VIDEOS_RESULTS_TABLE).put_item(Item={
+        'Identifier': video_identifier,
+        'FaceDetails': {
+            'Smile': {'Positive': 0, 'Negative': 0},
+            'Eyeglasses': {'Positive': 0, 'Negative': 0},
+            'Sunglasses': {'Positive': 0, 'Negative': 0},
+            'Gender': {'Male': 0, 'Female': 0},
+            'Beard': {'Positive': 0, 'Negative': 0},
+            'Mustache': {'Positive': 0, 'Negative': 0},
+            'EyesOpen': {'Positive': 0, 'Negative': 0},
+            'MouthOpen': {'Positive': 0, 'Negative': 0},
+            'Emotions': {'HAPPY': 0, 'SAD': 0, 'ANGRY': 0, 'DISGUSTED': 0, 'CONFUSED': 0,
+                         'SURPRISED': 0, 'CALM': 0}
+        },
+        'NumberFaceDetails': 0,
+        'DetectedLabels': {},
+        'Individuals': [],
+        'CollectionId': 'DVA-00000'
+    })
+
+
 def unmarshal_dynamodb_json(node):
     data = dict({})
     data['M'] = node
@@ -210,23 +736,43 @@ def create_RVA_PROCESS_TABLE(dynamodb):
                         AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
                         ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
 
+def create_RVA_PROCESS_PARTS_TABLE(dynamodb):
+    dynamodb.create_table(TableName=PROCESS_PARTS_TABLE,
+                        KeySchema=[{'AttributeName': 'Shard', 'KeyType': 'HASH'},{'AttributeName': 'Key', 'KeyType': 'RANGE'}],
+                        AttributeDefinitions=[{'AttributeName': 'Shard', 'AttributeType': 'S'},{'AttributeName': 'Key', 'AttributeType': 'S'},
+                                              {'AttributeName': 'PendingKey', 'AttributeType': 'S'},{'AttributeName': 'LeaseExpires', 'AttributeType': 'N'}],
+                        GlobalSecondaryIndexes=[{'IndexName': 'PendingParts',
+                                                 'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'},{'AttributeName': 'PendingKey', 'KeyType': 'RANGE'}],
+                                                 'Projection': {'ProjectionType': 'KEYS_ONLY'},
+                                                 'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}},
+                                                {'IndexName': 'LeasedParts',
+                                                 'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'},{'AttributeName': 'LeaseExpires', 'KeyType': 'RANGE'}],
+                                                 'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['Attempts']},
+                                                 'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}}],
+                        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
 def create_RVA_VIDEOS_RESULTS_TABLE(dynamodb):
     dynamodb.create_table(TableName=VIDEOS_RESULTS_TABLE,
                         KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
                         AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
                         ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
 
+    dynamodb.create_table(TableName=VIDEOS_RESULTS_MARKERS_TABLE,
+                        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'},{'AttributeName': 'Marker', 'KeyType': 'RANGE'}],
+                        AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'},{'AttributeName': 'Marker', 'AttributeType': 'S'}],
+                        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
 
 def create_RVA_FRAMES_RESULTS_TABLE(dynamodb):
     dynamodb.create_table(TableName=FRAMES_RESULTS_TABLE,
-                        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'},{'AttributeName': 'Key', 'KeyType': 'HASH'}],
+                        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'},{'AttributeName': 'Key', 'KeyType': 'RANGE'}],
                         AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'},{'AttributeName': 'Key', 'AttributeType': 'S'}],
                         ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
 
 def create_RVA_VIDEOS_LABELS_TABLE(dynamodb):
     dynamodb.create_table(TableName=VIDEO_LABELS_TABLE,
-                        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'},{'AttributeName': 'Key', 'KeyType': 'HASH'}],
-                        AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'},{'AttributeName': 'Key', 'AttributeType': 'S'}, {'AttributeName': 'Labels', 'AttributeType': 'S'},{'AttributeName': 'Time', 'AttributeType': 'S'}],
+                        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'},{'AttributeName': 'Key', 'KeyType': 'RANGE'}],
+                        AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'},{'AttributeName': 'Key', 'AttributeType': 'S'}],
                         ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
 
 if __name__ == '__main__':
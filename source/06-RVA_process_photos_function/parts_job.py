@@ -0,0 +1,79 @@
+from __future__ import print_function
+
+from collections import OrderedDict
+from update_expression import CounterUpdateBuilder
+
+# CONSTANTS
+GROUP_MAX_PARTS = 24 # a transaction writes at most 25 items, the markers of the parts and the counters
+
+
+class PartsJob:
+    '''
+    Parts of one video analyzed by the same invocation.
+
+    The parts share the thread pool and the results writer of the job, started with its first part.
+    The counters of each part are kept apart, so the video results of several parts are added at once
+    and only part by part when one of them was already added.
+    '''
+
+    def __init__(self, video_identifier, shards=None, lease_expires=None):
+        self.video_identifier = video_identifier
+        self.shards = shards
+        # Lease of the parts claimed by the invocation, unique to each claim of a part
+        self.lease_expires = lease_expires
+        self.collection_id = None
+        self.pool = None
+        self.results_writer = None
+        # Counters of the video results by part key, in processing order
+        self.parts = OrderedDict()
+        self.faces_indexed = 0
+        self.frames_skipped = 0
+
+    def add_part(self, key, counters, faces_indexed, frames_skipped):
+        self.parts[key] = counters
+        self.faces_indexed += faces_indexed
+        self.frames_skipped += frames_skipped
+
+    def drop_parts(self, keys):
+        '''
+        Leaves out the results of parts no longer leased to the job. Their faces are still indexed.
+        '''
+        for key in keys:
+            self.parts.pop(key, None)
+
+    def groups(self):
+        '''
+        Returns the parts of the job as (keys, counters) groups, each added with its own set of updates.
+
+        The updates of a part only depend on its key and counters, so a part gives the same updates and
+        markers whatever job it is added with. The parts added with a single update are grouped, up to
+        GROUP_MAX_PARTS, while the counters of the group still fit in a single update, which claims all
+        of them; every other part is a group of its own.
+        '''
+        groups = []
+        group = None
+
+        for key, counters in self.parts.items():
+            updates = len(counters.updates())
+
+            if updates > 1:
+                groups.append(([key], counters))
+                continue
+
+            if updates == 0:
+                continue
+
+            if group is not None and len(group[0]) < GROUP_MAX_PARTS:
+                merged = CounterUpdateBuilder(min(group[1].max_expression_size, counters.max_expression_size))
+                merged.merge(group[1])
+                merged.merge(counters)
+
+                if len(merged.updates()) == 1:
+                    group[0].append(key)
+                    group[1] = merged
+                    continue
+
+            group = [[key], counters]
+            groups.append(group)
+
+        return [tuple(group) for group in groups]
@@ -0,0 +1,65 @@
+import unittest
+import logging
+
+from parts_job import PartsJob
+from update_expression import CounterUpdateBuilder
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+def new_counters(faces, label_count):
+    builder = CounterUpdateBuilder()
+    builder.add(('NumberFaceDetails',), faces)
+    builder.add(('DetectedLabels', 'Person'), label_count)
+    return builder
+
+
+class TestPartsJob(unittest.TestCase):
+
+    def test_parts_of_the_job(self):
+        job = PartsJob('video.mp4', 4)
+        job.add_part('images/video.mp4/2.txt', new_counters(3, 1), 3, 0)
+        job.add_part('images/video.mp4/1.txt', new_counters(2, 4), 2, 5)
+
+        self.assertEqual(['images/video.mp4/2.txt', 'images/video.mp4/1.txt'], list(job.parts))
+        self.assertEqual((5, 5), (job.faces_indexed, job.frames_skipped))
+
+    def test_groups_of_single_update_parts(self):
+        job = PartsJob('video.mp4', 4)
+        job.add_part('images/video.mp4/2.txt', new_counters(3, 1), 3, 0)
+        job.add_part('images/video.mp4/1.txt', new_counters(2, 4), 2, 5)
+
+        groups = job.groups()
+        self.assertEqual([['images/video.mp4/2.txt', 'images/video.mp4/1.txt']], [keys for keys, _ in groups])
+        self.assertEqual({('NumberFaceDetails',): 5, ('DetectedLabels', 'Person'): 5}, groups[0][1].counters)
+        self.assertEqual(1, len(groups[0][1].updates()))
+
+        # The counters of the parts are left as they were
+        self.assertEqual(3, job.parts['images/video.mp4/2.txt'].counters[('NumberFaceDetails',)])
+
+    def test_groups_split_on_the_part_keys(self):
+        job = PartsJob('video.mp4')
+        job.add_part('k1', new_counters(1, 1), 1, 0)
+        job.add_part('k2', new_counters(1, 1), 1, 0)
+        job.add_part('k3', new_counters(1, 1), 1, 0)
+        job.add_part('k4', CounterUpdateBuilder(), 0, 0)
+
+        # A part split in several updates keeps its own, the others are grouped while they fit
+        job.parts['k2'].max_expression_size = 20
+        for key in ['k1', 'k3']:
+            job.parts[key].max_expression_size = 90
+
+        groups = job.groups()
+        self.assertEqual([['k1', 'k3'], ['k2']], sorted(keys for keys, _ in groups))
+        self.assertEqual(job.parts['k2'].updates(), [counters for keys, counters in groups if keys == ['k2']][0].updates())
+
+    def test_empty_job(self):
+        job = PartsJob('video.mp4')
+
+        self.assertEqual([], job.groups())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+from __future__ import print_function
+
+import logging
+import threading
+import sys, traceback
+from collections import deque
+
+logger = logging.getLogger()
+
+
+class TaskScheduler:
+    '''
+    Runs the calls to several APIs on one bounded thread pool.
+
+    Each API has its own number of concurrent slots and its own queue, so the calls to one API never
+    wait behind the calls to another one. Results are handed to the task callback as soon as the call
+    finishes, and callbacks may submit new tasks.
+
+    When an API has a concurrency controller, its capacity is read from the controller. The latency
+    is reported to the controller by the API call itself, see adaptive_concurrency.reports_latency.
+    '''
+
+    pool = None
+    default_capacity = 1
+
+    def __init__(self, pool, capacities, default_capacity=1, controllers=None):
+        self.pool = pool
+        self.capacities = dict(capacities)
+        self.default_capacity = default_capacity
+        self.controllers = dict(controllers or {})
+        self.queues = {}
+        self.running = {}
+        self.completed = {}
+        self.pending = 0
+        self.condition = threading.Condition()
+
+    def capacity(self, api):
+        if api in self.controllers:
+            return self.controllers[api].limit()
+
+        return self.capacities.get(api, self.default_capacity)
+
+    def submit(self, api, fn, params, callback=None):
+        with self.condition:
+            if api not in self.queues:
+                self.queues[api] = deque()
+                self.running[api] = 0
+                self.completed[api] = 0
+
+            self.queues[api].append((fn, params, callback))
+            self.pending += 1
+            self._dispatch()
+
+    def _dispatch(self):
+        # Must be called holding self.condition
+        for api, queue in self.queues.items():
+            while queue and self.running[api] < self.capacity(api):
+                fn, params, callback = queue.popleft()
+                self.running[api] += 1
+                self.pool.apply_async(self._run, (api, fn, params, callback))
+
+    def _run(self, api, fn, params, callback):
+        result = None
+
+        try:
+            result = fn(params)
+
+            if callback:
+                callback(result)
+        except Exception as e:
+            logger.error("TaskScheduler - error running task. API: '{}' Params: '{}'".format(api, params))
+            logger.error(e)
+            logger.error('-' * 60)
+            traceback.print_exc(file=sys.stdout)
+            logger.error('-' * 60)
+        finally:
+            with self.condition:
+                self.running[api] -= 1
+                self.completed[api] += 1
+                self.pending -= 1
+                self._dispatch()
+                self.condition.notify_all()
+
+        return result
+
+    def join(self):
+        with self.condition:
+            while self.pending > 0:
+                self.condition.wait()
+
+        logger.debug("TaskScheduler - completed calls: '{}'".format(self.completed))
+
+        return self.completed
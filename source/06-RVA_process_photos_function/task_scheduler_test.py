@@ -0,0 +1,116 @@
+import unittest
+import logging
+import threading
+import time
+from multiprocessing.dummy import Pool
+
+from task_scheduler import TaskScheduler
+from adaptive_concurrency import AIMDController, reports_latency
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+class ConcurrencyProbe(object):
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, params):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return params
+
+
+class TestTaskScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = Pool(6)
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def test_capacity_per_api(self):
+        faces = ConcurrencyProbe(0.02)
+        labels = ConcurrencyProbe(0.02)
+        scheduler = TaskScheduler(self.pool, {'IndexFaces': 2, 'DetectLabels': 4})
+
+        for i in range(20):
+            scheduler.submit('IndexFaces', faces, i)
+            scheduler.submit('DetectLabels', labels, i)
+
+        completed = scheduler.join()
+
+        self.assertEqual({'IndexFaces': 20, 'DetectLabels': 20}, completed)
+        self.assertEqual(2, faces.max_running)
+        self.assertEqual(4, labels.max_running)
+
+    def test_apis_run_concurrently(self):
+        faces = ConcurrencyProbe(0.1)
+        labels = ConcurrencyProbe(0.1)
+        scheduler = TaskScheduler(self.pool, {'IndexFaces': 3, 'DetectLabels': 3})
+
+        start = time.time()
+        for i in range(3):
+            scheduler.submit('IndexFaces', faces, i)
+            scheduler.submit('DetectLabels', labels, i)
+        scheduler.join()
+
+        # Running both APIs one after the other would take at least 0.2 s
+        self.assertLess(time.time() - start, 0.19)
+
+    def test_results_are_streamed_to_callbacks(self):
+        results = []
+        scheduler = TaskScheduler(self.pool, {}, default_capacity=2)
+
+        def follow_up(result):
+            results.append(result)
+            if result < 3:
+                scheduler.submit('FollowUp', lambda params: params, result + 10, results.append)
+
+        for i in range(5):
+            scheduler.submit('Call', lambda params: params, i, follow_up)
+        scheduler.join()
+
+        self.assertEqual([0, 1, 2, 3, 4, 10, 11, 12], sorted(results))
+
+    def test_failing_task_is_counted(self):
+        scheduler = TaskScheduler(self.pool, {}, default_capacity=2)
+
+        def fail(params):
+            raise ValueError(params)
+
+        scheduler.submit('Call', fail, 1)
+        scheduler.submit('Call', lambda params: params, 2)
+
+        self.assertEqual({'Call': 2}, scheduler.join())
+
+    def test_capacity_from_controller(self):
+        probe = ConcurrencyProbe(0.02)
+        controller = AIMDController('IndexFaces', 2, 1, 2)
+        faces = reports_latency(controller)(lambda params: probe(params))
+        scheduler = TaskScheduler(self.pool, {'IndexFaces': 6}, controllers={'IndexFaces': controller})
+
+        controller.on_throttle()
+        self.assertEqual(1, controller.limit())
+
+        for i in range(10):
+            scheduler.submit('IndexFaces', faces, i)
+        scheduler.join()
+
+        # The successful calls grow the limit back, never above the controller maximum
+        self.assertEqual(2, controller.limit())
+        self.assertEqual(2, probe.max_running)
+
+
+if __name__ == '__main__':
+    unittest.main()
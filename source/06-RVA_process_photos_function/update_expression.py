@@ -0,0 +1,140 @@
+from __future__ import print_function
+
+import logging
+from boto3.dynamodb.types import TypeSerializer
+
+logger = logging.getLogger()
+
+# CONSTANTS
+MAX_EXPRESSION_SIZE = 4096 # bytes, DynamoDB expression limit
+MARKER_ATTRIBUTE = 'Marker'
+MARKER_EXPIRES_ATTRIBUTE = 'ExpiresAt' # time to live of the marker items
+
+
+class CounterUpdateBuilder:
+    '''
+    Builds the update_item calls adding a set of counters to one item.
+
+    Every counter is added with one ADD action and the placeholders are numbered in order, so the
+    same counters always give the same expression. The counters are sorted by path and split into as
+    few updates as the expression size limit allows. With a batch key every update has its own marker,
+    an item of a marker table written in the same transaction as the update on condition that it is
+    not there yet, so a batch delivered again is not counted twice and the item updated doesn't grow.
+    With a list of batch keys, the counters of several batches added together, every update writes
+    the markers of all of them.
+    '''
+
+    def __init__(self, max_expression_size=MAX_EXPRESSION_SIZE):
+        self.max_expression_size = max_expression_size
+        self.counters = {}
+
+    def add(self, path, value):
+        '''
+        Adds value to the counter at path, a tuple of attribute names, e.g. ('DetectedLabels', 'Person').
+        '''
+        if value:
+            path = tuple(path)
+            self.counters[path] = self.counters.get(path, 0) + value
+
+    def merge(self, builder):
+        '''
+        Adds every counter of another builder.
+        '''
+        for path, value in builder.counters.items():
+            self.add(path, value)
+
+    def _new_update(self):
+        return {'Actions': [], 'Counters': 0, 'Names': {}, 'Placeholders': {}, 'Values': {}, 'Size': len('ADD ')}
+
+    def _action(self, update, path):
+        # Returns the action adding the counter and the placeholders it needs that are not in the update yet
+        new_names = {}
+        placeholders = []
+
+        for name in path:
+            if name not in update['Placeholders'] and name not in new_names:
+                new_names[name] = '#n{}'.format(len(update['Placeholders']) + len(new_names))
+            placeholders.append(update['Placeholders'].get(name) or new_names[name])
+
+        value_placeholder = ':v{}'.format(update['Counters'])
+
+        return '{} {}'.format('.'.join(placeholders), value_placeholder), new_names, value_placeholder
+
+    def updates(self):
+        '''
+        Returns the keyword arguments of every update_item call, in a deterministic order.
+        '''
+        updates = []
+        update = None
+
+        for path in sorted(self.counters):
+            if update is not None:
+                action, new_names, value_placeholder = self._action(update, path)
+                if update['Size'] + len(action) > self.max_expression_size and update['Counters'] > 0:
+                    update = None
+
+            if update is None:
+                update = self._new_update()
+                updates.append(update)
+                action, new_names, value_placeholder = self._action(update, path)
+
+            update['Actions'].append(action)
+            update['Counters'] += 1
+            update['Placeholders'].update(new_names)
+            update['Names'].update((placeholder, name) for name, placeholder in new_names.items())
+            update['Values'][value_placeholder] = self.counters[path]
+            update['Size'] += len(action) + len(', ')
+
+        return [self._update_item_args(update) for update in updates]
+
+    def _update_item_args(self, update):
+        return {
+            'UpdateExpression': 'ADD ' + ', '.join(update['Actions']),
+            'ExpressionAttributeNames': update['Names'],
+            'ExpressionAttributeValues': update['Values']
+        }
+
+    def markers(self, batch_key):
+        '''
+        Returns the markers of every update: the batch key for the first one and '<batch key>#<n>'
+        for the next ones, of every batch key of a list.
+        '''
+        batch_keys = batch_key if isinstance(batch_key, (list, tuple)) else [batch_key]
+
+        return [[key if part == 0 else '{}#{}'.format(key, part) for key in batch_keys] for part in range(len(self.updates()))]
+
+    def transactions(self, table_name, key, batch_key, marker_table_name, expires_at=None):
+        '''
+        Returns the TransactItems of every update, each one with the conditional put of its markers.
+        The markers are keyed by the key of the item updated, its first attribute, and the marker.
+        '''
+        serializer = TypeSerializer()
+        hash_name, hash_value = list(key.items())[0]
+        transactions = []
+
+        for update, markers in zip(self.updates(), self.markers(batch_key)):
+            transact_items = []
+
+            for marker in markers:
+                item = {hash_name: serializer.serialize(hash_value), MARKER_ATTRIBUTE: {'S': marker}}
+                if expires_at is not None:
+                    item[MARKER_EXPIRES_ATTRIBUTE] = {'N': str(int(expires_at))}
+
+                transact_items.append({'Put': {
+                    'TableName': marker_table_name,
+                    'Item': item,
+                    'ConditionExpression': 'attribute_not_exists(#m)',
+                    'ExpressionAttributeNames': {'#m': MARKER_ATTRIBUTE}
+                }})
+
+            transact_items.append({'Update': {
+                'TableName': table_name,
+                'Key': dict((name, serializer.serialize(value)) for name, value in key.items()),
+                'UpdateExpression': update['UpdateExpression'],
+                'ExpressionAttributeNames': update['ExpressionAttributeNames'],
+                'ExpressionAttributeValues': dict((name, serializer.serialize(value)) for name, value in update['ExpressionAttributeValues'].items())
+            }})
+
+            transactions.append(transact_items)
+
+        return transactions
@@ -0,0 +1,112 @@
+import unittest
+import boto3
+import logging
+
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb2
+
+from update_expression import CounterUpdateBuilder
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+VIDEOS_RESULTS_TABLE = 'RVA_VIDEOS_RESULTS_TABLE'
+VIDEOS_RESULTS_MARKERS_TABLE = 'RVA_VIDEOS_RESULTS_MARKERS_TABLE'
+
+
+def new_builder(labels, max_expression_size=4096):
+    builder = CounterUpdateBuilder(max_expression_size)
+    for i in range(labels):
+        builder.add(('DetectedLabels', 'Label {}'.format(i)), i + 1)
+    builder.add(('FaceDetails', 'Smile', 'Positive'), 2)
+    builder.add(('NumberFaceDetails',), 3)
+    return builder
+
+
+class TestCounterUpdateBuilder(unittest.TestCase):
+
+    def test_single_update_with_deterministic_placeholders(self):
+        updates = new_builder(2).updates()
+
+        self.assertEqual(1, len(updates))
+        self.assertEqual('ADD #n0.#n1 :v0, #n0.#n2 :v1, #n3.#n4.#n5 :v2, #n6 :v3', updates[0]['UpdateExpression'])
+        self.assertEqual({'#n0': 'DetectedLabels', '#n1': 'Label 0', '#n2': 'Label 1', '#n3': 'FaceDetails',
+                          '#n4': 'Smile', '#n5': 'Positive', '#n6': 'NumberFaceDetails'}, updates[0]['ExpressionAttributeNames'])
+        self.assertEqual({':v0': 1, ':v1': 2, ':v2': 2, ':v3': 3}, updates[0]['ExpressionAttributeValues'])
+        self.assertEqual(updates, new_builder(2).updates())
+
+    def test_zero_counters_are_skipped(self):
+        builder = CounterUpdateBuilder()
+        builder.add(('FaceDetails', 'Smile', 'Negative'), 0)
+
+        self.assertEqual([], builder.updates())
+
+    def test_split_on_expression_size(self):
+        updates = new_builder(400).updates()
+
+        self.assertLess(1, len(updates))
+        for update in updates:
+            self.assertLessEqual(len(update['UpdateExpression']), 4096)
+
+        self.assertEqual(402, sum(len(update['ExpressionAttributeValues']) for update in updates))
+        self.assertEqual(updates, new_builder(400).updates())
+
+        markers = new_builder(400).markers('images/video.mp4/batch.txt')
+        self.assertEqual(len(updates), len(markers))
+        self.assertEqual([['images/video.mp4/batch.txt'], ['images/video.mp4/batch.txt#1']], markers[:2])
+        self.assertEqual([['batch-1', 'batch-2'], ['batch-1#1', 'batch-2#1']], new_builder(400).markers(['batch-1', 'batch-2'])[:2])
+
+    @mock_dynamodb2
+    def test_batch_is_counted_once(self):
+        dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+        dynamodb.create_table(TableName=VIDEOS_RESULTS_TABLE,
+                            KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
+                            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+        dynamodb.create_table(TableName=VIDEOS_RESULTS_MARKERS_TABLE,
+                            KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}, {'AttributeName': 'Marker', 'KeyType': 'RANGE'}],
+                            AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}, {'AttributeName': 'Marker', 'AttributeType': 'S'}],
+                            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+        table = boto3.resource('dynamodb', region_name='us-east-1').Table(VIDEOS_RESULTS_TABLE)
+        table.put_item(Item={'Identifier': 'video.mp4', 'NumberFaceDetails': 0, 'DetectedLabels': {},
+                             'FaceDetails': {'Smile': {'Positive': 0, 'Negative': 0}}})
+
+        def write(builder, batch_key):
+            applied = 0
+            for transact_items in builder.transactions(VIDEOS_RESULTS_TABLE, {'Identifier': 'video.mp4'}, batch_key, VIDEOS_RESULTS_MARKERS_TABLE, 1000):
+                try:
+                    dynamodb.transact_write_items(TransactItems=transact_items)
+                    applied += 1
+                except ClientError as err:
+                    self.assertEqual('TransactionCanceledException', err.response['Error']['Code'])
+            return applied
+
+        self.assertEqual(2, sum(write(new_builder(2), batch_key) for batch_key in ['batch-1', 'batch-2', 'batch-1']))
+
+        item = table.get_item(Key={'Identifier': 'video.mp4'})['Item']
+        self.assertEqual(6, item['NumberFaceDetails'])
+        self.assertEqual(4, item['DetectedLabels']['Label 1'])
+        self.assertEqual(4, item['FaceDetails']['Smile']['Positive'])
+
+        # The markers are items of their own, the video results item doesn't grow
+        self.assertNotIn('ProcessedBatches', item)
+        markers = dynamodb.scan(TableName=VIDEOS_RESULTS_MARKERS_TABLE)['Items']
+        self.assertEqual([('video.mp4', 'batch-1', '1000'), ('video.mp4', 'batch-2', '1000')],
+                         sorted((marker['Identifier']['S'], marker['Marker']['S'], marker['ExpiresAt']['N']) for marker in markers))
+
+        # Batches added together are skipped when any of them was already added
+        builder = new_builder(2)
+        builder.merge(new_builder(2))
+        self.assertEqual(0, write(builder, ['batch-3', 'batch-1']))
+        self.assertEqual(1, write(builder, ['batch-3', 'batch-4']))
+
+        item = table.get_item(Key={'Identifier': 'video.mp4'})['Item']
+        self.assertEqual(12, item['NumberFaceDetails'])
+        self.assertEqual(4, dynamodb.scan(TableName=VIDEOS_RESULTS_MARKERS_TABLE)['Count'])
+
+
+if __name__ == '__main__':
+    unittest.main()
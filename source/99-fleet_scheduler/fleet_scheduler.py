@@ -0,0 +1,198 @@
+from __future__ import print_function
+
+from botocore.exceptions import ClientError
+import boto3
+import hashlib
+import json
+import logging
+import random
+import time
+
+logger = logging.getLogger()
+
+# CONSTANTS
+DEFAULT_WEIGHT = 1
+DEFAULT_TIER = 0
+SETTLE_SECONDS = 30  # slots granted are counted as processing until the video reports them
+STALE_SECONDS = 900  # videos not reported for this long release their slots
+MAX_RETRIES = 5
+RETRY_DELAY = 0.05 # seconds, doubled after every version conflict and jittered
+DEFAULT_SHARDS = 1
+
+
+def allocate(videos, free_slots, virtual_time):
+    '''
+    Hands out free_slots to the videos with pending parts, one at a time. Higher tiers are served
+    first and the videos of the same tier share the slots by weight with start-time fair queuing:
+    every slot takes the video with the smallest finish tag, Finish + 1/Weight. A video starts
+    waiting with its Finish at the virtual time, so it is served next to the videos already running
+    instead of behind them. Returns the slots granted to each video and the new virtual time.
+    '''
+    grants = {}
+
+    while free_slots > 0:
+        candidates = [video for video, entry in videos.items() if entry['Pending'] > grants.get(video, 0)]
+
+        if not candidates:
+            break
+
+        top_tier = max(videos[video]['Tier'] for video in candidates)
+        candidates = [video for video in candidates if videos[video]['Tier'] == top_tier]
+        video = min(candidates, key=lambda video: (videos[video]['Finish'] + 1.0 / videos[video]['Weight'], video))
+
+        entry = videos[video]
+        virtual_time = max(entry['Finish'], virtual_time)
+        entry['Finish'] += 1.0 / entry['Weight']
+        grants[video] = grants.get(video, 0) + 1
+        free_slots -= 1
+
+    return grants, virtual_time
+
+
+class FleetScheduler:
+    '''
+    Shares a fleet-wide number of dispatch slots between every video being processed.
+
+    The videos waiting for slots, their weight, tier and parts pending and processing are kept in a
+    control record, the same way the collections are kept by RekognitionCollectionController. Each
+    call reports the videos seen by the caller, hands out the free slots to all the videos in the
+    record and writes the record back conditioned on its version, so concurrent callers never
+    grant the same slot twice. A caller whose write conflicts backs off before reading it again.
+
+    With several shards each video belongs to the control record of one shard, which holds its own
+    share of the slots, so callers reporting videos of different shards never conflict. The videos
+    only share the slots of their shard: a video alone in its shard can't use the idle slots of the
+    others.
+    '''
+
+    def __init__(self, control_table_id, control_record_id, fleet_slots, dynamodb_client=None, shards=DEFAULT_SHARDS):
+        self.control_table_id = control_table_id
+        self.control_record_id = control_record_id
+        self.fleet_slots = fleet_slots
+        self.shards = max(1, min(shards, fleet_slots))
+        self.dynamodb_client = dynamodb_client or boto3.client('dynamodb')
+        self.time = time.time
+        self.sleep = time.sleep
+
+    def shard(self, video):
+        if isinstance(video, type(u'')):
+            video = video.encode('utf-8')
+
+        return int(hashlib.md5(video).hexdigest()[:8], 16) % self.shards
+
+    def shard_slots(self, shard):
+        return self.fleet_slots // self.shards + (1 if shard < self.fleet_slots % self.shards else 0)
+
+    def record_id(self, shard):
+        return self.control_record_id if self.shards == 1 else '{}#{}'.format(self.control_record_id, shard)
+
+    def schedule(self, demands):
+        '''
+        Reports the demand of some videos, a dict of {'Pending', 'Processing', 'Weight', 'Tier'} by
+        video identifier, and returns the number of parts each video can dispatch now. The videos
+        granted slots are not only the ones reported, but all belong to the shards of the ones reported.
+        '''
+        shard_demands = {}
+        for video, demand in demands.items():
+            shard_demands.setdefault(self.shard(video), {})[video] = demand
+
+        grants = {}
+        for shard, demands in sorted(shard_demands.items()):
+            grants.update(self.schedule_shard(shard, demands))
+
+        return grants
+
+    def schedule_shard(self, shard, demands):
+        slots = self.shard_slots(shard)
+
+        for mtries in range(MAX_RETRIES):
+            version, videos, virtual_time = self.get_control_record(shard)
+            now = self.time()
+
+            self.update_videos(videos, demands, virtual_time, now)
+
+            free_slots = slots - sum(entry['Processing'] for entry in videos.values())
+            grants, virtual_time = allocate(videos, free_slots, virtual_time)
+
+            for video, granted in grants.items():
+                videos[video]['Pending'] -= granted
+                videos[video]['Processing'] += granted
+                videos[video]['GrantedAt'] = now
+
+            if self.put_control_record(version, videos, virtual_time, shard):
+                logger.debug("FleetScheduler - shard: '{}' slots in use: '{}' grants: '{}'".format(shard, slots - free_slots + sum(grants.values()), grants))
+                return grants
+
+            logger.debug("FleetScheduler - control record changed. Retrying.")
+            self.sleep(random.uniform(0, RETRY_DELAY * 2 ** mtries))
+
+        logger.warn("FleetScheduler - control record '{}' busy, nothing dispatched.".format(self.record_id(shard)))
+
+        return {}
+
+    def update_videos(self, videos, demands, virtual_time, now):
+        for video, demand in demands.items():
+            entry = videos.setdefault(video, {'Finish': virtual_time, 'Pending': 0, 'Processing': 0, 'GrantedAt': 0})
+
+            # A video that was not waiting doesn't keep the credit of the time it had nothing pending
+            if entry['Pending'] <= 0:
+                entry['Finish'] = max(entry['Finish'], virtual_time)
+
+            entry['Pending'] = demand['Pending']
+            entry['Weight'] = max(demand.get('Weight', DEFAULT_WEIGHT), 1)
+            entry['Tier'] = demand.get('Tier', DEFAULT_TIER)
+            entry['UpdatedAt'] = now
+
+            # The parts just granted may not be processing yet
+            if now - entry['GrantedAt'] < SETTLE_SECONDS:
+                entry['Processing'] = max(demand['Processing'], entry['Processing'])
+            else:
+                entry['Processing'] = demand['Processing']
+
+        for video in list(videos):
+            entry = videos[video]
+            if entry['Pending'] <= 0 and entry['Processing'] <= 0:
+                del videos[video]
+            elif now - entry['UpdatedAt'] > STALE_SECONDS:
+                logger.warn("FleetScheduler - '{}' not reported since '{}'. Releasing its slots.".format(video, entry['UpdatedAt']))
+                del videos[video]
+
+    def get_control_record(self, shard=0):
+        r = self.dynamodb_client.get_item(
+            TableName=self.control_table_id,
+            Key={"Identifier": {"S": self.record_id(shard)}},
+            ConsistentRead=True
+        )
+
+        if 'Item' not in r:
+            return 0, {}, 0.0
+
+        item = r['Item']
+
+        return int(item['Version']['N']), json.loads(item['Videos']['S']), float(item['VirtualTime']['N'])
+
+    def put_control_record(self, version, videos, virtual_time, shard=0):
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.control_table_id,
+                Key={"Identifier": {"S": self.record_id(shard)}},
+                UpdateExpression="SET #ver = :newversion, #videos = :videos, #vt = :vt",
+                ConditionExpression="attribute_not_exists(#ver)" if version == 0 else "#ver = :version",
+                ExpressionAttributeNames={
+                    '#ver': 'Version',
+                    '#videos': 'Videos',
+                    '#vt': 'VirtualTime'
+                },
+                ExpressionAttributeValues=dict([
+                    (':newversion', {'N': str(version + 1)}),
+                    (':videos', {'S': json.dumps(videos, sort_keys=True)}),
+                    (':vt', {'N': repr(virtual_time)})
+                ] + ([(':version', {'N': str(version)})] if version else []))
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise err
+
+            return False
+
+        return True
@@ -0,0 +1,135 @@
+import unittest
+import boto3
+import logging
+
+from fleet_scheduler import FleetScheduler, allocate, STALE_SECONDS, RETRY_DELAY
+from moto import mock_dynamodb2
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+RVA_COLLECTION_CONTROL_TABLE = 'RVA_COLLECTION_CONTROL_TABLE'
+
+
+def new_entry(pending, weight=1, tier=0, finish=0.0):
+    return {'Pending': pending, 'Processing': 0, 'Weight': weight, 'Tier': tier, 'Finish': finish}
+
+
+class TestAllocate(unittest.TestCase):
+
+    def test_equal_weights_share_the_slots(self):
+        videos = {'feature.mp4': new_entry(1000), 'clip.mp4': new_entry(3)}
+
+        grants, _ = allocate(videos, 6, 0.0)
+
+        self.assertEqual({'feature.mp4': 3, 'clip.mp4': 3}, grants)
+
+    def test_weights(self):
+        videos = {'a.mp4': new_entry(100, weight=3), 'b.mp4': new_entry(100, weight=1)}
+
+        grants, _ = allocate(videos, 8, 0.0)
+
+        self.assertEqual({'a.mp4': 6, 'b.mp4': 2}, grants)
+
+    def test_new_video_is_not_behind(self):
+        # The feature film has been served for a while, the clip starts at the virtual time
+        videos = {'feature.mp4': new_entry(1000, finish=50.0)}
+        grants, virtual_time = allocate(videos, 10, 40.0)
+        self.assertEqual({'feature.mp4': 10}, grants)
+
+        videos['clip.mp4'] = new_entry(2, finish=virtual_time)
+        grants, _ = allocate(videos, 2, virtual_time)
+
+        self.assertEqual({'clip.mp4': 2}, grants)
+
+    def test_priority_tiers(self):
+        videos = {'low.mp4': new_entry(10), 'high.mp4': new_entry(3, tier=1)}
+
+        grants, _ = allocate(videos, 5, 0.0)
+
+        self.assertEqual({'high.mp4': 3, 'low.mp4': 2}, grants)
+
+
+class TestFleetScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_dynamodb2()
+        self.mock.start()
+
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(TableName=RVA_COLLECTION_CONTROL_TABLE,
+            KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+        self.scheduler = FleetScheduler(RVA_COLLECTION_CONTROL_TABLE, 'DISPATCH', 10, dynamodb)
+        self.scheduler.time = lambda: 1000.0
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_fleet_limit(self):
+        grants = self.scheduler.schedule({'feature.mp4': {'Pending': 500, 'Processing': 0}})
+        self.assertEqual({'feature.mp4': 10}, grants)
+
+        # Every slot is in use, the new video waits for the next one released
+        grants = self.scheduler.schedule({'clip.mp4': {'Pending': 3, 'Processing': 0}})
+        self.assertEqual({}, grants)
+
+        self.scheduler.time = lambda: 1100.0
+        grants = self.scheduler.schedule({'feature.mp4': {'Pending': 488, 'Processing': 8}})
+        self.assertEqual({'clip.mp4': 2}, grants)
+
+    def test_stale_video_releases_its_slots(self):
+        self.scheduler.schedule({'feature.mp4': {'Pending': 500, 'Processing': 0}})
+
+        self.scheduler.time = lambda: 1000.0 + STALE_SECONDS + 1
+        grants = self.scheduler.schedule({'clip.mp4': {'Pending': 3, 'Processing': 0}})
+
+        self.assertEqual({'clip.mp4': 3}, grants)
+
+    def test_version_conflict(self):
+        get_control_record = self.scheduler.get_control_record
+
+        def concurrent_get_control_record(shard=0):
+            # Another caller writes the record between the read and the write
+            version, videos, virtual_time = get_control_record(shard)
+            if version == 0:
+                self.scheduler.put_control_record(version, {}, 0.0)
+            return version, videos, virtual_time
+
+        self.scheduler.get_control_record = concurrent_get_control_record
+        sleeps = []
+        self.scheduler.sleep = sleeps.append
+
+        self.assertEqual({'clip.mp4': 3}, self.scheduler.schedule({'clip.mp4': {'Pending': 3, 'Processing': 0}}))
+        self.assertEqual(2, self.scheduler.get_control_record()[0])
+
+        # The caller backed off before reading the record again
+        self.assertEqual(1, len(sleeps))
+        self.assertLessEqual(sleeps[0], RETRY_DELAY)
+
+    def test_shards(self):
+        scheduler = FleetScheduler(RVA_COLLECTION_CONTROL_TABLE, 'DISPATCH', 10, boto3.client('dynamodb'), shards=2)
+        scheduler.time = lambda: 1000.0
+
+        # feature.mp4 and clip.mp4 belong to the shard 0, trailer.mp4 to the shard 1, each shard has 5 slots
+        grants = scheduler.schedule({'feature.mp4': {'Pending': 500, 'Processing': 0}, 'trailer.mp4': {'Pending': 500, 'Processing': 0}})
+        self.assertEqual({'feature.mp4': 5, 'trailer.mp4': 5}, grants)
+
+        self.assertEqual(['feature.mp4'], list(scheduler.get_control_record(0)[1]))
+        self.assertEqual(['trailer.mp4'], list(scheduler.get_control_record(1)[1]))
+
+        grants = scheduler.schedule({'clip.mp4': {'Pending': 3, 'Processing': 0}})
+        self.assertEqual({}, grants)
+
+        scheduler.time = lambda: 1100.0
+        grants = scheduler.schedule({'feature.mp4': {'Pending': 495, 'Processing': 3}})
+        self.assertEqual({'clip.mp4': 2}, grants)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+from __future__ import print_function
+
+from botocore.client import Config
+import boto3
+import json
+import logging
+import os
+import sys, traceback
+import threading
+
+logger = logging.getLogger()
+
+# CONSTANTS
+PUBLISH_MODE_DIRECT = 'direct' # iot-data publish from the caller
+PUBLISH_MODE_RELAY = 'relay'   # one invocation of the IoT publish function per flush
+MESSAGE_TYPE_STATUS = 'status'
+MAX_POOL_CONNECTIONS = 10
+QOS = 1
+
+
+def superseded(messages):
+    '''
+    Returns the messages left once the status messages followed by a newer status of the same topic
+    are dropped. Every other message is kept, in order.
+    '''
+    last_status = {}
+
+    for i, message in enumerate(messages):
+        if message['type'] == MESSAGE_TYPE_STATUS:
+            last_status[message['topic']] = i
+
+    return [message for i, message in enumerate(messages)
+            if message['type'] != MESSAGE_TYPE_STATUS or last_status[message['topic']] == i]
+
+
+class IotPublisher:
+    '''
+    Publishes the IoT messages of a function, the JSON payloads the IoT publish functions take.
+
+    The messages are queued and sent by flush(), from the handler before it returns or every
+    flush_interval seconds from a background thread. A flush only sends the last status of each
+    topic. In direct mode the messages are published with a pooled iot-data client. In relay mode,
+    or when the direct publish fails, they are all sent to relay_function in a single invocation.
+    '''
+
+    def __init__(self, relay_function=None, mode=PUBLISH_MODE_DIRECT, flush_interval=0, iot_data_client=None, lambda_client=None):
+        self.relay_function = relay_function
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.iot_data_client = iot_data_client
+        self.lambda_client = lambda_client
+        self.messages = []
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.stopped = threading.Event()
+
+        if self.mode == PUBLISH_MODE_DIRECT and self.iot_data_client is None:
+            self.iot_data_client = boto3.client('iot-data', region_name=os.environ['AWS_DEFAULT_REGION'],
+                                                config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+        if self.relay_function and self.lambda_client is None:
+            self.lambda_client = boto3.client('lambda', region_name=os.environ['AWS_DEFAULT_REGION'])
+
+    def publish(self, payload):
+        '''
+        Queues a message, a JSON payload with its 'topic', 'type' and 'payload'.
+        '''
+        with self.lock:
+            self.messages.append(json.loads(payload))
+
+        if self.flush_interval > 0 and self.flush_thread is None:
+            self.start()
+
+    def flush(self):
+        '''
+        Sends the messages queued so far. Returns the number of messages sent.
+        '''
+        with self.lock:
+            messages = superseded(self.messages)
+            self.messages = []
+
+        if not messages:
+            return 0
+
+        left = self.publish_direct(messages) if self.mode == PUBLISH_MODE_DIRECT else messages
+
+        if left:
+            self.publish_relay(left)
+
+        return len(messages)
+
+    def publish_direct(self, messages):
+        '''
+        Publishes the messages to IoT. Returns the messages not published.
+        '''
+        for i, message in enumerate(messages):
+            try:
+                self.iot_data_client.publish(
+                    topic=message['topic'],
+                    qos=QOS,
+                    payload=json.dumps({'type': message['type'], 'payload': message['payload']})
+                )
+            except Exception as e:
+                logger.error("IotPublisher - error publishing to '{}'".format(message['topic']))
+                logger.error(e)
+
+                if self.relay_function:
+                    return messages[i:]
+
+        return []
+
+    def publish_relay(self, messages):
+        if not self.relay_function:
+            logger.error("IotPublisher - no relay function, {} messages dropped".format(len(messages)))
+            return
+
+        try:
+            self.lambda_client.invoke(
+                FunctionName=self.relay_function,
+                InvocationType='Event',
+                LogType='None',
+                Payload=json.dumps({'messages': messages})
+            )
+        except Exception as e:
+            logger.error(e)
+            logger.error('-' * 10)
+            traceback.print_exc(file=sys.stdout)
+            logger.error('-' * 10)
+
+    def start(self):
+        '''
+        Starts the background thread flushing the messages every flush_interval seconds.
+        '''
+        with self.lock:
+            if self.flush_thread is not None:
+                return
+
+            self.stopped.clear()
+            self.flush_thread = threading.Thread(name='iot_publisher', target=self.run)
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        '''
+        Stops the background thread, if any, and sends the messages left.
+        '''
+        if self.flush_thread is not None:
+            self.stopped.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+
+        return self.flush()
@@ -0,0 +1,88 @@
+import unittest
+import mock
+import json
+import logging
+import os
+
+from iot_publisher import IotPublisher, superseded, PUBLISH_MODE_DIRECT, PUBLISH_MODE_RELAY
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+TOPIC = 'rekognition/video-topic'
+
+
+def status(percentage, topic=TOPIC):
+    return json.dumps({'topic': topic, 'type': 'status', 'payload': {'message': 'Analyzing frames', 'percentage': percentage}})
+
+
+def redirect(topic=TOPIC):
+    return json.dumps({'topic': topic, 'type': 'redirect', 'payload': {'identifier': 'video.mp4'}})
+
+
+class TestIotPublisher(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+        self.iot_data = mock.Mock()
+        self.lambda_client = mock.Mock()
+
+    def published(self):
+        return [(call[1]['topic'], json.loads(call[1]['payload'])) for call in self.iot_data.publish.call_args_list]
+
+    def test_superseded(self):
+        messages = [json.loads(m) for m in [status(10), status(20, 'other'), status(30), redirect(), status(40, 'other')]]
+
+        self.assertEqual([messages[2], messages[3], messages[4]], superseded(messages))
+
+    def test_direct(self):
+        publisher = IotPublisher('relay', PUBLISH_MODE_DIRECT, iot_data_client=self.iot_data, lambda_client=self.lambda_client)
+
+        publisher.publish(status(10))
+        publisher.publish(status(20))
+        publisher.publish(redirect())
+        self.iot_data.publish.assert_not_called()
+
+        self.assertEqual(2, publisher.flush())
+        self.assertEqual([(TOPIC, {'type': 'status', 'payload': {'message': 'Analyzing frames', 'percentage': 20}}),
+                          (TOPIC, {'type': 'redirect', 'payload': {'identifier': 'video.mp4'}})], self.published())
+        self.assertEqual(0, publisher.flush())
+        self.lambda_client.invoke.assert_not_called()
+
+    def test_relay(self):
+        publisher = IotPublisher('relay', PUBLISH_MODE_RELAY, iot_data_client=self.iot_data, lambda_client=self.lambda_client)
+
+        publisher.publish(status(10))
+        publisher.publish(status(20, 'other'))
+        publisher.flush()
+
+        self.iot_data.publish.assert_not_called()
+        self.assertEqual(1, self.lambda_client.invoke.call_count)
+        self.assertEqual('relay', self.lambda_client.invoke.call_args[1]['FunctionName'])
+        self.assertEqual(2, len(json.loads(self.lambda_client.invoke.call_args[1]['Payload'])['messages']))
+
+    def test_direct_error_relays(self):
+        self.iot_data.publish.side_effect = [None, Exception('Throttled')]
+        publisher = IotPublisher('relay', PUBLISH_MODE_DIRECT, iot_data_client=self.iot_data, lambda_client=self.lambda_client)
+
+        publisher.publish(status(10))
+        publisher.publish(status(20, 'other'))
+        publisher.publish(redirect())
+        publisher.flush()
+
+        messages = json.loads(self.lambda_client.invoke.call_args[1]['Payload'])['messages']
+        self.assertEqual(['other', TOPIC], [message['topic'] for message in messages])
+
+    def test_background_flush(self):
+        publisher = IotPublisher(mode=PUBLISH_MODE_DIRECT, flush_interval=0.01, iot_data_client=self.iot_data)
+
+        publisher.publish(status(10))
+        publisher.close()
+
+        self.assertEqual(1, self.iot_data.publish.call_count)
+        self.assertIsNone(publisher.flush_thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,328 @@
+from __future__ import print_function
+
+from botocore.exceptions import ClientError
+import hashlib
+import logging
+import random
+import re
+import time
+
+logger = logging.getLogger()
+
+# CONSTANTS
+PARTS_LAYOUT_MAP = 'MAP'       # every part in the Parts map of the process item
+PARTS_LAYOUT_ITEMS = 'ITEMS'   # one item per part in the parts table
+PENDING_INDEX = 'PendingParts' # sparse index with only the parts still pending
+LEASES_INDEX = 'LeasedParts'   # sparse index with only the parts being processed, by lease expiry
+STATUS_PENDING = 'PENDING'
+STATUS_PROCESSING = 'PROCESSING'
+STATUS_COMPLETED = 'COMPLETED'
+STATUS_FAILED = 'FAILED'
+STATUS_COUNTERS = {
+    STATUS_PENDING: 'PendingCount',
+    STATUS_PROCESSING: 'ProcessingCount',
+    STATUS_COMPLETED: 'CompletedCount',
+    STATUS_FAILED: 'FailedCount'
+}
+DEFAULT_SHARDS = 10
+PARTS_MAPS_MAX_BYTES = 8192 # every status change rewrites the process item, 1 write unit per KB
+PART_ENTRY_BYTES = 25       # status, lease expiry, attempts and the map overhead of one part
+BATCH_WRITE_MAX_ITEMS = 25 # BatchWriteItem limit
+BATCH_GET_MAX_ITEMS = 100  # BatchGetItem limit
+QUERY_PAGE_SIZE = 100
+MAX_RETRIES = 5
+TRANSACTION_RETRY_DELAY = 0.05 # seconds, doubled after every conflict and jittered
+TRANSACTION_RETRY_REASONS = ('TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded')
+
+
+def part_shard(video_identifier, key, shards):
+    '''
+    Returns the partition key of a part. The shard is the first 32 bits of the MD5 of the part key,
+    so it can be computed by the preprocess service as well, e.g. $(( 0x$(echo -n $KEY | md5sum | cut -c1-8) % $SHARDS )).
+    The MD5 is the one of the UTF-8 bytes of the key, as md5sum hashes them.
+    '''
+    if isinstance(key, type(u'')):
+        key = key.encode('utf-8')
+
+    return '{}#{}'.format(video_identifier, int(hashlib.md5(key).hexdigest()[:8], 16) % shards)
+
+
+def cancellation_reasons(err):
+    '''
+    Returns the code of the cancellation reason of every action of a canceled transaction, 'None'
+    for the actions that did not cancel it.
+    '''
+    if 'CancellationReasons' in err.response:
+        return [reason.get('Code', 'None') for reason in err.response['CancellationReasons']]
+
+    # Some endpoints only list them in the message
+    reasons = re.search(r'\[(.*)\]', err.response['Error'].get('Message', ''))
+    return [reason.strip() for reason in reasons.group(1).split(',')] if reasons else []
+
+
+def write_transaction(dynamodb_client, transact_items, sleep=time.sleep):
+    '''
+    Writes the items of a transaction, retried with a jittered backoff while it conflicts with other
+    writes of the same items. Returns None once written and the cancellation reasons when a condition
+    of the transaction failed.
+    '''
+    mtries = 0
+
+    while True:
+        try:
+            dynamodb_client.transact_write_items(TransactItems=transact_items)
+            return None
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'TransactionCanceledException':
+                raise err
+
+            reasons = cancellation_reasons(err)
+
+            if 'ConditionalCheckFailed' in reasons:
+                return reasons
+
+            if mtries >= MAX_RETRIES or not any(reason in TRANSACTION_RETRY_REASONS for reason in reasons):
+                raise err
+
+            sleep(random.uniform(0, TRANSACTION_RETRY_DELAY * 2 ** mtries))
+            mtries += 1
+
+
+def parts_layout(row):
+    '''
+    Returns the layout of a process item read with the low level client or from the stream.
+    '''
+    return row.get('PartsLayout', {}).get('S', PARTS_LAYOUT_MAP)
+
+
+def parts_maps_size(keys):
+    '''
+    Returns an estimate of the size of the Parts, LeaseExpires and Attempts maps of a process item
+    with these part keys, each key being stored in the three maps. The preprocess service computes
+    the same estimate to choose the layout of a video.
+    '''
+    return sum(3 * len(key) + PART_ENTRY_BYTES for key in keys)
+
+
+def layout_for_parts(keys, max_bytes=PARTS_MAPS_MAX_BYTES):
+    '''
+    Returns the layout of a video with these part keys: the parts table once the maps of the process
+    item would be larger than max_bytes.
+    '''
+    return PARTS_LAYOUT_ITEMS if parts_maps_size(keys) > max_bytes else PARTS_LAYOUT_MAP
+
+
+class PartTracker:
+    '''
+    Status of the parts of a video kept as one item per part.
+
+    The parts of a video are spread over `shards` partition keys ('<video>#<n>'), so the workers of
+    the same video don't write to the same item. A pending part also has a PendingKey, the sort key
+    of the sparse PendingParts index, and the pending parts are found with a query on that index
+    instead of reading every part. A part being processed has a LeaseExpires, the sort key of the
+    sparse LeasedParts index, so the parts whose worker was lost are found the same way. The status
+    counters of the process item are updated in the same transaction as the status of the part, its
+    stream is what triggers the orchestrator.
+    '''
+
+    def __init__(self, dynamodb_client, process_table_name, parts_table_name):
+        self.dynamodb_client = dynamodb_client
+        self.process_table_name = process_table_name
+        self.parts_table_name = parts_table_name
+        self.sleep = time.sleep
+
+    def put_parts(self, video_identifier, keys, shards):
+        '''
+        Writes every part of a video as pending.
+        '''
+        for i in range(0, len(keys), BATCH_WRITE_MAX_ITEMS):
+            request_items = {self.parts_table_name: [{'PutRequest': {'Item': {
+                'Shard': {'S': part_shard(video_identifier, key, shards)},
+                'Key': {'S': key},
+                'Identifier': {'S': video_identifier},
+                'Status': {'S': STATUS_PENDING},
+                'PendingKey': {'S': key}
+            }}} for key in keys[i:i + BATCH_WRITE_MAX_ITEMS]]}
+
+            mtries = 0
+            while request_items:
+                request_items = self.dynamodb_client.batch_write_item(RequestItems=request_items).get('UnprocessedItems', {})
+                if request_items:
+                    if mtries >= MAX_RETRIES:
+                        raise Exception("Parts of '{}' not written".format(video_identifier))
+                    self.sleep(min(2 ** mtries, 15) / 2.0)
+                    mtries += 1
+
+    def pending_parts(self, video_identifier, shards, limit, first_shard=0):
+        '''
+        Yields up to limit parts still pending, reading the shards in turn from first_shard.
+        '''
+        found = 0
+
+        for i in range(shards):
+            query = {
+                'TableName': self.parts_table_name,
+                'IndexName': PENDING_INDEX,
+                'KeyConditionExpression': 'Shard = :shard',
+                'ExpressionAttributeValues': {':shard': {'S': '{}#{}'.format(video_identifier, (first_shard + i) % shards)}},
+                'Limit': min(QUERY_PAGE_SIZE, limit)
+            }
+
+            while True:
+                response = self.dynamodb_client.query(**query)
+
+                for item in response.get('Items', []):
+                    yield item['Key']['S']
+                    found += 1
+                    if found >= limit:
+                        return
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def expired_leases(self, video_identifier, shards, now):
+        '''
+        Yields the key, lease expiry and attempts of the parts whose lease expired before now.
+        '''
+        for shard in range(shards):
+            query = {
+                'TableName': self.parts_table_name,
+                'IndexName': LEASES_INDEX,
+                'KeyConditionExpression': 'Shard = :shard AND LeaseExpires < :now',
+                'ExpressionAttributeValues': {':shard': {'S': '{}#{}'.format(video_identifier, shard)}, ':now': {'N': str(int(now))}}
+            }
+
+            while True:
+                response = self.dynamodb_client.query(**query)
+
+                for item in response.get('Items', []):
+                    yield item['Key']['S'], int(item['LeaseExpires']['N']), int(item.get('Attempts', {}).get('N', 0))
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def leased_parts(self, video_identifier, keys, shards, lease_expires):
+        '''
+        Returns the keys of the parts still processing under the lease lease_expires.
+        '''
+        leased = set()
+        request_keys = [{'Shard': {'S': part_shard(video_identifier, key, shards)}, 'Key': {'S': key}} for key in keys]
+
+        for i in range(0, len(request_keys), BATCH_GET_MAX_ITEMS):
+            request_items = {self.parts_table_name: {
+                'Keys': request_keys[i:i + BATCH_GET_MAX_ITEMS],
+                'ProjectionExpression': '#key, #status, LeaseExpires',
+                'ExpressionAttributeNames': {'#key': 'Key', '#status': 'Status'},
+                'ConsistentRead': True
+            }}
+
+            mtries = 0
+            while request_items:
+                response = self.dynamodb_client.batch_get_item(RequestItems=request_items)
+
+                for item in response.get('Responses', {}).get(self.parts_table_name, []):
+                    if item['Status']['S'] == STATUS_PROCESSING and int(item.get('LeaseExpires', {}).get('N', 0)) == int(lease_expires):
+                        leased.add(item['Key']['S'])
+
+                request_items = response.get('UnprocessedKeys', {})
+                if request_items:
+                    if mtries >= MAX_RETRIES:
+                        raise Exception("Parts of '{}' not read".format(video_identifier))
+                    self.sleep(min(2 ** mtries, 15) / 2.0)
+                    mtries += 1
+
+        return leased
+
+    def count_parts(self, video_identifier, shards):
+        '''
+        Returns the number of pending, processing, completed and failed parts reading every part of the video.
+        '''
+        counts = {STATUS_PENDING: 0, STATUS_PROCESSING: 0, STATUS_COMPLETED: 0, STATUS_FAILED: 0}
+
+        for shard in range(shards):
+            query = {
+                'TableName': self.parts_table_name,
+                'KeyConditionExpression': 'Shard = :shard',
+                'ProjectionExpression': '#status',
+                'ExpressionAttributeNames': {'#status': 'Status'},
+                'ExpressionAttributeValues': {':shard': {'S': '{}#{}'.format(video_identifier, shard)}},
+                'ConsistentRead': True
+            }
+
+            while True:
+                response = self.dynamodb_client.query(**query)
+
+                for item in response.get('Items', []):
+                    status = item['Status']['S']
+                    if status in counts:
+                        counts[status] += 1
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        return counts[STATUS_PENDING], counts[STATUS_PROCESSING], counts[STATUS_COMPLETED], counts[STATUS_FAILED]
+
+    def start_part(self, video_identifier, key, shards, lease_expires):
+        '''
+        Moves a part from pending to processing, leased until lease_expires. Returns False when the
+        part was not pending.
+        '''
+        return self._change_status(video_identifier, key, shards, STATUS_PENDING, STATUS_PROCESSING,
+                                   'SET #status = :new, LeaseExpires = :expires ADD Attempts :one REMOVE PendingKey', '#status = :old',
+                                   {':expires': {'N': str(int(lease_expires))}, ':one': {'N': '1'}})
+
+    def complete_part(self, video_identifier, key, shards, lease_expires=None):
+        '''
+        Moves a part from processing to completed. Returns False when the part was not processing,
+        already completed or, with lease_expires, not under that lease anymore.
+        '''
+        if lease_expires is not None:
+            return self._change_status(video_identifier, key, shards, STATUS_PROCESSING, STATUS_COMPLETED,
+                                       'SET #status = :new REMOVE LeaseExpires', '#status = :old AND LeaseExpires = :expires',
+                                       {':expires': {'N': str(int(lease_expires))}})
+
+        return self._change_status(video_identifier, key, shards, STATUS_PROCESSING, STATUS_COMPLETED,
+                                   'SET #status = :new REMOVE LeaseExpires', '#status = :old')
+
+    def reclaim_part(self, video_identifier, key, shards, lease_expires, failed=False):
+        '''
+        Moves a part whose lease expired back to pending, or to failed. Returns False when the part
+        is not under that lease anymore.
+        '''
+        if failed:
+            return self._change_status(video_identifier, key, shards, STATUS_PROCESSING, STATUS_FAILED,
+                                       'SET #status = :new REMOVE LeaseExpires', '#status = :old AND LeaseExpires = :expires',
+                                       {':expires': {'N': str(int(lease_expires))}})
+
+        return self._change_status(video_identifier, key, shards, STATUS_PROCESSING, STATUS_PENDING,
+                                   'SET #status = :new, PendingKey = :key REMOVE LeaseExpires', '#status = :old AND LeaseExpires = :expires',
+                                   {':expires': {'N': str(int(lease_expires))}, ':key': {'S': key}})
+
+    def _change_status(self, video_identifier, key, shards, old_status, new_status, update_expression, condition_expression, values=None):
+        expression_values = {':old': {'S': old_status}, ':new': {'S': new_status}}
+        expression_values.update(values or {})
+
+        transact_items = [{'Update': {
+            'TableName': self.parts_table_name,
+            'Key': {'Shard': {'S': part_shard(video_identifier, key, shards)}, 'Key': {'S': key}},
+            'UpdateExpression': update_expression,
+            'ConditionExpression': condition_expression,
+            'ExpressionAttributeNames': {'#status': 'Status'},
+            'ExpressionAttributeValues': expression_values
+        }}, {'Update': {
+            'TableName': self.process_table_name,
+            'Key': {'Identifier': {'S': video_identifier}},
+            'UpdateExpression': 'ADD #old :dec, #new :inc',
+            'ExpressionAttributeNames': {'#old': STATUS_COUNTERS[old_status], '#new': STATUS_COUNTERS[new_status]},
+            'ExpressionAttributeValues': {':dec': {'N': '-1'}, ':inc': {'N': '1'}}
+        }}]
+
+        # The workers of a video all update its process item, so their transactions can conflict
+        if write_transaction(self.dynamodb_client, transact_items, self.sleep) is not None:
+            logger.warn("Part '{}' of '{}' is not {}. Skipping.".format(key, video_identifier, old_status))
+            return False
+
+        return True
@@ -0,0 +1,202 @@
+import unittest
+import boto3
+import logging
+import mock
+import os
+import re
+import subprocess
+
+from part_tracking import PartTracker, part_shard, parts_layout, parts_maps_size, layout_for_parts, PARTS_LAYOUT_MAP, PARTS_LAYOUT_ITEMS, PENDING_INDEX, LEASES_INDEX
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb2
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+RVA_PROCESS_TABLE = 'RVA_PROCESS_TABLE'
+RVA_PROCESS_PARTS_TABLE = 'RVA_PROCESS_PARTS_TABLE'
+VIDEO_IDENTIFIER = 'VideoFile.mp4'
+SHARDS = 4
+PREPROCESS_SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '01-PreProcessService', 'opt', 'video-frame-based-analysis', 'preprocess-service.sh')
+
+
+def batch_keys(frames, batch_size, video_identifier='fun-at-fair-343902224.mp4'):
+    # The batches written by the preprocess service, one frame per second
+    return ['images/{}/{}.txt'.format(video_identifier, i) for i in range(1, (frames + batch_size - 1) // batch_size + 1)]
+
+
+class TestPartTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_dynamodb2()
+        self.mock.start()
+
+        self.dynamodb = boto3.client('dynamodb')
+        create_tables(self.dynamodb)
+
+        self.keys = ['images/{}/{}.txt'.format(VIDEO_IDENTIFIER, i) for i in range(1, 61)]
+        self.dynamodb.put_item(TableName=RVA_PROCESS_TABLE, Item={
+            'Identifier': {'S': VIDEO_IDENTIFIER},
+            'PartsLayout': {'S': PARTS_LAYOUT_ITEMS},
+            'PartShards': {'N': str(SHARDS)},
+            'PendingCount': {'N': str(len(self.keys))},
+            'ProcessingCount': {'N': '0'},
+            'CompletedCount': {'N': '0'},
+            'FailedCount': {'N': '0'}
+        })
+
+        self.tracker = PartTracker(self.dynamodb, RVA_PROCESS_TABLE, RVA_PROCESS_PARTS_TABLE)
+        self.tracker.put_parts(VIDEO_IDENTIFIER, self.keys, SHARDS)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def counters(self):
+        item = self.dynamodb.get_item(TableName=RVA_PROCESS_TABLE, Key={'Identifier': {'S': VIDEO_IDENTIFIER}})['Item']
+        return tuple(int(item[counter]['N']) for counter in ['PendingCount', 'ProcessingCount', 'CompletedCount', 'FailedCount'])
+
+    def test_part_shard(self):
+        shards = set(part_shard(VIDEO_IDENTIFIER, key, SHARDS) for key in self.keys)
+
+        self.assertEqual(set('{}#{}'.format(VIDEO_IDENTIFIER, i) for i in range(SHARDS)), shards)
+        self.assertEqual(part_shard(VIDEO_IDENTIFIER, self.keys[0], SHARDS), part_shard(VIDEO_IDENTIFIER, self.keys[0], SHARDS))
+
+        # Same shard as $(( 0x$(echo -n $KEY | md5sum | cut -c1-8) % $SHARDS )) for a non-ASCII key
+        key = u'images/vid\u00e9o.mp4/batch-1.txt'
+        self.assertEqual('{}#{}'.format(VIDEO_IDENTIFIER, 0x550f92dd % SHARDS), part_shard(VIDEO_IDENTIFIER, key, SHARDS))
+        self.assertEqual(part_shard(VIDEO_IDENTIFIER, key, SHARDS), part_shard(VIDEO_IDENTIFIER, key.encode('utf-8'), SHARDS))
+
+    def test_parts_layout(self):
+        self.assertEqual(PARTS_LAYOUT_MAP, parts_layout({'Parts': {'M': {}}}))
+        self.assertEqual(PARTS_LAYOUT_ITEMS, parts_layout({'PartsLayout': {'S': PARTS_LAYOUT_ITEMS}}))
+
+    def test_layout_for_parts(self):
+        # 10 minutes, 20 frames per batch
+        self.assertEqual(PARTS_LAYOUT_MAP, layout_for_parts(batch_keys(600, 20)))
+        # 2 hours, 80 frames per batch
+        self.assertEqual(PARTS_LAYOUT_ITEMS, layout_for_parts(batch_keys(7200, 80)))
+
+    def test_preprocess_service_parts_maps_size(self):
+        with open(PREPROCESS_SERVICE) as script_file:
+            script = script_file.read()
+
+        constants = re.search(r'^PART_ENTRY_BYTES=.*$', script, re.M).group(0)
+        function = re.search(r'^function parts_maps_size \{.*?^\}$', script, re.M | re.S).group(0)
+        keys = batch_keys(7200, 80)
+
+        size = subprocess.check_output(['bash', '-c', '\n'.join([constants, function, 'parts_maps_size "$@"']), 'bash'] + keys)
+
+        self.assertEqual(parts_maps_size(keys), int(size))
+
+    def test_pending_parts(self):
+        self.assertEqual(5, len(list(self.tracker.pending_parts(VIDEO_IDENTIFIER, SHARDS, 5))))
+        self.assertEqual(sorted(self.keys), sorted(self.tracker.pending_parts(VIDEO_IDENTIFIER, SHARDS, 1000, first_shard=2)))
+
+    def test_start_and_complete_part(self):
+        key = self.keys[0]
+
+        self.assertTrue(self.tracker.start_part(VIDEO_IDENTIFIER, key, SHARDS, 1000))
+        self.assertFalse(self.tracker.start_part(VIDEO_IDENTIFIER, key, SHARDS, 1000))
+        self.assertEqual((59, 1, 0, 0), self.counters())
+        self.assertNotIn(key, list(self.tracker.pending_parts(VIDEO_IDENTIFIER, SHARDS, 1000)))
+
+        self.assertTrue(self.tracker.complete_part(VIDEO_IDENTIFIER, key, SHARDS))
+        self.assertFalse(self.tracker.complete_part(VIDEO_IDENTIFIER, key, SHARDS))
+        self.assertEqual((59, 0, 1, 0), self.counters())
+        self.assertEqual((59, 0, 1, 0), self.tracker.count_parts(VIDEO_IDENTIFIER, SHARDS))
+        self.assertEqual([], list(self.tracker.expired_leases(VIDEO_IDENTIFIER, SHARDS, 2000)))
+
+    def test_reclaim_expired_lease(self):
+        key = self.keys[0]
+
+        self.tracker.start_part(VIDEO_IDENTIFIER, key, SHARDS, 1000)
+        self.tracker.start_part(VIDEO_IDENTIFIER, self.keys[1], SHARDS, 3000)
+
+        self.assertEqual([(key, 1000, 1)], list(self.tracker.expired_leases(VIDEO_IDENTIFIER, SHARDS, 2000)))
+
+        # Only the holder of the lease seen can be reclaimed
+        self.assertFalse(self.tracker.reclaim_part(VIDEO_IDENTIFIER, key, SHARDS, 999))
+        self.assertTrue(self.tracker.reclaim_part(VIDEO_IDENTIFIER, key, SHARDS, 1000))
+        self.assertEqual((59, 1, 0, 0), self.counters())
+        self.assertIn(key, list(self.tracker.pending_parts(VIDEO_IDENTIFIER, SHARDS, 1000)))
+
+        # The late worker can't complete the part reclaimed
+        self.assertFalse(self.tracker.complete_part(VIDEO_IDENTIFIER, key, SHARDS))
+
+        self.tracker.start_part(VIDEO_IDENTIFIER, key, SHARDS, 4000)
+        self.assertEqual([(self.keys[1], 3000, 1), (key, 4000, 2)], sorted(self.tracker.expired_leases(VIDEO_IDENTIFIER, SHARDS, 5000), key=lambda lease: lease[1]))
+        self.assertTrue(self.tracker.reclaim_part(VIDEO_IDENTIFIER, key, SHARDS, 4000, failed=True))
+        self.assertEqual((58, 1, 0, 1), self.counters())
+        self.assertEqual((58, 1, 0, 1), self.tracker.count_parts(VIDEO_IDENTIFIER, SHARDS))
+
+    def test_complete_leased_part(self):
+        self.tracker.start_part(VIDEO_IDENTIFIER, self.keys[0], SHARDS, 1000)
+        self.tracker.start_part(VIDEO_IDENTIFIER, self.keys[1], SHARDS, 2000)
+
+        self.assertEqual(set([self.keys[0]]), self.tracker.leased_parts(VIDEO_IDENTIFIER, self.keys[:3], SHARDS, 1000))
+
+        # Only the holder of the lease completes the part
+        self.assertFalse(self.tracker.complete_part(VIDEO_IDENTIFIER, self.keys[1], SHARDS, 1000))
+        self.assertTrue(self.tracker.complete_part(VIDEO_IDENTIFIER, self.keys[0], SHARDS, 1000))
+        self.assertEqual((58, 1, 1, 0), self.counters())
+        self.assertEqual(set(), self.tracker.leased_parts(VIDEO_IDENTIFIER, self.keys[:3], SHARDS, 1000))
+
+    def test_status_and_counters_in_one_transaction(self):
+        key = self.keys[0]
+
+        # The counters of a process item that can't be written leave the part as it was
+        tracker = PartTracker(self.dynamodb, 'RVA_PROCESS_TABLE_MISSING', RVA_PROCESS_PARTS_TABLE)
+        self.assertRaises(ClientError, tracker.start_part, VIDEO_IDENTIFIER, key, SHARDS, 1000)
+        self.assertIn(key, list(self.tracker.pending_parts(VIDEO_IDENTIFIER, SHARDS, 1000)))
+        self.assertEqual((60, 0, 0, 0), self.counters())
+
+    def test_transaction_conflict_retried(self):
+        conflict = ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                                'CancellationReasons': [{'Code': 'None'}, {'Code': 'TransactionConflict'}]}, 'TransactWriteItems')
+        errors = [conflict, conflict]
+        transact_write_items = self.dynamodb.transact_write_items
+        self.tracker.sleep = mock.Mock()
+
+        def conflicting_transact_write_items(**kwargs):
+            if errors:
+                raise errors.pop()
+            return transact_write_items(**kwargs)
+
+        with mock.patch.object(self.dynamodb, 'transact_write_items', side_effect=conflicting_transact_write_items):
+            self.assertTrue(self.tracker.start_part(VIDEO_IDENTIFIER, self.keys[0], SHARDS, 1000))
+
+        self.assertEqual(2, self.tracker.sleep.call_count)
+        self.assertEqual((59, 1, 0, 0), self.counters())
+
+
+def create_tables(dynamodb):
+    dynamodb.create_table(TableName=RVA_PROCESS_TABLE,
+        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+    dynamodb.create_table(TableName=RVA_PROCESS_PARTS_TABLE,
+        KeySchema=[{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'Key', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'Shard', 'AttributeType': 'S'},
+                              {'AttributeName': 'Key', 'AttributeType': 'S'},
+                              {'AttributeName': 'PendingKey', 'AttributeType': 'S'},
+                              {'AttributeName': 'LeaseExpires', 'AttributeType': 'N'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': PENDING_INDEX,
+            'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'PendingKey', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        }, {
+            'IndexName': LEASES_INDEX,
+            'KeySchema': [{'AttributeName': 'Shard', 'KeyType': 'HASH'}, {'AttributeName': 'LeaseExpires', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['Attempts']},
+            'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        }],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
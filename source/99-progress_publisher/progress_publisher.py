@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+from botocore.exceptions import ClientError
+import boto3
+import json
+import logging
+import time
+
+logger = logging.getLogger()
+
+# CONSTANTS
+DEFAULT_PROGRESS_TABLE = 'RVA_PROGRESS_TABLE'
+DEFAULT_MIN_CHANGE = 5       # percentage points
+DEFAULT_MIN_INTERVAL = 10    # seconds
+DEFAULT_TTL = 24 * 60 * 60   # seconds the last message of a topic is remembered
+MESSAGE_TYPE_STATUS = 'status'
+
+
+class ProgressPublisher:
+    '''
+    Publishes the progress messages of the IoT topics, leaving out the ones users wouldn't notice.
+
+    The last status message published to a topic is kept in the progress table, with a TTL. A status
+    message is published when its text is not the last one published or its percentage moved up by
+    min_change, or moved up at all after min_interval seconds. The decision is a conditional update
+    of the topic, so concurrent callers don't publish the same progress twice. Any other message
+    type, e.g. a redirect once the process ends, is always published.
+    '''
+
+    def __init__(self, publish_function, table_name=DEFAULT_PROGRESS_TABLE, min_change=DEFAULT_MIN_CHANGE,
+                 min_interval=DEFAULT_MIN_INTERVAL, ttl=DEFAULT_TTL, dynamodb_client=None):
+        self.publish_function = publish_function
+        self.table_name = table_name
+        self.min_change = min_change
+        self.min_interval = min_interval
+        self.ttl = ttl
+        self.dynamodb_client = dynamodb_client or boto3.client('dynamodb')
+        self.time = time.time
+
+    def publish(self, message):
+        '''
+        Publishes a message, a dict with the 'topic', 'type' and 'payload' of the IoT publish function,
+        unless it's a status message too close to the last one. Returns True when it was published.
+        '''
+        if message['type'] == MESSAGE_TYPE_STATUS and not self.should_publish(message['topic'], message['payload']):
+            logger.debug("ProgressPublisher - skipping '{}' on '{}'".format(message['payload'], message['topic']))
+            return False
+
+        self.publish_function(json.dumps(message))
+
+        return True
+
+    def should_publish(self, topic, payload):
+        now = int(self.time())
+        percentage = int(payload.get('percentage', 0))
+
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key={'Topic': {'S': topic}},
+                UpdateExpression='SET #msg = :msg, Percentage = :percentage, PublishedAt = :now, ExpiresAt = :expires',
+                ConditionExpression='attribute_not_exists(#msg) OR #msg <> :msg OR Percentage <= :threshold OR '
+                                    '(Percentage < :percentage AND PublishedAt <= :since)',
+                ExpressionAttributeNames={'#msg': 'Message'},
+                ExpressionAttributeValues={
+                    ':msg': {'S': payload.get('message', '')},
+                    ':percentage': {'N': str(percentage)},
+                    ':threshold': {'N': str(percentage - self.min_change)},
+                    ':now': {'N': str(now)},
+                    ':since': {'N': str(now - self.min_interval)},
+                    ':expires': {'N': str(now + self.ttl)}
+                })
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+
+            # Users still see the progress when the table can't be used
+            logger.error("ProgressPublisher - error reading the last progress of '{}'".format(topic))
+            logger.error(err)
+
+        return True
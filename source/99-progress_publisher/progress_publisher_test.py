@@ -0,0 +1,79 @@
+import unittest
+import mock
+import boto3
+import json
+import logging
+
+from botocore.exceptions import ClientError
+
+from progress_publisher import ProgressPublisher, DEFAULT_PROGRESS_TABLE
+from moto import mock_dynamodb2
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+TOPIC = 'rekognition/video-topic'
+
+
+def status(message, percentage):
+    return {'topic': TOPIC, 'type': 'status', 'payload': {'message': message, 'percentage': percentage}}
+
+
+class TestProgressPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_dynamodb2()
+        self.mock.start()
+
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(TableName=DEFAULT_PROGRESS_TABLE,
+            KeySchema=[{'AttributeName': 'Topic', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'Topic', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+        self.published = []
+        self.publisher = ProgressPublisher(self.published.append, min_change=5, min_interval=10, dynamodb_client=dynamodb)
+        self.publisher.time = lambda: 1000.0
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def percentages(self):
+        return [json.loads(message)['payload'].get('percentage') for message in self.published]
+
+    def test_min_change(self):
+        for percentage in [60, 61, 63, 65, 66, 71]:
+            self.publisher.publish(status('Analyzing frames', percentage))
+
+        self.assertEqual([60, 65, 71], self.percentages())
+
+    def test_min_interval(self):
+        self.assertTrue(self.publisher.publish(status('Analyzing frames', 60)))
+        self.assertFalse(self.publisher.publish(status('Analyzing frames', 61)))
+
+        self.publisher.time = lambda: 1010.0
+        self.assertFalse(self.publisher.publish(status('Analyzing frames', 60)))
+        self.assertTrue(self.publisher.publish(status('Analyzing frames', 61)))
+
+    def test_new_stage_and_terminal_messages(self):
+        self.publisher.publish(status('Analyzing frames', 89))
+        self.publisher.publish(status('Consolidating results', 90))
+        self.publisher.publish({'topic': TOPIC, 'type': 'redirect', 'payload': {'identifier': 'video.mp4'}})
+        self.publisher.publish({'topic': TOPIC, 'type': 'redirect', 'payload': {'identifier': 'video.mp4'}})
+
+        self.assertEqual([89, 90, None, None], self.percentages())
+
+    def test_table_error_publishes(self):
+        dynamodb = mock.Mock()
+        dynamodb.update_item.side_effect = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'UpdateItem')
+        publisher = ProgressPublisher(self.published.append, dynamodb_client=dynamodb)
+
+        self.assertTrue(publisher.publish(status('Analyzing frames', 60)))
+        self.assertTrue(publisher.publish(status('Analyzing frames', 60)))
+
+
+if __name__ == '__main__':
+    unittest.main()
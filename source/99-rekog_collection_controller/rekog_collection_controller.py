@@ -10,6 +10,8 @@ import logging
 import time
 import string
 import random
+import threading
+from rekognition_rate_limiter import rate_limited, API_CREATE_COLLECTION
 
 # Lambda Variables
 LOG_LEVEL = str(os.environ.get('LOG_LEVEL', 'INFO')).upper()
@@ -27,6 +29,7 @@ MAX_BACKOFF = 15 # seconds
 MAX_RETRIES = 5
 RETRY_EXCEPTIONS = ('ProvisionedThroughputExceededException',
                     'ThrottlingException')
+DEFAULT_REGISTRY_TTL = 60 # seconds
 
 # Services
 
@@ -97,6 +100,7 @@ class RekognitionCollectionController:
         return collection_id
 
 
+    @rate_limited(API_CREATE_COLLECTION)
     def create_collection_call(self, collection_id):
         logger.debug(">create_collection_call '{}'".format(collection_id))
 
@@ -109,16 +113,18 @@ class RekognitionCollectionController:
         r = self.dynamodb_client.update_item(
             TableName=self.control_table_id,
             Key={"Identifier": {"S": self.control_record_id}},
-            UpdateExpression="SET #curr = :newvalue, #cnt = :count, #cols = :coll_id", #list_append(if_not_exists(#cols, :empty_list), :coll_id)",
+            UpdateExpression="SET #curr = :newvalue, #cnt = :count, #cols = :coll_id ADD #ver :one", #list_append(if_not_exists(#cols, :empty_list), :coll_id)",
             ExpressionAttributeNames={
                 '#curr': 'Current',
                 '#cnt': 'Count',
-                '#cols': 'CollectionIds'
+                '#cols': 'CollectionIds',
+                '#ver': 'Version'
             },
             ExpressionAttributeValues={
                 ':newvalue': {'S': collection_id},
                 ':count': {'N': "0"},
-                ':coll_id': {'L': [{'S': collection_id}]}
+                ':coll_id': {'L': [{'S': collection_id}]},
+                ':one': {'N': "1"}
             },
             ReturnConsumedCapacity='TOTAL'
         )
@@ -131,16 +137,18 @@ class RekognitionCollectionController:
         r = self.dynamodb_client.update_item(
             TableName=self.control_table_id,
             Key={"Identifier": {"S": self.control_record_id}},
-            UpdateExpression="SET #curr = :newvalue, #cnt = :count, #cols = list_append(#cols, :coll_id)",
+            UpdateExpression="SET #curr = :newvalue, #cnt = :count, #cols = list_append(#cols, :coll_id) ADD #ver :one",
             ExpressionAttributeNames={
                 '#curr': 'Current',
                 '#cnt': 'Count',
-                '#cols': 'CollectionIds'
+                '#cols': 'CollectionIds',
+                '#ver': 'Version'
             },
             ExpressionAttributeValues={
                 ':newvalue': {'S': collection_id},
                 ':count': {'N': "0"},
-                ':coll_id': {'L': [{'S': collection_id}]}
+                ':coll_id': {'L': [{'S': collection_id}]},
+                ':one': {'N': "1"}
             },
             ReturnConsumedCapacity='TOTAL'
         )
@@ -178,7 +186,15 @@ class RekognitionCollectionController:
         return new_cnt
 
     def list_collections(self):
+        return self.list_collections_version()[0]
+
+    def list_collections_version(self):
+        '''
+        Returns the collections of the control record with its version, 0 for a record written
+        before the version was kept.
+        '''
         collections = []
+        version = 0
 
         r = self.dynamodb_client.get_item(
             TableName=self.control_table_id,
@@ -190,8 +206,24 @@ class RekognitionCollectionController:
         if 'Item' in r:
             for coll_id in r['Item']['CollectionIds']['L']:
                 collections.append(coll_id['S'])
+            version = int(r['Item'].get('Version', {'N': "0"})['N'])
+
+        return collections, version
+
+    def get_version(self):
+        '''
+        Returns the version of the control record, bumped each time a collection is added.
+        '''
+        r = self.dynamodb_client.get_item(
+            TableName=self.control_table_id,
+            Key={"Identifier": {"S": self.control_record_id}},
+            ProjectionExpression="#ver",
+            ExpressionAttributeNames={'#ver': 'Version'},
+            ConsistentRead=True,
+            ReturnConsumedCapacity='TOTAL'
+        )
 
-        return collections
+        return int(r.get('Item', {}).get('Version', {'N': "0"})['N'])
 
     def get_current_collection(self):
         response = None
@@ -211,3 +243,33 @@ class RekognitionCollectionController:
         logger.debug("get_current_collection response: {}".format(json.dumps(response)))
 
         return response
+
+
+class CollectionRegistry:
+    '''
+    Caches the collections of a control record, to keep at module scope across the invocations of a
+    warm container. The collections are served from memory for ttl seconds. Once expired, only the
+    version of the control record is read and the collections are read again if it changed.
+    '''
+
+    def __init__(self, controller, ttl=DEFAULT_REGISTRY_TTL, clock=time.time):
+        self.controller = controller
+        self.ttl = ttl
+        self.clock = clock
+        self.collection_ids = None
+        self.version = None
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def list_collections(self):
+        with self.lock:
+            now = self.clock()
+
+            if self.collection_ids is None or (now >= self.expires and self.controller.get_version() != self.version):
+                self.collection_ids, self.version = self.controller.list_collections_version()
+                logger.debug("CollectionRegistry - {} collections, version {}".format(len(self.collection_ids), self.version))
+
+            if now >= self.expires:
+                self.expires = now + self.ttl
+
+            return list(self.collection_ids)
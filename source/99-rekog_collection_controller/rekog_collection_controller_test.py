@@ -3,7 +3,7 @@ import mock
 import json
 import boto3
 
-from rekog_collection_controller import RekognitionCollectionController
+from rekog_collection_controller import RekognitionCollectionController, CollectionRegistry
 #from lambda_function import lambda_handler
 from moto import mock_s3, mock_dynamodb2, mock_dynamodb
 import logging
@@ -226,6 +226,43 @@ class TestActor(unittest.TestCase):
         self.assertEqual(2234, r, msg="Data written in DDB is wrong. Exp: {} Found: {}".format("", ""))
 
 
+class TestCollectionRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.controller = mock.Mock()
+        self.controller.list_collections_version.return_value = (['DVA-000000', 'DVA-000001'], 1)
+        self.controller.get_version.return_value = 1
+        self.registry = CollectionRegistry(self.controller, ttl=60, clock=lambda: self.now)
+
+    def test_cached_until_ttl(self):
+        self.assertEqual(['DVA-000000', 'DVA-000001'], self.registry.list_collections())
+        self.now += 59
+        self.assertEqual(['DVA-000000', 'DVA-000001'], self.registry.list_collections())
+
+        self.assertEqual(1, self.controller.list_collections_version.call_count)
+        self.controller.get_version.assert_not_called()
+
+    def test_expired_same_version(self):
+        self.registry.list_collections()
+        self.now += 60
+        self.registry.list_collections()
+        self.now += 30
+        self.registry.list_collections()
+
+        self.assertEqual(1, self.controller.list_collections_version.call_count)
+        self.assertEqual(1, self.controller.get_version.call_count)
+
+    def test_expired_new_version(self):
+        self.registry.list_collections()
+        self.controller.list_collections_version.return_value = (['DVA-000000', 'DVA-000001', 'DVA-000002'], 2)
+        self.controller.get_version.return_value = 2
+        self.now += 60
+
+        self.assertEqual(['DVA-000000', 'DVA-000001', 'DVA-000002'], self.registry.list_collections())
+        self.assertEqual(2, self.controller.list_collections_version.call_count)
+
+
 def create_RVA_COLLECTION_CONTROL_TABLE(dynamodb):
     dynamodb.create_table(TableName=RVA_COLLECTION_CONTROL_TABLE,
                         KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
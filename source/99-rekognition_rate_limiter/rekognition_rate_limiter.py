@@ -0,0 +1,215 @@
+from __future__ import print_function
+
+from botocore.exceptions import ClientError
+from functools import wraps
+import boto3
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Constants
+API_INDEX_FACES = 'IndexFaces'
+API_DETECT_LABELS = 'DetectLabels'
+API_SEARCH_FACES_BY_IMAGE = 'SearchFacesByImage'
+API_DETECT_FACES = 'DetectFaces'
+API_CREATE_COLLECTION = 'CreateCollection'
+
+# Transactions per second allowed for each API when no environment variable overrides it.
+DEFAULT_TPS = {
+    API_INDEX_FACES: 50,
+    API_DETECT_LABELS: 50,
+    API_SEARCH_FACES_BY_IMAGE: 50,
+    API_DETECT_FACES: 50,
+    API_CREATE_COLLECTION: 5
+}
+DEFAULT_LEASE_SIZE = 5
+LEASE_TTL = 60 # seconds
+
+# Lambda Variables
+# REKOGNITION_TPS_<API> overrides the TPS of an API (0 disables the limit), e.g. REKOGNITION_TPS_INDEXFACES=20
+# When REKOGNITION_RATE_LIMIT_TABLE is set the TPS is shared by all the containers through that table.
+REKOGNITION_RATE_LIMIT_TABLE = os.getenv('REKOGNITION_RATE_LIMIT_TABLE', '')
+REKOGNITION_RATE_LIMIT_LEASE_SIZE = int(os.getenv('REKOGNITION_RATE_LIMIT_LEASE_SIZE', DEFAULT_LEASE_SIZE))
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+class FleetLease:
+    '''
+    Shares the TPS of an API between containers. Each container leases a block of calls for the
+    current one second window with an atomic counter, and the lease is refused once the fleet
+    has used up the window.
+    '''
+
+    def __init__(self, dynamodb_client, table_name, api, tps, lease_size=DEFAULT_LEASE_SIZE):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.api = api
+        self.tps = tps
+        self.lease_size = max(1, min(lease_size, tps))
+
+    def lease(self, window):
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key={"Identifier": {"S": "{}#{}".format(self.api, window)}},
+                UpdateExpression="ADD #cnt :lease SET #exp = :expires",
+                ConditionExpression="attribute_not_exists(#cnt) OR #cnt <= :max",
+                ExpressionAttributeNames={
+                    '#cnt': 'Count',
+                    '#exp': 'ExpiresAt'
+                },
+                ExpressionAttributeValues={
+                    ':lease': {'N': str(self.lease_size)},
+                    ':max': {'N': str(self.tps - self.lease_size)},
+                    ':expires': {'N': str(window + LEASE_TTL)}
+                }
+            )
+            return self.lease_size
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return 0
+
+            # Never stop processing because the lease table is unavailable, the local limit still applies
+            logger.warn("FleetLease - {} - lease failed, using the local limit only: {}".format(self.api, err))
+            return self.lease_size
+
+
+class RateLimiter:
+    '''
+    Token bucket limiting the calls to one API from this container, optionally backed by a FleetLease.
+    '''
+
+    def __init__(self, api, tps, burst=None, fleet_lease=None):
+        self.api = api
+        self.tps = float(tps)
+        self.burst = float(burst if burst is not None else max(1, tps))
+        self.tokens = self.burst
+        self.fleet_lease = fleet_lease
+        self.leased_tokens = 0
+        self.lease_window = None
+        self.lease_exhausted = False
+        self.leasing = False
+        self.lease_condition = threading.Condition()
+        self.clock = time.time
+        self.sleep = time.sleep
+        self.last_refill = self.clock()
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.tps > 0
+
+    def _reserve_local(self):
+        # Returns how long the caller has to wait for the token it just reserved
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.tps)
+            self.last_refill = now
+            self.tokens -= 1
+
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.tps
+
+    def _reserve_fleet(self):
+        # Returns 0 when a leased token was taken, otherwise how long to wait for the next window.
+        # One thread at a time leases from the fleet, outside the lock, while the others wait for its
+        # lease, and an empty lease is kept until the window ends so the table is not asked again.
+        with self.lease_condition:
+            while True:
+                now = self.clock()
+                window = int(now)
+
+                if self.lease_window != window:
+                    self.lease_window = window
+                    self.leased_tokens = 0
+                    self.lease_exhausted = False
+
+                if self.leased_tokens > 0:
+                    self.leased_tokens -= 1
+                    return 0.0
+
+                if self.lease_exhausted:
+                    return window + 1 - now
+
+                if not self.leasing:
+                    break
+
+                self.lease_condition.wait()
+
+            self.leasing = True
+
+        leased = 0
+        try:
+            leased = self.fleet_lease.lease(window)
+        finally:
+            with self.lease_condition:
+                self.leasing = False
+
+                if self.lease_window == window:
+                    self.leased_tokens += leased
+                    self.lease_exhausted = leased == 0
+
+                self.lease_condition.notify_all()
+
+        return self._reserve_fleet()
+
+    def acquire(self):
+        '''
+        Blocks until a call to the API is allowed. Returns the number of seconds waited.
+        '''
+        if not self.enabled():
+            return 0.0
+
+        waited = self._reserve_local()
+        if waited > 0:
+            self.sleep(waited)
+
+        if self.fleet_lease:
+            wait = self._reserve_fleet()
+            while wait > 0:
+                self.sleep(wait)
+                waited += wait
+                wait = self._reserve_fleet()
+
+        if waited > 0:
+            logger.debug("RateLimiter - {} - waited '{}' s".format(self.api, waited))
+
+        return waited
+
+
+def get_rate_limiter(api):
+    '''
+    Returns the rate limiter of the API, shared by all the threads of the container.
+    '''
+    with rate_limiters_lock:
+        if api not in rate_limiters:
+            tps = int(os.getenv('REKOGNITION_TPS_{}'.format(api.upper()), DEFAULT_TPS.get(api, 0)))
+            fleet_lease = None
+
+            if REKOGNITION_RATE_LIMIT_TABLE and tps > 0:
+                fleet_lease = FleetLease(boto3.client('dynamodb'), REKOGNITION_RATE_LIMIT_TABLE, api, tps,
+                                         REKOGNITION_RATE_LIMIT_LEASE_SIZE)
+
+            rate_limiters[api] = RateLimiter(api, tps, fleet_lease=fleet_lease)
+
+        return rate_limiters[api]
+
+
+def rate_limited(api):
+    '''
+    Decorator taking a token from the API rate limiter before every call. Apply it below @retry so
+    every retry waits for its own token.
+    '''
+    def decorator_rate_limited(f):
+
+        @wraps(f)
+        def f_rate_limited(*args, **kwargs):
+            get_rate_limiter(api).acquire()
+            return f(*args, **kwargs)
+
+        return f_rate_limited
+
+    return decorator_rate_limited
@@ -0,0 +1,193 @@
+import unittest
+import mock
+import boto3
+import logging
+import threading
+import time
+from multiprocessing.dummy import Pool
+
+from moto import mock_dynamodb2
+
+import rekognition_rate_limiter
+from rekognition_rate_limiter import RateLimiter, FleetLease, rate_limited, get_rate_limiter
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+RATE_LIMIT_TABLE = 'RVA_RATE_LIMIT_TABLE'
+
+
+class FakeClock(object):
+    '''
+    Replaces time.time/time.sleep so the tests don't depend on the machine speed.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+def new_rate_limiter(tps, burst=None, fleet_lease=None):
+    clock = FakeClock()
+    rl = RateLimiter('IndexFaces', tps, burst, fleet_lease)
+    rl.clock = clock.time
+    rl.sleep = clock.sleep
+    rl.last_refill = clock.now
+    return rl, clock
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_burst_is_not_delayed(self):
+        rl, clock = new_rate_limiter(10)
+
+        for _ in range(10):
+            rl.acquire()
+
+        self.assertEqual(0.0, clock.slept)
+
+    def test_calls_are_spaced_at_tps(self):
+        rl, clock = new_rate_limiter(10, burst=1)
+
+        for _ in range(21):
+            rl.acquire()
+
+        self.assertAlmostEqual(2.0, clock.slept)
+
+    def test_zero_tps_disables_limit(self):
+        rl, clock = new_rate_limiter(0)
+
+        for _ in range(100):
+            rl.acquire()
+
+        self.assertEqual(0.0, clock.slept)
+
+    def test_threads_share_the_bucket(self):
+        rl = RateLimiter('DetectLabels', 1000, burst=1)
+        calls = []
+
+        @rate_limited('DetectLabels')
+        def call(i):
+            calls.append(i)
+
+        with mock.patch.dict(rekognition_rate_limiter.rate_limiters, {'DetectLabels': rl}):
+            pool = Pool(8)
+            pool.map(call, range(200))
+            pool.close()
+            pool.join()
+
+        self.assertEqual(200, len(calls))
+        self.assertLessEqual(rl.tokens, 0)
+
+    @mock.patch.dict(rekognition_rate_limiter.rate_limiters, {})
+    @mock.patch.dict('os.environ', {'REKOGNITION_TPS_SEARCHFACESBYIMAGE': '7'})
+    def test_tps_from_environment(self):
+        self.assertEqual(7, get_rate_limiter('SearchFacesByImage').tps)
+        self.assertEqual(5, get_rate_limiter('CreateCollection').tps)
+        self.assertIs(get_rate_limiter('SearchFacesByImage'), get_rate_limiter('SearchFacesByImage'))
+
+
+class TestFleetLease(unittest.TestCase):
+
+    @mock_dynamodb2
+    def test_fleet_stays_under_tps(self):
+        dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+        create_RATE_LIMIT_TABLE(dynamodb)
+
+        # Two containers sharing 10 TPS, each one leasing 5 calls at a time
+        first, clock = new_rate_limiter(100, fleet_lease=FleetLease(dynamodb, RATE_LIMIT_TABLE, 'IndexFaces', 10, 5))
+        second = RateLimiter('IndexFaces', 100, fleet_lease=FleetLease(dynamodb, RATE_LIMIT_TABLE, 'IndexFaces', 10, 5))
+        second.clock = clock.time
+        second.sleep = clock.sleep
+        second.last_refill = clock.now
+
+        for _ in range(5):
+            first.acquire()
+            second.acquire()
+        self.assertEqual(0.0, clock.slept)
+
+        # The window is used up, the next call waits for the next second
+        first.acquire()
+        self.assertAlmostEqual(1.0, clock.slept)
+
+        item = dynamodb.get_item(TableName=RATE_LIMIT_TABLE, Key={'Identifier': {'S': 'IndexFaces#1000'}})['Item']
+        self.assertEqual('10', item['Count']['N'])
+
+    def test_lease_errors_fall_back_to_local_limit(self):
+        dynamodb = mock.Mock()
+        dynamodb.update_item.side_effect = rekognition_rate_limiter.ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': ''}}, 'UpdateItem')
+
+        lease = FleetLease(dynamodb, RATE_LIMIT_TABLE, 'IndexFaces', 10, 5)
+
+        self.assertEqual(5, lease.lease(1000))
+
+    def test_empty_lease_kept_for_the_window(self):
+        fleet_lease = mock.Mock()
+        fleet_lease.lease.side_effect = [0, 5]
+        rl, clock = new_rate_limiter(100, fleet_lease=fleet_lease)
+
+        # The fleet used up the window, the calls of this window wait without asking the table again
+        for _ in range(3):
+            self.assertAlmostEqual(1.0, rl._reserve_fleet())
+        self.assertEqual(1, fleet_lease.lease.call_count)
+
+        clock.now += 1
+        self.assertEqual(0.0, rl._reserve_fleet())
+        self.assertEqual([mock.call(1000), mock.call(1001)], fleet_lease.lease.call_args_list)
+
+    def test_one_lease_at_a_time(self):
+        calls = []
+        unlocked = []
+
+        def try_lock():
+            if rl.lease_condition.acquire(False):
+                unlocked.append(True)
+                rl.lease_condition.release()
+
+        def lease(window):
+            calls.append(window)
+
+            # The lease is taken without holding the lock of the rate limiter
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+
+            time.sleep(0.05)
+            return 20
+
+        fleet_lease = mock.Mock()
+        fleet_lease.lease.side_effect = lease
+        rl, clock = new_rate_limiter(100, fleet_lease=fleet_lease)
+
+        # The threads waiting for a token use the lease of the first one instead of leasing their own
+        pool = Pool(8)
+        waits = pool.map(lambda i: rl._reserve_fleet(), range(16))
+        pool.close()
+        pool.join()
+
+        self.assertEqual([0.0] * 16, waits)
+        self.assertEqual([1000], calls)
+        self.assertEqual([True], unlocked)
+        self.assertEqual(4, rl.leased_tokens)
+
+
+def create_RATE_LIMIT_TABLE(dynamodb):
+    dynamodb.create_table(TableName=RATE_LIMIT_TABLE,
+                        KeySchema=[{'AttributeName': 'Identifier', 'KeyType': 'HASH'}],
+                        AttributeDefinitions=[{'AttributeName': 'Identifier', 'AttributeType': 'S'}],
+                        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()